@@ -1,3 +1,24 @@
-# from django.contrib import admin
+# pylint: disable=line-too-long
 
-# Register your models here.
+from django.contrib import admin
+
+from .models import BackupArtifact, BackupArtifactRange, DumpWatermark
+
+class BackupArtifactRangeInline(admin.TabularInline):
+    model = BackupArtifactRange
+    extra = 0
+
+@admin.register(BackupArtifact)
+class BackupArtifactAdmin(admin.ModelAdmin):
+    list_display = ('path', 'app', 'destination', 'start_date', 'end_date', 'size', 'codec', 'row_count', 'transmitted',)
+    list_filter = ('transmitted', 'destination', 'app', 'codec',)
+    search_fields = ('path', 'app', 'checksum',)
+
+    inlines = [
+        BackupArtifactRangeInline,
+    ]
+
+@admin.register(DumpWatermark)
+class DumpWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('model', 'field', 'start_date', 'end_date', 'start_value', 'end_value',)
+    list_filter = ('model', 'field',)
@@ -0,0 +1,190 @@
+# pylint: disable=line-too-long
+
+'''
+Reading stored backup artifacts back: locating their windows, fetching
+them (reassembling deduplicated files from their chunks) and streaming the
+fixture records they hold.
+'''
+
+import codecs
+import datetime
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+
+from .compression import codec_for_header
+from .deduplication import MANIFEST_SUFFIX, manifest_chunk_paths, read_manifest, reassemble_file
+from .encryption import decrypt_file, open_decrypted
+
+READ_SIZE = 1024 * 1024
+
+DEFAULT_FOLDER_FORMAT = '%(start_date)s__%(end_date)s'
+
+# Matches the default SIMPLE_BACKUP_FOLDER_FORMAT ('%(start_date)s__%(end_date)s').
+
+WINDOW_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})__(\d{4}-\d{2}-\d{2})')
+
+def parse_date(value):
+    return datetime.date(*[int(component) for component in value.split('-')])
+
+def artifact_window(remote_path):
+    match = WINDOW_PATTERN.search(remote_path)
+
+    if match is None:
+        return None
+
+    return parse_date(match.group(1)), parse_date(match.group(2))
+
+def window_folder(start_date, end_date):
+    folder_path_format = getattr(settings, 'SIMPLE_BACKUP_FOLDER_FORMAT', DEFAULT_FOLDER_FORMAT)
+
+    return folder_path_format % {
+        'start_date': str(start_date),
+        'end_date': str(end_date),
+        'clear': 'data-retained',
+    }
+
+# Restores fetch artifacts on several threads into one staging folder, and
+# deduplicated manifests share chunks. Each chunk is fetched once, under its
+# own lock, and only appears under its final name once complete.
+
+CHUNK_LOCKS = {}
+CHUNK_LOCKS_LOCK = threading.Lock()
+
+def make_folder(folder):
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if os.path.isdir(folder) is False:
+            raise
+
+def fetch_chunk(destination, chunk_remote, chunk_local):
+    with CHUNK_LOCKS_LOCK:
+        chunk_lock = CHUNK_LOCKS.setdefault(chunk_local, threading.Lock())
+
+    with chunk_lock:
+        if os.path.exists(chunk_local):
+            return
+
+        make_folder(os.path.dirname(chunk_local))
+
+        handle, partial_path = tempfile.mkstemp(dir=os.path.dirname(chunk_local), suffix='.partial')
+
+        os.close(handle)
+
+        try:
+            destination.fetch(chunk_remote, partial_path)
+
+            os.rename(partial_path, chunk_local)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+def fetch_artifact(key, destination, remote_path, staging):
+    '''
+    Fetches one artifact below staging and returns (local path, encrypted).
+    Manifests of deduplicated backups are decrypted and their chunks
+    fetched, and the reassembled (compressed, unencrypted) file is returned
+    instead.
+    '''
+
+    local_path = os.path.join(staging, remote_path.replace('/', os.sep))
+
+    make_folder(os.path.dirname(local_path))
+
+    destination.fetch(remote_path, local_path)
+
+    if local_path.endswith(MANIFEST_SUFFIX + '.encrypted') is False:
+        return local_path, True
+
+    manifest_path = local_path[:-len('.encrypted')]
+
+    decrypt_file(key, local_path, manifest_path)
+
+    for chunk_remote in manifest_chunk_paths(read_manifest(manifest_path)):
+        fetch_chunk(destination, chunk_remote, os.path.join(staging, chunk_remote.replace('/', os.sep)))
+
+    return reassemble_file(key, manifest_path, staging), False
+
+# Whitespace, and the commas between array elements, before the next record.
+
+SEPARATOR_PATTERN = re.compile(r'[\s,]*')
+
+def iter_json_values(reader):
+    '''
+    Parses the records of a JSON array (dumpdata output, written on a single
+    line) or of JSON lines (native dumps) one at a time from a binary
+    stream. Only the unparsed rest of the last read is held in memory.
+    '''
+
+    decoder = json.JSONDecoder()
+
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+
+    text = ''
+    position = 0
+
+    in_array = None
+    finished = False
+
+    while True:
+        position = SEPARATOR_PATTERN.match(text, position).end()
+
+        if position < len(text):
+            if in_array is None:
+                in_array = text[position] == '['
+
+                if in_array:
+                    position += 1
+
+                continue
+
+            if in_array and text[position] == ']':
+                return
+
+            try:
+                record, position = decoder.raw_decode(text, position)
+            except ValueError:
+                # The record continues in the next read (or the file is malformed).
+
+                if finished:
+                    raise
+            else:
+                yield record
+
+                continue
+        elif finished:
+            return
+
+        chunk = reader.read(READ_SIZE)
+
+        finished = not chunk
+
+        text = text[position:] + decode(chunk, final=finished)
+        position = 0
+
+def iter_records(key, path, encrypted=True):
+    '''
+    Streams the fixture records of a fetched artifact: decrypting, detecting
+    and undoing compression, then parsing JSON lines (native dumps) or a
+    JSON array (dumpdata output) record by record.
+    '''
+
+    with io.open(path, 'rb') as fetched_file:
+        reader = fetched_file
+
+        if encrypted:
+            reader = open_decrypted(key, fetched_file)
+
+        codec = codec_for_header(reader.peek(8)[:8])
+
+        if codec is not None:
+            reader = codec.open_reader(reader)
+
+        for record in iter_json_values(reader): # pylint: disable=use-yield-from
+            yield record
@@ -1,25 +1,237 @@
-import bz2
-import gc
+# pylint: disable=no-member,line-too-long
+
+import datetime
 import io
+import json
 import logging
 import os
 import sys
 import tempfile
 
+import six
+
+import django
+
+from django.apps import apps
 from django.conf import settings
-from django.core import management
+from django.core import management, serializers
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.db import DEFAULT_DB_ALIAS, models, router
+from django.db.models import Max, Prefetch, Q
 from django.utils.text import slugify
 
+from .catalog import CatalogStats
+from .compression import configured_codec
+from .fixtures import counted_json_format
+
 logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
-def incremental_backup(parameters): # pylint: disable=unused-argument
-    to_transmit = []
+# Amount of uncompressed dump output buffered before it is handed to the compressor.
+
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Rows fetched per database round trip by incremental dumps.
+
+DEFAULT_ITERATOR_CHUNK_SIZE = 2000
+
+class CompressedFixtureWriter(object): # pylint: disable=useless-object-inheritance, too-many-instance-attributes
+    '''
+    File-like adapter that compresses text written to it (e.g. by dumpdata)
+    in fixed-size chunks and writes the compressed output straight through
+    to the staged fixture file, so only one chunk is held in memory at a time.
+    Uses the SIMPLE_BACKUP_COMPRESSION codec unless one is passed in. Rows
+    serialized in the simple_backup_json format (see fixtures) are tallied
+    in stats, when a CatalogStats is passed.
+    '''
+
+    def __init__(self, fixture_file, chunk_size=None, codec=None, stats=None):
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'SIMPLE_BACKUP_STREAM_CHUNK_SIZE', DEFAULT_STREAM_CHUNK_SIZE)
+
+        if codec is None:
+            codec = configured_codec()
+
+        self.fixture_file = fixture_file
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.compressor = codec.compressor()
+        self.pending = []
+        self.pending_size = 0
+        self.bytes_written = 0
+        self.stats = stats
+
+    def write(self, content):
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+
+        self.pending.append(content)
+        self.pending_size += len(content)
+
+        if self.pending_size >= self.chunk_size:
+            self.compress_pending()
+
+    def compress_pending(self):
+        if self.pending_size > 0:
+            self.write_compressed(self.compressor.compress(b''.join(self.pending)))
+
+        self.pending = []
+        self.pending_size = 0
+
+    def write_compressed(self, compressed):
+        if compressed:
+            self.fixture_file.write(compressed)
+
+            self.bytes_written += len(compressed)
+
+    def flush(self):
+        self.compress_pending()
+
+    def close(self):
+        self.compress_pending()
+
+        self.write_compressed(self.compressor.flush())
+
+    def isatty(self): # pylint: disable=no-self-use
+        return False
+
+class StreamingSerializer(PythonSerializer):
+    '''
+    Writes each object as a line of JSON (the "jsonl" fixture format) as soon
+    as it is serialized, instead of collecting a list of every object.
+    '''
+
+    def end_object(self, obj):
+        self.stream.write(json.dumps(self.get_dump_object(obj), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+
+        self._current = None # pylint: disable=attribute-defined-outside-init
+
+    def handle_m2m_field(self, obj, field):
+        # Use prefetched values directly - the base serializer builds a new
+        # queryset for every object and field even when they are prefetched.
+
+        prefetched = getattr(obj, '_prefetched_objects_cache', {}).get(field.name, None)
+
+        if prefetched is None or self.use_natural_foreign_keys or not field.remote_field.through._meta.auto_created: # pylint: disable=protected-access
+            super(StreamingSerializer, self).handle_m2m_field(obj, field) # pylint: disable=super-with-arguments
+
+            return
+
+        self._current[field.name] = [self._value_from_field(related, related._meta.pk) for related in prefetched] # pylint: disable=protected-access
 
-    # Dump full content of these models. No incremental backup here.
+def related_models(model):
+    related = set()
 
-    dumpdata_apps = (
+    for field in model._meta.get_fields(include_hidden=True): # pylint: disable=protected-access
+        if field.concrete and field.is_relation and field.remote_field is not None and field.related_model is not None:
+            related.add(field.related_model)
+
+    related.discard(model)
+
+    return related
+
+def dependency_order(model_list):
+    '''
+    Orders models so that every model comes after the models it refers to
+    (through foreign keys or many-to-many fields). Models in a reference
+    cycle keep their original relative order.
+    '''
+
+    remaining = list(model_list)
+    ordered = []
+
+    while remaining:
+        ready = [model for model in remaining if not related_models(model).intersection(remaining)]
+
+        if not ready:
+            ready = remaining[:1]
+
+        for model in ready:
+            remaining.remove(model)
+            ordered.append(model)
+
+    return ordered
+
+def app_models(app_label):
+    # The same selection as dumpdata: concrete models the database router allows here.
+
+    return [model for model in apps.get_app_config(app_label).get_models() if not model._meta.proxy and router.allow_migrate_model(DEFAULT_DB_ALIAS, model)] # pylint: disable=protected-access
+
+def native_dump(app_label, stream, stats=None):
+    '''
+    Streams every row of an app's models, in dependency order, to stream as
+    JSON lines and returns the number of rows written. Rows are read with
+    server-side iteration and many-to-many values are prefetched per chunk
+    where Django supports it, so memory use is bounded by the chunk size.
+    Rows are tallied in stats (a CatalogStats) when one is passed.
+    '''
+
+    serializer = StreamingSerializer()
+
+    if stats is None:
+        stats = CatalogStats()
+
+    for model in dependency_order(app_models(app_label)):
+        queryset = model._default_manager.order_by(model._meta.pk.name) # pylint: disable=protected-access
+
+        if django.VERSION >= (4, 1):
+            many_to_many = [field for field in model._meta.many_to_many if field.remote_field.through._meta.auto_created] # pylint: disable=protected-access
+
+            queryset = queryset.prefetch_related(*[Prefetch(field.name, queryset=field.related_model._default_manager.only('pk')) for field in many_to_many]) # pylint: disable=protected-access
+
+        serializer.serialize(stats.counted(streamed_rows(queryset)), stream=stream)
+
+    return stats.row_count()
+
+def dump_engine():
+    '''
+    Returns SIMPLE_BACKUP_DUMP_ENGINE: "dumpdata" (the default, the dumpdata
+    management command's JSON output) or "native" (native_dump's faster JSON
+    lines, which loaddata only reads from Django 3.2).
+    '''
+
+    engine = getattr(settings, 'SIMPLE_BACKUP_DUMP_ENGINE', 'dumpdata')
+
+    if engine not in ('dumpdata', 'native'):
+        raise ImproperlyConfigured('Unknown SIMPLE_BACKUP_DUMP_ENGINE "%s" (expected "dumpdata" or "native").' % engine)
+
+    if engine == 'native' and django.VERSION < (3, 2):
+        raise ImproperlyConfigured('SIMPLE_BACKUP_DUMP_ENGINE "native" writes JSON lines fixtures, which loaddata only reads from Django 3.2 (running %s).' % django.get_version())
+
+    return engine
+
+def dumpdata_apps():
+    # Dump full content of these apps. Models listed in
+    # SIMPLE_BACKUP_INCREMENTAL_MODELS only have their changes dumped (see
+    # incremental_dump), so they can be left out of SIMPLE_BACKUP_DUMPDATA_APPS.
+
+    return getattr(settings, 'SIMPLE_BACKUP_DUMPDATA_APPS', (
         'auth',
-    )
+    ))
+
+def full_dump_stem(prefix, app, engine):
+    # The full dump's file name, without the codec extension.
+
+    if engine == 'dumpdata':
+        return prefix + '_' + slugify(app) + '.json-dumpdata'
+
+    return prefix + '_' + slugify(app) + '.jsonl'
+
+def full_dump_stems():
+    '''
+    Returns the file name stems of the full dumps written for
+    SIMPLE_BACKUP_DUMPDATA_APPS by either dump engine. Each holds a whole
+    app, so the newest one supersedes earlier windows' (see
+    retention.compact_windows).
+    '''
+
+    prefix = 'simple_backup_' + settings.ALLOWED_HOSTS[0]
+
+    return set(full_dump_stem(prefix, app, engine) for app in dumpdata_apps() for engine in ('dumpdata', 'native'))
+
+def incremental_backup(parameters):
+    to_transmit = []
 
     prefix = 'simple_backup_' + settings.ALLOWED_HOSTS[0]
 
@@ -30,32 +242,182 @@ def incremental_backup(parameters): # pylint: disable=unused-argument
     except AttributeError:
         pass
 
-    for app in dumpdata_apps:
+    backup_staging = parameters.get('staging_destination', backup_staging)
+
+    engine = dump_engine()
+
+    codec = configured_codec()
+
+    for app in dumpdata_apps():
         logger.info('[simple_backup] Backing up %s...', app)
         sys.stdout.flush()
 
-        buf = io.StringIO()
-        management.call_command('dumpdata', app, stdout=buf)
-        buf.seek(0)
+        path = os.path.join(backup_staging, full_dump_stem(prefix, app, engine) + codec.extension)
+
+        stats = CatalogStats()
+
+        with io.open(path, 'wb') as fixture_file:
+            writer = CompressedFixtureWriter(fixture_file, codec=codec, stats=stats)
+
+            if engine == 'dumpdata':
+                management.call_command('dumpdata', app, format=counted_json_format(), stdout=writer)
+            else:
+                native_dump(app, writer, stats)
+
+            writer.close()
+
+        stats.write(path)
+
+        to_transmit.append(path)
+
+    to_transmit.extend(incremental_dump(parameters, getattr(settings, 'SIMPLE_BACKUP_INCREMENTAL_MODELS', ()), prefix=prefix))
+
+    return to_transmit
+
+def window_dates(parameters):
+    # end_date is exclusive in parameters but inclusive in records, as in the ledger.
+
+    return parameters['start_date'].date(), (parameters['end_date'] - datetime.timedelta(days=1)).date()
+
+def streamed_rows(queryset):
+    chunk_size = getattr(settings, 'SIMPLE_BACKUP_ITERATOR_CHUNK_SIZE', DEFAULT_ITERATOR_CHUNK_SIZE)
+
+    if django.VERSION >= (2, 0):
+        return queryset.iterator(chunk_size=chunk_size)
+
+    return queryset.iterator()
+
+def changed_rows(model, fields, parameters):
+    '''
+    Rows of model with any of fields (dates or datetimes) within the window.
+    '''
+
+    changed = Q()
+
+    for field_name in fields:
+        start = parameters['start_date']
+        end = parameters['end_date']
+
+        field = model._meta.get_field(field_name) # pylint: disable=protected-access
+
+        if isinstance(field, models.DateField) and not isinstance(field, models.DateTimeField):
+            start = start.date()
+            end = end.date()
+
+        changed = changed | Q(**{field_name + '__gte': start, field_name + '__lt': end})
+
+    return model._default_manager.filter(changed).order_by('pk') # pylint: disable=protected-access
+
+def created_before(model, field_name, created_field, moment):
+    # Highest field_name value among rows created before moment.
 
-        database_dump = buf.read()
+    field = model._meta.get_field(created_field) # pylint: disable=protected-access
 
-        buf = None
+    if isinstance(field, models.DateField) and not isinstance(field, models.DateTimeField):
+        moment = moment.date()
 
-        gc.collect()
+    return model._default_manager.filter(**{created_field + '__lt': moment}).aggregate(Max(field_name))[field_name + '__max'] # pylint: disable=protected-access
 
-        compressed_str = bz2.compress(database_dump.encode('utf-8'))
+def new_rows(model, field_name, parameters, created_field=None):
+    '''
+    Rows of model whose high-water mark field falls in the window's range.
+    With created_field (the date or datetime a row was created), the range
+    runs between the highest values among rows created before the window's
+    start and before its end, so windows may run in any order or at once.
+    Without it, the range runs from the highest value recorded by earlier
+    windows to the highest present now, which only holds for windows run in
+    order - a window earlier than one already recorded is refused.
 
-        database_dump = None
+    Re-running a window reuses its recorded range, so retried or resumed
+    runs dump the same rows again.
+    '''
 
-        gc.collect()
+    from .models import DumpWatermark # pylint: disable=import-outside-toplevel
 
-        filename = prefix + '_' + slugify(app) + '.json-dumpdata.bz2'
+    label = model._meta.label # pylint: disable=protected-access
 
-        path = os.path.join(backup_staging, filename)
+    start_date, end_date = window_dates(parameters)
+
+    watermark = DumpWatermark.objects.filter(model=label, field=field_name, start_date=start_date, end_date=end_date).first()
+
+    if watermark is None and created_field is not None:
+        earlier = created_before(model, field_name, created_field, parameters['start_date'])
+
+        current = created_before(model, field_name, created_field, parameters['end_date'])
+
+        watermark = DumpWatermark.objects.create(model=label, field=field_name, start_date=start_date, end_date=end_date, start_value=earlier, end_value=current)
+    elif watermark is None:
+        later = DumpWatermark.objects.filter(model=label, field=field_name, end_date__gt=end_date).order_by('end_date').first()
+
+        if later is not None:
+            raise ValueError('Unable to back up %s for %s__%s after the later %s__%s window: high-water mark ranges depend on the order windows run in. Add a "created_field" to its SIMPLE_BACKUP_INCREMENTAL_MODELS declaration to back up earlier or parallel windows.' % (label, start_date, end_date, later.start_date, later.end_date))
+
+        earlier = DumpWatermark.objects.filter(model=label, field=field_name, end_date__lt=start_date).aggregate(Max('end_value'))['end_value__max']
+
+        current = model._default_manager.aggregate(Max(field_name))[field_name + '__max'] # pylint: disable=protected-access
+
+        watermark = DumpWatermark.objects.create(model=label, field=field_name, start_date=start_date, end_date=end_date, start_value=earlier, end_value=current if current is not None else earlier)
+
+    rows = model._default_manager.all() # pylint: disable=protected-access
+
+    if watermark.start_value is not None:
+        rows = rows.filter(**{field_name + '__gt': watermark.start_value})
+
+    if watermark.end_value is None:
+        return rows.none()
+
+    return rows.filter(**{field_name + '__lte': watermark.end_value}).order_by(field_name)
+
+def incremental_dump(parameters, declarations, prefix=None):
+    '''
+    Writes one compressed fixture per declared model holding only the rows
+    that changed in the window and returns the staged paths. Each
+    declaration is a dict naming the model ('app_label.Model') and either
+    the date or datetime fields that track changes:
+
+        {'model': 'auth.User', 'fields': ('date_joined', 'last_login')}
+
+    or an increasing integer field used as a high-water mark, optionally
+    with the field holding each row's creation date (see new_rows):
+
+        {'model': 'auth.Group', 'high_water_mark': 'id'}
+        {'model': 'auth.User', 'high_water_mark': 'id', 'created_field': 'date_joined'}
+
+    Rows are read with QuerySet.iterator and serialized straight into the
+    compressor, so memory use does not grow with the table.
+    '''
+
+    if prefix is None:
+        prefix = 'simple_backup_' + settings.ALLOWED_HOSTS[0]
+
+    backup_staging = parameters.get('staging_destination', getattr(settings, 'SIMPLE_BACKUP_STAGING_DESTINATION', tempfile.gettempdir()))
+
+    to_transmit = []
+
+    codec = configured_codec()
+
+    for declaration in declarations:
+        model = apps.get_model(declaration['model'])
+
+        if 'high_water_mark' in declaration:
+            rows = new_rows(model, declaration['high_water_mark'], parameters, created_field=declaration.get('created_field', None))
+        else:
+            rows = changed_rows(model, declaration['fields'], parameters)
+
+        logger.info('[simple_backup] Backing up changes to %s...', declaration['model'])
+
+        path = os.path.join(backup_staging, prefix + '_' + slugify(declaration['model']) + '.json-incremental' + codec.extension)
 
         with io.open(path, 'wb') as fixture_file:
-            fixture_file.write(compressed_str)
+            writer = CompressedFixtureWriter(fixture_file, codec=codec)
+
+            stats = CatalogStats()
+
+            serializers.serialize('json', stats.counted(streamed_rows(rows)), stream=writer)
+
+            writer.close()
+
+        stats.write(path)
 
         to_transmit.append(path)
 
@@ -0,0 +1,159 @@
+# pylint: disable=no-member,line-too-long
+
+'''
+Catalog of what each transmitted backup artifact holds.
+
+Dumps written by this app leave a small JSON sidecar next to each staged
+file (path + '.catalog') with its row count per model and, for integer
+primary keys, the lowest and highest key dumped. incremental_backup reads
+the sidecar when it records the artifact in the BackupArtifact ledger, so
+point-in-time lookups and restore plans are index queries rather than
+storage listings. Files staged by other apps' backup_api modules are still
+catalogued (window, app, destination, size, checksum and codec), just
+without row counts.
+'''
+
+import hashlib
+import io
+import json
+import os
+
+import six
+
+from django.conf import settings
+from django.db.models import Q
+
+CATALOG_SUFFIX = '.catalog'
+
+def record_pk_ranges():
+    return getattr(settings, 'SIMPLE_BACKUP_CATALOG_PK_RANGES', True)
+
+class CatalogStats(object): # pylint: disable=useless-object-inheritance
+    '''
+    Row counts and primary key ranges per model, gathered while rows are
+    serialized.
+    '''
+
+    def __init__(self):
+        self.models = {}
+        self.ranges = record_pk_ranges()
+
+    def tally(self, obj):
+        self.add(obj._meta.label, obj.pk) # pylint: disable=protected-access
+
+    def add(self, label, primary_key):
+        entry = self.models.get(label, None)
+
+        if entry is None:
+            entry = {
+                'rows': 0,
+                'min_pk': None,
+                'max_pk': None,
+            }
+
+            self.models[label] = entry
+
+        entry['rows'] += 1
+
+        if self.ranges and isinstance(primary_key, six.integer_types) and not isinstance(primary_key, bool):
+            if entry['min_pk'] is None or primary_key < entry['min_pk']:
+                entry['min_pk'] = primary_key
+
+            if entry['max_pk'] is None or primary_key > entry['max_pk']:
+                entry['max_pk'] = primary_key
+
+    def counted(self, rows):
+        for row in rows:
+            self.tally(row)
+
+            yield row
+
+    def row_count(self):
+        return sum(entry['rows'] for entry in self.models.values())
+
+    def write(self, path):
+        with io.open(path + CATALOG_SUFFIX, 'w', encoding='utf8') as catalog_file:
+            catalog_file.write(six.text_type(json.dumps(self.models)))
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as checksum_file:
+        while True:
+            chunk = checksum_file.read(1024 * 1024)
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def read_catalog_stats(path):
+    '''
+    Returns (and removes) the per-model statistics written next to a staged
+    file, or None if its dump did not leave any.
+    '''
+
+    catalog_path = path + CATALOG_SUFFIX
+
+    if os.path.exists(catalog_path) is False:
+        return None
+
+    with io.open(catalog_path, 'r', encoding='utf8') as catalog_file:
+        stats = json.load(catalog_file)
+
+    os.remove(catalog_path)
+
+    return stats
+
+def data_artifacts():
+    # Chunks of deduplicated backups are only reachable through their manifests.
+
+    from .deduplication import chunk_folder # pylint: disable=import-outside-toplevel
+    from .models import BackupArtifact # pylint: disable=import-outside-toplevel
+
+    return BackupArtifact.objects.filter(~Q(path__startswith=chunk_folder() + '/'))
+
+def artifacts_containing(model, primary_key=None, as_of=None, destination=None):
+    '''
+    Artifacts holding rows of model ('app_label.Model'), optionally one
+    whose primary key range covers primary_key, from windows ending on or before
+    as_of. The newest come first, so the first is the state as of that date.
+    '''
+
+    # One filter() call, so the model and key bounds must match the same range row.
+
+    range_filter = {
+        'ranges__model': model,
+    }
+
+    if primary_key is not None:
+        range_filter['ranges__min_pk__lte'] = primary_key
+        range_filter['ranges__max_pk__gte'] = primary_key
+
+    artifacts = data_artifacts().filter(**range_filter)
+
+    if as_of is not None:
+        artifacts = artifacts.filter(end_date__lte=as_of)
+
+    if destination is not None:
+        artifacts = artifacts.filter(destination=destination)
+
+    return artifacts.distinct().order_by('-end_date', '-start_date', 'destination', 'path')
+
+def restore_plan(destination, start_date=None, end_date=None):
+    '''
+    Artifacts at a destination from windows overlapping start_date to
+    end_date, oldest windows first.
+    '''
+
+    artifacts = data_artifacts().filter(destination=destination)
+
+    if start_date is not None:
+        artifacts = artifacts.filter(end_date__gte=start_date)
+
+    if end_date is not None:
+        artifacts = artifacts.filter(start_date__lte=end_date)
+
+    return artifacts.order_by('start_date', 'end_date', 'path')
@@ -0,0 +1,376 @@
+# pylint: disable=line-too-long
+
+'''
+Compression codecs for staged backup files.
+
+SIMPLE_BACKUP_COMPRESSION selects the codec (bz2 by default), either by name
+('bz2', 'zstd', 'gzip' or 'lzma') or as a dict with a level and, for zstd
+and bz2, a thread count. zstd needs the optional zstandard package:
+
+    SIMPLE_BACKUP_COMPRESSION = {'codec': 'zstd', 'level': 3, 'threads': -1}
+
+Threads of -1 use every core. Threaded bz2 works like pbzip2: the input is
+cut into blocks (block_size, 900 kB by default) that are compressed as
+independent bz2 streams and written out in order, which any bz2 reader
+treats as one file.
+
+The codec is recorded in the file extension, and every format starts with
+its own magic bytes, so readers detect the codec from the content rather
+than trusting the name. All of the formats allow complete compressed
+streams to be concatenated.
+'''
+
+import bz2
+import collections
+import gzip
+import io
+import multiprocessing
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+
+try:
+    import lzma
+except ImportError: # Python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULT_BZ2_BLOCK_SIZE = 900 * 1000
+
+READ_SIZE = 64 * 1024
+
+def worker_count(threads):
+    if threads is not None and threads < 0:
+        return multiprocessing.cpu_count()
+
+    return max(1, threads or 1)
+
+class ParallelBz2Compressor(object): # pylint: disable=useless-object-inheritance, too-many-instance-attributes
+    '''
+    BZ2Compressor work-alike that compresses fixed-size blocks of input as
+    separate bz2 streams on a thread pool (the bz2 module releases the GIL
+    while compressing) and returns them in input order. At most two blocks
+    per worker are in flight, so memory use stays bounded.
+    '''
+
+    def __init__(self, level, workers, block_size):
+        self.level = level
+        self.workers = workers
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.pending_size = 0
+        self.futures = collections.deque()
+        self.submitted = False
+
+    def submit_block(self, block):
+        self.futures.append(self.executor.submit(bz2.compress, block, self.level))
+
+        self.submitted = True
+
+    def collect(self, wait):
+        output = []
+
+        while self.futures and (wait or self.futures[0].done() or len(self.futures) > self.workers * 2):
+            output.append(self.futures.popleft().result())
+
+        return b''.join(output)
+
+    def compress(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+        if self.pending_size >= self.block_size:
+            pending = b''.join(self.pending)
+
+            offset = 0
+
+            while len(pending) - offset >= self.block_size:
+                self.submit_block(pending[offset:offset + self.block_size])
+
+                offset += self.block_size
+
+            self.pending = [pending[offset:]]
+            self.pending_size = len(pending) - offset
+
+        return self.collect(wait=False)
+
+    def flush(self):
+        # An empty input still becomes one (empty) stream, so the output is a valid bz2 file.
+
+        if self.pending_size > 0 or self.submitted is False:
+            self.submit_block(b''.join(self.pending))
+
+        self.pending = []
+        self.pending_size = 0
+
+        try:
+            return self.collect(wait=True)
+        finally:
+            self.executor.shutdown()
+
+def iter_bz2_streams(source):
+    '''
+    Yields the decompressed content of the concatenated bz2 streams read
+    from source. Python 2's BZ2File only opens file names and stops after
+    the first stream, so readers there are built on this instead.
+    '''
+
+    decompressor = bz2.BZ2Decompressor()
+    started = False # Whether the current decompressor has been given data
+
+    while True:
+        data = source.read(READ_SIZE)
+
+        if not data:
+            break
+
+        while data:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # The previous stream ended exactly where the last read did.
+
+                decompressor = bz2.BZ2Decompressor()
+                started = False
+
+                continue
+
+            started = True
+
+            yield output
+
+            # Whatever follows the end of a stream starts the next one.
+
+            data = decompressor.unused_data
+
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+                started = False
+
+    if started:
+        # A finished decompressor refuses any further input, even none.
+
+        try:
+            decompressor.decompress(b'')
+        except EOFError:
+            return
+
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+class DecompressedReader(io.RawIOBase):
+    '''
+    Readable binary stream over decompressed pieces yielded by a generator
+    such as iter_bz2_streams.
+    '''
+
+    def __init__(self, pieces):
+        super(DecompressedReader, self).__init__() # pylint: disable=super-with-arguments
+
+        self.pieces = pieces
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.pieces)
+            except StopIteration:
+                return 0
+
+        length = min(len(buffer), len(self.buffer))
+
+        buffer[:length] = self.buffer[:length]
+
+        self.buffer = self.buffer[length:]
+
+        return length
+
+class Codec(object): # pylint: disable=useless-object-inheritance
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+
+    def __init__(self, level=None, threads=None, block_size=None):
+        self.level = level if level is not None else self.default_level
+        self.threads = threads
+        self.block_size = block_size
+
+    def available(self): # pylint: disable=no-self-use
+        return True
+
+    def compressor(self):
+        '''
+        Returns an object with compress(data) and flush() methods, like
+        bz2.BZ2Compressor.
+        '''
+
+        raise NotImplementedError('Codec subclasses must implement compressor.')
+
+    def open_reader(self, source):
+        '''
+        Returns a readable file-like object with the decompressed content of
+        the readable binary stream source, across concatenated streams.
+        '''
+
+        raise NotImplementedError('Codec subclasses must implement open_reader.')
+
+    def compress(self, data):
+        compressor = self.compressor()
+
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        with self.open_reader(io.BytesIO(data)) as reader:
+            return reader.read()
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+    extension = '.bz2'
+    magic = b'BZh'
+    default_level = 9
+
+    def compressor(self):
+        if worker_count(self.threads) > 1:
+            return ParallelBz2Compressor(self.level, worker_count(self.threads), self.block_size or DEFAULT_BZ2_BLOCK_SIZE)
+
+        return bz2.BZ2Compressor(self.level)
+
+    def open_reader(self, source):
+        if six.PY2:
+            return io.BufferedReader(DecompressedReader(iter_bz2_streams(source)), buffer_size=READ_SIZE)
+
+        return bz2.BZ2File(source, 'rb')
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+    magic = b'\x1f\x8b'
+    default_level = 6
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def open_reader(self, source):
+        return gzip.GzipFile(fileobj=source, mode='rb')
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    extension = '.xz'
+    magic = b'\xfd7zXZ\x00'
+    default_level = 6
+
+    def available(self):
+        return lzma is not None
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self.level)
+
+    def open_reader(self, source):
+        return lzma.LZMAFile(source, 'rb')
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+    default_level = 3
+
+    def available(self):
+        return zstandard is not None
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level, threads=self.threads if self.threads is not None else -1).compressobj()
+
+    def open_reader(self, source):
+        return zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+
+CODEC_CLASSES = {
+    'bz2': Bz2Codec,
+    'gzip': GzipCodec,
+    'lzma': LzmaCodec,
+    'zstd': ZstdCodec,
+}
+
+DEFAULT_CODEC = 'bz2'
+
+def codec_named(name, level=None, threads=None, block_size=None):
+    codec_class = CODEC_CLASSES.get(name, None)
+
+    if codec_class is None:
+        raise ImproperlyConfigured('Unknown compression codec: %s (choose from %s).' % (name, ', '.join(sorted(CODEC_CLASSES.keys()))))
+
+    codec = codec_class(level=level, threads=threads, block_size=block_size)
+
+    if codec.available() is False:
+        raise ImproperlyConfigured('The %s compression codec is not available - install its Python package or choose another codec.' % name)
+
+    return codec
+
+def configured_codec():
+    compression = getattr(settings, 'SIMPLE_BACKUP_COMPRESSION', None)
+
+    if compression is None:
+        return codec_named(DEFAULT_CODEC)
+
+    if isinstance(compression, dict):
+        return codec_named(compression.get('codec', DEFAULT_CODEC), level=compression.get('level', None), threads=compression.get('threads', None), block_size=compression.get('block_size', None))
+
+    return codec_named(compression)
+
+def codec_for_header(header):
+    for codec_class in CODEC_CLASSES.values():
+        if header[:len(codec_class.magic)] == codec_class.magic:
+            return codec_class()
+
+    return None
+
+def codec_for_extension(path):
+    for codec_class in CODEC_CLASSES.values():
+        if path.endswith(codec_class.extension):
+            return codec_class()
+
+    return None
+
+def detect_codec(path):
+    with io.open(path, 'rb') as compressed_file:
+        return codec_for_header(compressed_file.read(8))
+
+def decompress_file(path, output_path=None, chunk_size=1024 * 1024):
+    '''
+    Decompresses path (detecting the codec from its header) to output_path,
+    by default the same path without the codec's extension. Returns the
+    output path, or None when path is not compressed with a known codec.
+    '''
+
+    codec = detect_codec(path)
+
+    if codec is None or codec.available() is False:
+        return None
+
+    if output_path is None:
+        output_path = path[:-len(codec.extension)] if path.endswith(codec.extension) else path + '.decompressed'
+
+    with io.open(path, 'rb') as compressed_file:
+        with codec.open_reader(compressed_file) as reader:
+            with io.open(output_path, 'wb') as output_file:
+                while True:
+                    chunk = reader.read(chunk_size)
+
+                    if not chunk:
+                        break
+
+                    output_file.write(chunk)
+
+    return output_path
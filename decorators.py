@@ -46,6 +46,16 @@ def handle_lock(handle):
         logging.debug("-" * 72)
 
         lock_name = self.__module__.split('.').pop()
+
+        # Commands may narrow the lock (e.g. to a date window) so that
+        # independent invocations can run side by side.
+
+        if hasattr(self, 'lock_suffix'):
+            lock_suffix = self.lock_suffix(options)
+
+            if lock_suffix:
+                lock_name = '%s__%s' % (lock_name, slugify(lock_suffix))
+
         lock = FileLock('%s/%s__%s' % (tempfile.gettempdir(), lock_prefix, lock_name))
 
         logging.debug("%s - acquiring lock...", lock_name)
@@ -61,6 +71,9 @@ def handle_lock(handle):
 
         logging.debug("acquired.")
 
+        # Failures are logged and re-raised once the lock is released, so
+        # callers (and exit codes) see them instead of a silent success.
+
         try:
             handle(self, *args, **options)
         except: # pylint: disable=bare-except
@@ -69,9 +82,11 @@ def handle_lock(handle):
             logging.error(traceback.format_exc())
             logging.error('==' * 72)
 
-        logging.debug("releasing lock...")
-        lock.release()
-        logging.debug("released.")
+            raise
+        finally:
+            logging.debug("releasing lock...")
+            lock.release()
+            logging.debug("released.")
 
         logging.debug("done in %.2f seconds", (time.time() - start_time))
         return
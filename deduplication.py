@@ -0,0 +1,354 @@
+# pylint: disable=line-too-long
+
+'''
+Content-addressed chunk store for staged backup files.
+
+Staged files are cut into variable-sized chunks with a gear rolling hash
+(content-defined chunking), so an insertion or deletion only changes the
+chunks around it. Each chunk is compressed on its own and named by a keyed
+hash (HMAC-SHA256 with the backup key) of its content, so chunk names do not
+reveal what they hold. Each staged file is replaced by a small manifest
+listing its chunks in order.
+
+Compressed files are chunked on their decompressed content: a compressor's
+output changes from the first changed byte onwards, so chunking it directly
+would find almost nothing to share between runs. Their chunks are
+compressed with the file's own codec, and because every chunk is a complete
+stream, concatenating them gives back a valid compressed file.
+'''
+
+import binascii
+import collections
+import hashlib
+import hmac
+import io
+import json
+import os
+import struct
+
+import six
+
+from django.conf import settings
+
+from .compression import codec_for_extension, codec_named, configured_codec
+from .encryption import decrypt_stream
+
+MANIFEST_VERSION = 2
+MANIFEST_SUFFIX = '.manifest'
+
+DEFAULT_CHUNK_FOLDER = 'chunks'
+DEFAULT_AVERAGE_CHUNK_SIZE = 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+# Chunks may end where the low bits of a hash of the last WINDOW_SIZE bytes
+# are zero. The hash sums a pseudo-random weight per pair of neighbouring
+# bytes, so it depends on their order. It is computed for a whole block at a
+# time with big integer arithmetic (one 32-bit lane per byte), keeping the
+# scan in C rather than in one Python iteration per byte.
+
+WINDOW_SIZE = 32
+SCAN_SIZE = 256 * 1024
+
+def weight_tables(salt):
+    # 26-bit weights, so a window's sum stays below 2 ** 31 and within its lane.
+
+    weights = [struct.unpack('>I', hashlib.sha256(struct.pack('>BB', salt, index)).digest()[:4])[0] >> 6 for index in range(256)]
+
+    # One translation table per byte of the (little-endian) weights.
+
+    return tuple(bytes(bytearray((weight >> (8 * part)) & 0xff for weight in weights)) for part in range(4))
+
+PREVIOUS_WEIGHTS = weight_tables(0)
+CURRENT_WEIGHTS = weight_tables(1)
+
+def deduplication_enabled():
+    return getattr(settings, 'SIMPLE_BACKUP_DEDUPLICATE', False)
+
+def chunk_folder():
+    return getattr(settings, 'SIMPLE_BACKUP_CHUNK_FOLDER', DEFAULT_CHUNK_FOLDER)
+
+def average_chunk_size():
+    return getattr(settings, 'SIMPLE_BACKUP_DEDUPLICATE_CHUNK_SIZE', DEFAULT_AVERAGE_CHUNK_SIZE)
+
+def boundary_bits(average_size):
+    # A window hash ends a chunk one time in 2 ** bits (at least 8 bits, see window_ends).
+
+    return min(30, max(8, average_size.bit_length() - 1))
+
+def int_from_bytes(data):
+    if six.PY2:
+        return int(binascii.hexlify(bytes(data[::-1])) or b'0', 16)
+
+    return int.from_bytes(data, 'little')
+
+def int_to_bytes(value, length):
+    if six.PY2:
+        return binascii.unhexlify('%0*x' % (2 * length, value))[::-1]
+
+    return value.to_bytes(length, 'little')
+
+def weight_lanes(data, tables):
+    lanes = bytearray(4 * len(data))
+
+    for part, table in enumerate(tables):
+        lanes[part::4] = data.translate(table)
+
+    return int_from_bytes(lanes)
+
+def window_ends(data, bits):
+    '''
+    Returns the offsets of the bytes of data after which a chunk may end.
+    The first WINDOW_SIZE bytes of data only provide the window for the
+    bytes after them.
+    '''
+
+    count = len(data)
+
+    # Lane i holds the weight of bytes i - 1 and i; doubling adds each lane
+    # to the lanes after it until each holds the sum over its window.
+
+    value = (weight_lanes(data, PREVIOUS_WEIGHTS) << 32) ^ weight_lanes(data, CURRENT_WEIGHTS)
+
+    width = 32
+
+    while width < 32 * WINDOW_SIZE:
+        value += value << width
+
+        width *= 2
+
+    sums = int_to_bytes(value, 4 * (count + WINDOW_SIZE + 1))
+
+    lanes = [bytearray(sums[part:4 * count:4]) for part in range(4)]
+
+    mask = (1 << bits) - 1
+
+    ends = []
+
+    # With at least 8 bits, only windows whose sum has a zero low byte qualify.
+
+    position = lanes[0].find(b'\0', WINDOW_SIZE)
+
+    while position != -1:
+        if (lanes[1][position] << 8 | lanes[2][position] << 16 | lanes[3][position] << 24) & mask == 0:
+            ends.append(position)
+
+        position = lanes[0].find(b'\0', position + 1)
+
+    return ends
+
+def iter_chunks(source, average_size=None):
+    '''
+    Yields content-defined chunks of the readable binary stream source, each
+    between a quarter of and four times average_size bytes long.
+    '''
+
+    if average_size is None:
+        average_size = average_chunk_size()
+
+    minimum_size = average_size // 4
+    maximum_size = average_size * 4
+
+    bits = boundary_bits(average_size)
+
+    pending = bytearray()
+    start = 0 # Stream offset of pending[0]
+
+    context = b''
+    ends = collections.deque()
+
+    finished = False
+
+    while finished is False:
+        block = source.read(READ_SIZE)
+
+        finished = not block
+
+        # Stream offset of block[0].
+
+        origin = start + len(pending)
+
+        for offset in range(0, len(block), SCAN_SIZE):
+            scanned = context + block[offset:offset + SCAN_SIZE]
+
+            ends.extend(origin + offset - len(context) + position + 1 for position in window_ends(scanned, bits))
+
+            context = scanned[-WINDOW_SIZE:]
+
+        pending.extend(block)
+
+        while pending:
+            while ends and ends[0] - start <= minimum_size:
+                ends.popleft()
+
+            if ends and ends[0] - start <= maximum_size:
+                boundary = ends.popleft() - start
+            elif len(pending) >= maximum_size:
+                boundary = maximum_size
+            elif finished:
+                boundary = len(pending)
+            else:
+                break
+
+            yield bytes(pending[:boundary])
+
+            del pending[:boundary]
+
+            start += boundary
+
+def chunk_name(key, chunk):
+    return hmac.new(key, chunk, hashlib.sha256).hexdigest()
+
+def chunk_path(name, codec):
+    return '%s/%s/%s%s' % (chunk_folder(), name[:2], name, codec.extension)
+
+def deduplicate_file(key, path, chunk_staging): # pylint: disable=too-many-locals
+    '''
+    Splits path into compressed chunk files below chunk_staging (skipping
+    chunks already written there) and replaces it with a manifest. Returns
+    the manifest path and a list of (local chunk path, remote chunk path).
+    '''
+
+    file_codec = codec_for_extension(path)
+
+    chunk_codec = configured_codec()
+
+    if file_codec is not None and file_codec.name != chunk_codec.name:
+        chunk_codec = codec_named(file_codec.name)
+
+    chunks = []
+    chunk_files = []
+
+    size = 0
+
+    with io.open(path, 'rb') as staged_file:
+        source = staged_file
+
+        if file_codec is not None:
+            source = file_codec.open_reader(staged_file)
+
+        for chunk in iter_chunks(source):
+            name = chunk_name(key, chunk)
+
+            remote_path = chunk_path(name, chunk_codec)
+
+            local_path = os.path.join(chunk_staging, name + chunk_codec.extension)
+
+            if os.path.exists(local_path) is False:
+                with io.open(local_path, 'wb') as chunk_file:
+                    chunk_file.write(chunk_codec.compress(chunk))
+
+                chunk_files.append((local_path, remote_path))
+
+            chunks.append(name)
+
+            size += len(chunk)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'file': os.path.basename(path),
+        'codec': file_codec.name if file_codec is not None else None,
+        'chunk_codec': chunk_codec.name,
+        'chunk_folder': chunk_folder(),
+        'size': size,
+        'chunks': chunks,
+    }
+
+    manifest_path = path + MANIFEST_SUFFIX
+
+    with io.open(manifest_path, 'w', encoding='utf8') as manifest_file:
+        manifest_file.write(six.text_type(json.dumps(manifest, indent=2)))
+
+    os.remove(path)
+
+    return manifest_path, chunk_files
+
+def find_chunk_root(manifest_path, folder):
+    # Chunks sit at the destination root, alongside the dated backup folders.
+
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+
+    while True:
+        if os.path.isdir(os.path.join(directory, folder)):
+            return directory
+
+        parent = os.path.dirname(directory)
+
+        if parent == directory:
+            return None
+
+        directory = parent
+
+def read_manifest(manifest_path):
+    with io.open(manifest_path, 'r', encoding='utf8') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get('version', None) != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version in %s: %s' % (manifest_path, manifest.get('version', None)))
+
+    return manifest
+
+def manifest_chunk_paths(manifest):
+    '''
+    Returns the stored (encrypted) path of each distinct chunk a manifest
+    lists, relative to the chunk root.
+    '''
+
+    extension = codec_named(manifest['chunk_codec']).extension
+
+    paths = []
+
+    for name in manifest['chunks']:
+        path = '%s/%s/%s%s.encrypted' % (manifest['chunk_folder'], name[:2], name, extension)
+
+        if path not in paths:
+            paths.append(path)
+
+    return paths
+
+def reassemble_file(key, manifest_path, chunk_root=None):
+    '''
+    Rebuilds the file described by a (decrypted) manifest next to it from
+    the encrypted chunks below chunk_root and returns its path.
+    '''
+
+    manifest = read_manifest(manifest_path)
+
+    chunk_codec = codec_named(manifest['chunk_codec'])
+
+    if chunk_root is None:
+        chunk_root = find_chunk_root(manifest_path, manifest['chunk_folder'])
+
+        if chunk_root is None:
+            raise ValueError('Unable to locate the "%s" chunk folder for %s.' % (manifest['chunk_folder'], manifest_path))
+
+    output_path = os.path.join(os.path.dirname(manifest_path), manifest['file'])
+
+    try:
+        with io.open(output_path, 'wb') as output_file:
+            for name in manifest['chunks']:
+                encrypted_chunk = os.path.join(chunk_root, manifest['chunk_folder'], name[:2], name + chunk_codec.extension + '.encrypted')
+
+                compressed_chunk = io.BytesIO()
+
+                with io.open(encrypted_chunk, 'rb') as chunk_file:
+                    decrypt_stream(key, chunk_file, compressed_chunk)
+
+                chunk = chunk_codec.decompress(compressed_chunk.getvalue())
+
+                # Chunk files are only authenticated individually - make sure each one is the chunk the manifest names.
+                # (Names read from JSON are unicode on Python 2, where compare_digest needs matching types.)
+
+                if hmac.compare_digest(chunk_name(key, chunk), str(name)) is False:
+                    raise ValueError('Chunk %s does not match its name.' % encrypted_chunk)
+
+                if manifest['codec'] is not None:
+                    output_file.write(compressed_chunk.getvalue())
+                else:
+                    output_file.write(chunk)
+    except Exception:
+        os.remove(output_path)
+
+        raise
+
+    return output_path
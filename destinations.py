@@ -0,0 +1,754 @@
+# pylint: disable=no-member,line-too-long
+
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import dropbox
+import pytz
+import six
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from django.conf import settings
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+DROPBOX_DEFAULT_SESSION_THRESHOLD = 64 * 1024 * 1024
+DROPBOX_DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DROPBOX_DEFAULT_CHUNK_RETRIES = 3
+DROPBOX_FINISH_BATCH_SIZE = 1000
+DROPBOX_DELETE_BATCH_SIZE = 1000
+
+S3_DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+S3_DEFAULT_PART_SIZE = 16 * 1024 * 1024
+S3_DEFAULT_PART_WORKERS = 4
+S3_DEFAULT_PART_RETRIES = 3
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_DELETE_BATCH_SIZE = 1000
+
+DEFAULT_MAX_CONNECTIONS = 16
+
+READ_SIZE = 1024 * 1024
+
+SHARED_CLIENTS = {}
+SHARED_CLIENTS_LOCK = threading.Lock()
+
+def file_md5(path):
+    digest = hashlib.md5() # nosec
+
+    with open(path, 'rb') as md5_file:
+        while True:
+            chunk = md5_file.read(1024 * 1024)
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def max_connections():
+    return getattr(settings, 'SIMPLE_BACKUP_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS)
+
+def shared_client(key, factory):
+    '''
+    Returns the client stored under key, creating it with factory on first
+    use. Clients - and their pooled HTTP connections - are shared by every
+    destination instance and thread for the rest of the run.
+    '''
+
+    with SHARED_CLIENTS_LOCK:
+        client = SHARED_CLIENTS.get(key, None)
+
+        if client is None:
+            client = factory()
+
+            SHARED_CLIENTS[key] = client
+
+        return client
+
+def file_item(name, size, updated):
+    return {
+        'name': name,
+        'size': size,
+        'updated': updated,
+    }
+
+class Destination(object): # pylint: disable=useless-object-inheritance
+    def __init__(self, destination):
+        self.destination = destination
+        self.url = urlparse(destination)
+
+    def label(self):
+        return destination_label(self.destination)
+
+    def transmit(self, encrypted_path, remote_path):
+        raise NotImplementedError('Destination subclasses must implement transmit.')
+
+    def commit(self):
+        pass
+
+    def list_files(self):
+        '''
+        Yields a dict (name, size and updated, as a UTC datetime) for every
+        stored file. Names are relative to the destination, as passed to
+        transmit. Destinations whose listing reveals a content fingerprint
+        ("md5:<hex>") add it as fingerprint.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement list_files.')
+
+    def list_paths(self):
+        for item in self.list_files():
+            yield item['name']
+
+    def stat(self, remote_path):
+        '''
+        Returns the list_files dict for one file, or None if it does not exist.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement stat.')
+
+    def open_read(self, remote_path):
+        '''
+        Returns a readable binary stream of a stored file's content, which the
+        caller closes.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement open_read.')
+
+    def write_stream(self, stream, remote_path, fingerprint=None):
+        '''
+        Stores the content of a readable binary stream of unknown length,
+        holding at most one upload chunk in memory, replacing any file at
+        remote_path. Destinations that can keep metadata store the source's
+        fingerprint with it, for fingerprints to report.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement write_stream.')
+
+    def fingerprints(self, item): # pylint: disable=no-self-use
+        '''
+        Returns the set of content fingerprints known for a list_files dict.
+        May read the file or request its metadata, so it is only asked about
+        files their size does not already tell apart.
+        '''
+
+        if item.get('fingerprint', None) is not None:
+            return set([item['fingerprint']])
+
+        return set()
+
+    def needs_update(self, item, size, updated, fingerprint=None):
+        '''
+        Whether the stored file item (a list_files dict, or None) differs from
+        a source file. As for Google Drive, content fingerprints decide when
+        both sides have one of the same kind; otherwise a file modified since
+        the stored copy was written is.
+        '''
+
+        if item is None or item['size'] != size:
+            return True
+
+        if fingerprint is not None:
+            fingerprints = self.fingerprints(item)
+
+            if fingerprint in fingerprints:
+                return False
+
+            # A fingerprint of the same kind that differs means the content changed.
+
+            if fingerprint.split(':', 1)[0] in set(known.split(':', 1)[0] for known in fingerprints):
+                return True
+
+        return updated is not None and item['updated'] < updated
+
+    def fetch(self, remote_path, local_path):
+        stream = self.open_read(remote_path)
+
+        try:
+            with io.open(local_path, 'wb') as local_file:
+                shutil.copyfileobj(stream, local_file, READ_SIZE)
+        finally:
+            stream.close()
+
+    def copy(self, source_path, remote_path):
+        '''
+        Copies a stored artifact to another path, on the storage side where
+        the destination supports it.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement copy.')
+
+    def delete(self, remote_paths):
+        '''
+        Deletes the listed artifacts, in as few requests as the destination
+        allows. Paths that no longer exist are ignored.
+        '''
+
+        raise NotImplementedError('Destination subclasses must implement delete.')
+
+class FileDestination(Destination):
+    def transmit(self, encrypted_path, remote_path):
+        dest_path = os.path.join(self.url.path, remote_path)
+
+        dest_folder = os.path.dirname(dest_path)
+
+        if os.path.exists(dest_folder) is False:
+            six.print_('Creating folder for archive storage: ' + dest_folder)
+            sys.stdout.flush()
+
+            try:
+                os.makedirs(dest_folder)
+            except OSError:
+                if os.path.isdir(dest_folder) is False:
+                    raise
+
+        six.print_('Writing to filesystem: ' + dest_path)
+        sys.stdout.flush()
+
+        shutil.copyfile(encrypted_path, dest_path)
+
+    def list_files(self):
+        for folder, folder_names, file_names in os.walk(self.url.path): # pylint: disable=unused-variable
+            for file_name in file_names:
+                item = self.stat(os.path.relpath(os.path.join(folder, file_name), self.url.path).replace(os.sep, '/'))
+
+                if item is not None:
+                    yield item
+
+    def stat(self, remote_path):
+        try:
+            file_stat = os.stat(os.path.join(self.url.path, remote_path))
+        except OSError:
+            return None
+
+        return file_item(remote_path, file_stat.st_size, datetime.datetime.fromtimestamp(file_stat.st_mtime, pytz.utc))
+
+    def open_read(self, remote_path):
+        return io.open(os.path.join(self.url.path, remote_path), 'rb')
+
+    def write_stream(self, stream, remote_path, fingerprint=None):
+        dest_path = os.path.join(self.url.path, remote_path)
+
+        try:
+            os.makedirs(os.path.dirname(dest_path))
+        except OSError:
+            if os.path.isdir(os.path.dirname(dest_path)) is False:
+                raise
+
+        with io.open(dest_path, 'wb') as dest_file:
+            shutil.copyfileobj(stream, dest_file, READ_SIZE)
+
+    def fingerprints(self, item):
+        return set(['md5:' + file_md5(os.path.join(self.url.path, item['name']))])
+
+    def fetch(self, remote_path, local_path):
+        shutil.copyfile(os.path.join(self.url.path, remote_path), local_path)
+
+    def copy(self, source_path, remote_path):
+        dest_path = os.path.join(self.url.path, remote_path)
+
+        if os.path.isdir(os.path.dirname(dest_path)) is False:
+            os.makedirs(os.path.dirname(dest_path))
+
+        shutil.copyfile(os.path.join(self.url.path, source_path), dest_path)
+
+    def delete(self, remote_paths):
+        root = os.path.abspath(self.url.path)
+
+        for remote_path in remote_paths:
+            path = os.path.join(root, remote_path)
+
+            if os.path.exists(path):
+                os.remove(path)
+
+            # Drop folders left empty, up to the destination root.
+
+            folder = os.path.dirname(path)
+
+            while folder != root and folder.startswith(root) and os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+
+                folder = os.path.dirname(folder)
+
+class DropboxDestination(Destination):
+    def __init__(self, destination):
+        super(DropboxDestination, self).__init__(destination) # pylint: disable=super-with-arguments
+
+        token = self.url.netloc
+
+        self.client = shared_client(('dropbox', token), lambda: dropbox.Dropbox(token, session=dropbox.create_session(max_connections=max_connections())))
+
+        self.pending_sessions = []
+
+    def transmit(self, encrypted_path, remote_path):
+        dropbox_path = os.path.join(self.url.path, remote_path)
+
+        size = os.path.getsize(encrypted_path)
+
+        threshold = getattr(settings, 'SIMPLE_BACKUP_DROPBOX_SESSION_THRESHOLD', DROPBOX_DEFAULT_SESSION_THRESHOLD)
+
+        if size >= threshold:
+            self.transmit_session(encrypted_path, dropbox_path, size)
+
+            return
+
+        six.print_('Uploading to Dropbox: ' + dropbox_path)
+        sys.stdout.flush()
+
+        with open(encrypted_path, 'rb') as encrypted_file:
+            self.client.files_upload(encrypted_file.read(), dropbox_path)
+
+    def transmit_session(self, encrypted_path, dropbox_path, size):
+        chunk_size = getattr(settings, 'SIMPLE_BACKUP_DROPBOX_CHUNK_SIZE', DROPBOX_DEFAULT_CHUNK_SIZE)
+        retries = getattr(settings, 'SIMPLE_BACKUP_DROPBOX_CHUNK_RETRIES', DROPBOX_DEFAULT_CHUNK_RETRIES)
+
+        six.print_('Uploading to Dropbox in %d MB chunks: %s' % (chunk_size // (1024 * 1024), dropbox_path))
+        sys.stdout.flush()
+
+        session_id = self.client.files_upload_session_start(b'').session_id
+
+        offset = 0
+        attempt = 0
+
+        with open(encrypted_path, 'rb') as encrypted_file:
+            while True:
+                encrypted_file.seek(offset)
+
+                chunk = encrypted_file.read(chunk_size)
+
+                close = (offset + len(chunk)) >= size
+
+                cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+
+                try:
+                    self.client.files_upload_session_append_v2(chunk, cursor, close=close)
+
+                    offset += len(chunk)
+                    attempt = 0
+
+                    if close:
+                        break
+                except dropbox.exceptions.ApiError as api_error:
+                    lookup_error = api_error.error
+
+                    if hasattr(lookup_error, 'is_incorrect_offset') and lookup_error.is_incorrect_offset():
+                        # An earlier attempt reached the server - resume from the offset it committed.
+
+                        offset = lookup_error.get_incorrect_offset().correct_offset
+                    elif close and hasattr(lookup_error, 'is_closed') and lookup_error.is_closed():
+                        # The closing append went through but its response was lost.
+
+                        break
+                    else:
+                        raise
+                except Exception: # pylint: disable=broad-except
+                    attempt += 1
+
+                    if attempt > retries:
+                        raise
+
+                    time.sleep(2 ** attempt)
+
+        cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=size)
+
+        self.pending_sessions.append(dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=dropbox.files.CommitInfo(path=dropbox_path)))
+
+    def commit(self):
+        # Closed sessions are committed together, DROPBOX_FINISH_BATCH_SIZE at a time.
+
+        failures = []
+
+        while self.pending_sessions:
+            entries = self.pending_sessions[:DROPBOX_FINISH_BATCH_SIZE]
+
+            self.pending_sessions = self.pending_sessions[DROPBOX_FINISH_BATCH_SIZE:]
+
+            launch = self.client.files_upload_session_finish_batch(entries)
+
+            if launch.is_async_job_id():
+                job_id = launch.get_async_job_id()
+
+                while True:
+                    job_status = self.client.files_upload_session_finish_batch_check(job_id)
+
+                    if job_status.is_complete():
+                        result = job_status.get_complete()
+
+                        break
+
+                    time.sleep(1)
+            elif launch.is_complete():
+                result = launch.get_complete()
+            else:
+                raise dropbox.exceptions.DropboxException('Unexpected response committing Dropbox upload sessions: %s' % launch)
+
+            for entry, result_entry in zip(entries, result.entries):
+                if result_entry.is_failure():
+                    failures.append('%s (%s)' % (entry.commit.path, result_entry.get_failure()))
+
+        if failures:
+            raise dropbox.exceptions.DropboxException('Unable to commit Dropbox uploads: ' + ', '.join(failures))
+
+    def dropbox_item(self, remote_path, entry): # pylint: disable=no-self-use
+        return file_item(remote_path, entry.size, pytz.utc.localize(entry.server_modified) if entry.server_modified.tzinfo is None else entry.server_modified)
+
+    def list_files(self):
+        root = self.url.path.rstrip('/')
+
+        result = self.client.files_list_folder(root, recursive=True)
+
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    yield self.dropbox_item(entry.path_display[len(root):].lstrip('/'), entry)
+
+            if result.has_more is False:
+                break
+
+            result = self.client.files_list_folder_continue(result.cursor)
+
+    def stat(self, remote_path):
+        try:
+            entry = self.client.files_get_metadata(os.path.join(self.url.path, remote_path))
+        except dropbox.exceptions.ApiError as api_error:
+            if api_error.error.is_path() and api_error.error.get_path().is_not_found():
+                return None
+
+            raise
+
+        if isinstance(entry, dropbox.files.FileMetadata) is False:
+            return None
+
+        return self.dropbox_item(remote_path, entry)
+
+    def open_read(self, remote_path):
+        metadata, response = self.client.files_download(os.path.join(self.url.path, remote_path)) # pylint: disable=unused-variable
+
+        response.raw.decode_content = True
+
+        return response.raw
+
+    def write_stream(self, stream, remote_path, fingerprint=None):
+        # Dropbox has no room for the source's fingerprint - syncs compare modification times instead.
+
+        dropbox_path = os.path.join(self.url.path, remote_path)
+
+        chunk_size = getattr(settings, 'SIMPLE_BACKUP_DROPBOX_CHUNK_SIZE', DROPBOX_DEFAULT_CHUNK_SIZE)
+
+        chunk = stream.read(chunk_size)
+
+        next_chunk = stream.read(chunk_size) if len(chunk) == chunk_size else b''
+
+        if not next_chunk:
+            self.client.files_upload(chunk, dropbox_path, mode=dropbox.files.WriteMode.overwrite)
+
+            return
+
+        session_id = self.client.files_upload_session_start(chunk).session_id
+
+        offset = len(chunk)
+
+        while True:
+            chunk = next_chunk
+
+            next_chunk = stream.read(chunk_size) if len(chunk) == chunk_size else b''
+
+            cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+
+            if not next_chunk:
+                self.client.files_upload_session_finish(chunk, cursor, dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode.overwrite))
+
+                return
+
+            self.client.files_upload_session_append_v2(chunk, cursor)
+
+            offset += len(chunk)
+
+    def fetch(self, remote_path, local_path):
+        self.client.files_download_to_file(local_path, os.path.join(self.url.path, remote_path))
+
+    def copy(self, source_path, remote_path):
+        self.client.files_copy_v2(os.path.join(self.url.path, source_path), os.path.join(self.url.path, remote_path))
+
+    def delete(self, remote_paths):
+        # Deletes run as batch jobs, DROPBOX_DELETE_BATCH_SIZE paths at a time.
+
+        remote_paths = list(remote_paths)
+
+        failures = []
+
+        for start in range(0, len(remote_paths), DROPBOX_DELETE_BATCH_SIZE):
+            entries = [dropbox.files.DeleteArg(os.path.join(self.url.path, remote_path)) for remote_path in remote_paths[start:start + DROPBOX_DELETE_BATCH_SIZE]]
+
+            launch = self.client.files_delete_batch(entries)
+
+            if launch.is_async_job_id():
+                job_id = launch.get_async_job_id()
+
+                while True:
+                    job_status = self.client.files_delete_batch_check(job_id)
+
+                    if job_status.is_complete():
+                        result = job_status.get_complete()
+
+                        break
+
+                    if job_status.is_failed():
+                        raise dropbox.exceptions.DropboxException('Unable to delete from Dropbox: %s' % job_status.get_failed())
+
+                    time.sleep(1)
+            elif launch.is_complete():
+                result = launch.get_complete()
+            else:
+                raise dropbox.exceptions.DropboxException('Unexpected response deleting from Dropbox: %s' % launch)
+
+            for entry, result_entry in zip(entries, result.entries):
+                if result_entry.is_failure():
+                    failure = result_entry.get_failure()
+
+                    if failure.is_path_lookup() and failure.get_path_lookup().is_not_found():
+                        continue
+
+                    failures.append('%s (%s)' % (entry.path, failure))
+
+        if failures:
+            raise dropbox.exceptions.DropboxException('Unable to delete from Dropbox: ' + ', '.join(failures))
+
+class S3Destination(Destination):
+    def __init__(self, destination):
+        super(S3Destination, self).__init__(destination) # pylint: disable=super-with-arguments
+
+        self.client = shared_client(('s3', settings.SIMPLE_BACKUP_AWS_REGION, settings.SIMPLE_BACKUP_AWS_ACCESS_KEY_ID), self.create_client)
+
+        self.bucket = self.url.netloc
+
+    def create_client(self): # pylint: disable=no-self-use
+        aws_config = Config(
+            region_name=settings.SIMPLE_BACKUP_AWS_REGION,
+            retries={'max_attempts': 10, 'mode': 'standard'},
+            max_pool_connections=max_connections()
+        )
+
+        # A private session: building clients from the default session is not thread-safe.
+
+        session = boto3.session.Session(aws_access_key_id=settings.SIMPLE_BACKUP_AWS_ACCESS_KEY_ID, aws_secret_access_key=settings.SIMPLE_BACKUP_AWS_SECRET_ACCESS_KEY)
+
+        return session.client('s3', config=aws_config)
+
+    def transmit(self, encrypted_path, remote_path):
+        size = os.path.getsize(encrypted_path)
+
+        threshold = getattr(settings, 'SIMPLE_BACKUP_S3_MULTIPART_THRESHOLD', S3_DEFAULT_MULTIPART_THRESHOLD)
+
+        if size >= threshold:
+            self.transmit_multipart(encrypted_path, remote_path, size)
+
+            return
+
+        six.print_('Uploading to S3: ' + remote_path)
+        sys.stdout.flush()
+
+        # The content MD5 is kept as metadata so syncs can fingerprint objects
+        # whose ETag is not an MD5 (multipart uploads, KMS encryption).
+
+        with open(encrypted_path, 'rb') as encrypted_file:
+            self.client.put_object(Body=encrypted_file, Bucket=self.bucket, Key=remote_path, Metadata={'md5': file_md5(encrypted_path)})
+
+    def transmit_multipart(self, encrypted_path, remote_path, size):
+        part_size = getattr(settings, 'SIMPLE_BACKUP_S3_PART_SIZE', S3_DEFAULT_PART_SIZE)
+
+        # S3 requires parts of at least 5 MB and allows at most 10,000 of them.
+
+        part_size = max(part_size, S3_MIN_PART_SIZE, -(-size // S3_MAX_PARTS))
+
+        part_workers = getattr(settings, 'SIMPLE_BACKUP_S3_PART_WORKERS', S3_DEFAULT_PART_WORKERS)
+
+        part_count = max(1, -(-size // part_size))
+
+        six.print_('Uploading to S3 in %d parts: %s' % (part_count, remote_path))
+        sys.stdout.flush()
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=remote_path, Metadata={'md5': file_md5(encrypted_path)})['UploadId']
+
+        try:
+            # Parts are read from disk as workers pick them up, so at most
+            # part_workers parts are held in memory at any time.
+
+            with ThreadPoolExecutor(max_workers=max(1, part_workers)) as executor:
+                futures = []
+
+                for index in range(part_count):
+                    offset = index * part_size
+
+                    futures.append(executor.submit(self.transmit_part, encrypted_path, remote_path, upload_id, (index + 1, offset, min(part_size, size - offset))))
+
+                try:
+                    parts = [future.result() for future in futures]
+                except Exception: # pylint: disable=broad-except
+                    for future in futures:
+                        future.cancel()
+
+                    raise
+
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=remote_path, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception: # pylint: disable=broad-except
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=remote_path, UploadId=upload_id)
+
+            raise
+
+    def transmit_part(self, encrypted_path, remote_path, upload_id, part):
+        part_number, offset, length = part
+
+        retries = getattr(settings, 'SIMPLE_BACKUP_S3_PART_RETRIES', S3_DEFAULT_PART_RETRIES)
+
+        attempt = 0
+
+        while True:
+            try:
+                with open(encrypted_path, 'rb') as encrypted_file:
+                    encrypted_file.seek(offset)
+
+                    body = encrypted_file.read(length)
+
+                response = self.client.upload_part(Body=body, Bucket=self.bucket, Key=remote_path, UploadId=upload_id, PartNumber=part_number)
+
+                return {
+                    'ETag': response['ETag'],
+                    'PartNumber': part_number,
+                }
+            except Exception: # pylint: disable=broad-except
+                attempt += 1
+
+                if attempt > retries:
+                    raise
+
+                time.sleep(2 ** attempt)
+
+    def list_files(self):
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket):
+            for s3_object in page.get('Contents', ()):
+                item = file_item(s3_object['Key'], s3_object['Size'], s3_object['LastModified'])
+
+                # Single-part ETags are the MD5 of the content.
+
+                etag = s3_object.get('ETag', '').strip('"')
+
+                if etag and '-' not in etag:
+                    item['fingerprint'] = 'md5:' + etag
+
+                yield item
+
+    def fingerprints(self, item):
+        if item.get('fingerprint', None) is not None:
+            return set([item['fingerprint']])
+
+        # Multipart uploads keep the content MD5 (transmit) or the source's fingerprint (write_stream) as metadata.
+
+        response = self.client.head_object(Bucket=self.bucket, Key=item['name'])
+
+        metadata = response.get('Metadata', {})
+
+        fingerprints = set(['s3-etag:' + response['ETag'].strip('"')])
+
+        if 'md5' in metadata:
+            fingerprints.add('md5:' + metadata['md5'])
+
+        if 'fingerprint' in metadata:
+            fingerprints.add(metadata['fingerprint'])
+
+        return fingerprints
+
+    def stat(self, remote_path):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=remote_path)
+        except ClientError as client_error:
+            if client_error.response.get('Error', {}).get('Code', None) in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+
+            raise
+
+        return file_item(remote_path, response['ContentLength'], response['LastModified'])
+
+    def open_read(self, remote_path):
+        return self.client.get_object(Bucket=self.bucket, Key=remote_path)['Body']
+
+    def write_stream(self, stream, remote_path, fingerprint=None):
+        # Managed uploads switch to concurrent multipart uploads past the threshold.
+
+        transfer_config = TransferConfig(multipart_threshold=getattr(settings, 'SIMPLE_BACKUP_S3_MULTIPART_THRESHOLD', S3_DEFAULT_MULTIPART_THRESHOLD), multipart_chunksize=getattr(settings, 'SIMPLE_BACKUP_S3_PART_SIZE', S3_DEFAULT_PART_SIZE), max_concurrency=getattr(settings, 'SIMPLE_BACKUP_S3_PART_WORKERS', S3_DEFAULT_PART_WORKERS))
+
+        extra_args = {}
+
+        if fingerprint is not None:
+            extra_args['Metadata'] = {'fingerprint': fingerprint}
+
+            if fingerprint.startswith('md5:'):
+                extra_args['Metadata']['md5'] = fingerprint[len('md5:'):]
+
+        self.client.upload_fileobj(stream, self.bucket, remote_path, ExtraArgs=extra_args, Config=transfer_config)
+
+    def fetch(self, remote_path, local_path):
+        self.client.download_file(self.bucket, remote_path, local_path)
+
+    def copy(self, source_path, remote_path):
+        # Managed copies run on the S3 side (as a multipart copy for large
+        # objects) and keep the object metadata, including the content MD5.
+
+        self.client.copy({'Bucket': self.bucket, 'Key': source_path}, self.bucket, remote_path)
+
+    def delete(self, remote_paths):
+        remote_paths = list(remote_paths)
+
+        failures = []
+
+        for start in range(0, len(remote_paths), S3_DELETE_BATCH_SIZE):
+            objects = [{'Key': remote_path} for remote_path in remote_paths[start:start + S3_DELETE_BATCH_SIZE]]
+
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+            for error in response.get('Errors', ()):
+                failures.append('%s (%s: %s)' % (error.get('Key', None), error.get('Code', None), error.get('Message', None)))
+
+        if failures:
+            raise IOError('Unable to delete from S3: ' + ', '.join(failures))
+
+DESTINATION_CLASSES = {
+    'file': FileDestination,
+    'dropbox': DropboxDestination,
+    's3': S3Destination,
+}
+
+def destination_label(destination):
+    url = urlparse(destination)
+
+    if url.scheme == 'dropbox':
+        # The network location holds the access token - keep it out of reports and records.
+
+        return 'dropbox://' + url.path
+
+    return destination
+
+def destination_for_url(destination):
+    destination_class = DESTINATION_CLASSES.get(urlparse(destination).scheme, None)
+
+    if destination_class is None:
+        return None
+
+    return destination_class(destination)
@@ -0,0 +1,241 @@
+# pylint: disable=line-too-long
+
+'''
+Chunked, streaming container for encrypted backup artifacts.
+
+Layout (all integers big-endian):
+
+    header: MAGIC (8 bytes) | version (1 byte) | chunk size (4 bytes) | stream nonce prefix (16 bytes)
+    record: flags (1 byte) | ciphertext length (4 bytes) | SecretBox ciphertext (MAC + payload)
+
+Every record is sealed with its own nonce, derived from the random stream
+prefix and the record index (with a final-record bit), so reordering,
+duplicating, truncating or splicing records between files fails to
+authenticate. Files without the header are legacy single-blob SecretBox
+messages and are still decrypted (in memory) for compatibility.
+'''
+
+import io
+import os
+import struct
+
+import nacl.utils
+
+from nacl.exceptions import CryptoError
+from nacl.secret import SecretBox
+
+from django.conf import settings
+
+MAGIC = b'SBACKUP\x00'
+VERSION = 1
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+NONCE_PREFIX_SIZE = SecretBox.NONCE_SIZE - 8
+
+FLAG_FINAL = 0x01
+FINAL_INDEX_BIT = 1 << 63
+
+HEADER_STRUCT = struct.Struct('>8sBI%ds' % NONCE_PREFIX_SIZE)
+RECORD_STRUCT = struct.Struct('>BI')
+
+SECRET_BOXES = {}
+
+def encryption_chunk_size():
+    return getattr(settings, 'SIMPLE_BACKUP_ENCRYPTION_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+def record_nonce(prefix, index, final):
+    if final:
+        index = index | FINAL_INDEX_BIT
+
+    return prefix + struct.pack('>Q', index)
+
+def read_fully(source, size):
+    chunks = []
+    remaining = size
+
+    while remaining > 0:
+        chunk = source.read(remaining)
+
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return b''.join(chunks)
+
+def secret_box(key):
+    # SecretBox is stateless once built, so one instance per key serves every file in a run.
+
+    box = SECRET_BOXES.get(key, None)
+
+    if box is None:
+        box = SecretBox(key)
+
+        SECRET_BOXES[key] = box
+
+    return box
+
+def is_chunked(prefix):
+    return prefix[:len(MAGIC)] == MAGIC
+
+def iter_encrypted(key, source, chunk_size=None):
+    '''
+    Yields the encrypted container for the readable binary stream source
+    piece by piece, holding at most two plaintext chunks in memory.
+    '''
+
+    if chunk_size is None:
+        chunk_size = encryption_chunk_size()
+
+    box = secret_box(key)
+
+    prefix = nacl.utils.random(NONCE_PREFIX_SIZE)
+
+    yield HEADER_STRUCT.pack(MAGIC, VERSION, chunk_size, prefix)
+
+    index = 0
+
+    chunk = read_fully(source, chunk_size)
+
+    while True:
+        next_chunk = read_fully(source, chunk_size) if len(chunk) == chunk_size else b''
+
+        final = len(next_chunk) == 0 # pylint: disable=len-as-condition
+
+        ciphertext = box.encrypt(chunk, record_nonce(prefix, index, final)).ciphertext
+
+        yield RECORD_STRUCT.pack(FLAG_FINAL if final else 0, len(ciphertext)) + ciphertext
+
+        if final:
+            break
+
+        chunk = next_chunk
+        index += 1
+
+def iter_decrypted(key, source):
+    '''
+    Yields the plaintext of an encrypted artifact read from the binary stream
+    source. Chunked containers are decrypted record by record; legacy
+    single-blob files are decrypted whole. Raises CryptoError if the content
+    fails to authenticate or is truncated.
+    '''
+
+    box = secret_box(key)
+
+    header = read_fully(source, HEADER_STRUCT.size)
+
+    if is_chunked(header) is False:
+        yield box.decrypt(header + source.read())
+
+        return
+
+    if len(header) < HEADER_STRUCT.size:
+        raise CryptoError('Truncated backup header.')
+
+    magic, version, chunk_size, prefix = HEADER_STRUCT.unpack(header) # pylint: disable=unused-variable
+
+    if version != VERSION:
+        raise CryptoError('Unsupported backup container version: %s' % version)
+
+    max_record_size = chunk_size + SecretBox.MACBYTES
+
+    index = 0
+
+    while True:
+        record_header = read_fully(source, RECORD_STRUCT.size)
+
+        if len(record_header) < RECORD_STRUCT.size:
+            raise CryptoError('Truncated backup: missing final chunk.')
+
+        flags, length = RECORD_STRUCT.unpack(record_header)
+
+        if length > max_record_size:
+            raise CryptoError('Invalid chunk length in backup: %s' % length)
+
+        ciphertext = read_fully(source, length)
+
+        if len(ciphertext) < length:
+            raise CryptoError('Truncated backup: incomplete chunk %s.' % index)
+
+        final = (flags & FLAG_FINAL) != 0
+
+        yield box.decrypt(ciphertext, record_nonce(prefix, index, final))
+
+        if final:
+            break
+
+        index += 1
+
+    if source.read(1):
+        raise CryptoError('Unexpected data after final chunk in backup.')
+
+class DecryptedReader(io.RawIOBase):
+    '''
+    Readable binary stream over the plaintext of an encrypted artifact, for
+    consumers (such as decompressors) that pull data rather than iterate.
+    '''
+
+    def __init__(self, key, source):
+        super(DecryptedReader, self).__init__() # pylint: disable=super-with-arguments
+
+        self.pieces = iter_decrypted(key, source)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.pieces)
+            except StopIteration:
+                return 0
+
+        length = min(len(buffer), len(self.buffer))
+
+        buffer[:length] = self.buffer[:length]
+
+        self.buffer = self.buffer[length:]
+
+        return length
+
+def open_decrypted(key, source):
+    return io.BufferedReader(DecryptedReader(key, source), buffer_size=encryption_chunk_size())
+
+def encrypt_stream(key, source, destination, chunk_size=None):
+    written = 0
+
+    for piece in iter_encrypted(key, source, chunk_size=chunk_size):
+        destination.write(piece)
+
+        written += len(piece)
+
+    return written
+
+def decrypt_stream(key, source, destination):
+    written = 0
+
+    for piece in iter_decrypted(key, source):
+        destination.write(piece)
+
+        written += len(piece)
+
+    return written
+
+def encrypt_file(key, path, encrypted_path, chunk_size=None):
+    with io.open(path, 'rb') as source:
+        with io.open(encrypted_path, 'wb') as destination:
+            return encrypt_stream(key, source, destination, chunk_size=chunk_size)
+
+def decrypt_file(key, encrypted_path, path):
+    try:
+        with io.open(encrypted_path, 'rb') as source:
+            with io.open(path, 'wb') as destination:
+                return decrypt_stream(key, source, destination)
+    except CryptoError:
+        if os.path.exists(path):
+            os.remove(path)
+
+        raise
@@ -0,0 +1,288 @@
+# pylint: disable=no-member,line-too-long
+
+import base64
+import io
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import six
+
+from nacl.secret import SecretBox
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import management
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...backup_api import CompressedFixtureWriter, app_models, native_dump
+from ...compression import CODEC_CLASSES, codec_named
+from ...encryption import encrypt_file, decrypt_file
+
+MEGABYTE = 1024 * 1024
+
+FIXTURE_BATCH_SIZE = 10000
+
+def peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin': # ru_maxrss is reported in bytes on macOS, kilobytes elsewhere
+        return usage
+
+    return usage * 1024
+
+def legacy_encrypt_file(key, path, encrypted_path):
+    box = SecretBox(key)
+
+    with io.open(path, 'rb') as source:
+        encrypted = box.encrypt(source.read())
+
+    with io.open(encrypted_path, 'wb') as destination:
+        destination.write(encrypted)
+
+def legacy_decrypt_file(key, encrypted_path, path):
+    box = SecretBox(key)
+
+    with io.open(encrypted_path, 'rb') as source:
+        content = box.decrypt(source.read())
+
+    with io.open(path, 'wb') as destination:
+        destination.write(content)
+
+def run_encryption_case(case, key, path, work_path):
+    # Runs in a fresh worker process so ru_maxrss reflects this case only.
+
+    baseline = peak_rss()
+
+    encrypted_path = work_path + '.encrypted'
+    decrypted_path = work_path + '.decrypted'
+
+    start = time.time()
+
+    if case == 'legacy':
+        legacy_encrypt_file(key, path, encrypted_path)
+    else:
+        encrypt_file(key, path, encrypted_path)
+
+    encrypt_seconds = time.time() - start
+
+    start = time.time()
+
+    if case == 'legacy':
+        legacy_decrypt_file(key, encrypted_path, decrypted_path)
+    else:
+        decrypt_file(key, encrypted_path, decrypted_path)
+
+    decrypt_seconds = time.time() - start
+
+    os.remove(encrypted_path)
+    os.remove(decrypted_path)
+
+    return {
+        'encrypt_seconds': encrypt_seconds,
+        'decrypt_seconds': decrypt_seconds,
+        'baseline_rss': baseline,
+        'peak_rss': peak_rss(),
+    }
+
+class Command(BaseCommand):
+    help = 'Measures throughput and peak memory of backup pipeline stages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite',
+                            choices=('encryption', 'dump', 'compression',),
+                            help='Pipeline stage to benchmark')
+
+        parser.add_argument('--size',
+                            type=int,
+                            dest='size',
+                            default=256,
+                            help='Size of the synthetic payload in megabytes')
+
+        parser.add_argument('--rows',
+                            type=int,
+                            dest='rows',
+                            default=1000000,
+                            help='Number of synthetic users created for the dump benchmark')
+
+        parser.add_argument('--input',
+                            type=str,
+                            dest='input',
+                            default=None,
+                            help='Uncompressed dump to compress (default: a fresh dump of SIMPLE_BACKUP_DUMPDATA_APPS)')
+
+    def handle(self, *args, **options):
+        if options['suite'] == 'encryption':
+            self.benchmark_encryption(options)
+        elif options['suite'] == 'dump':
+            self.benchmark_dump(options)
+        elif options['suite'] == 'compression':
+            self.benchmark_compression(options)
+
+    def benchmark_compression(self, options): # pylint: disable=no-self-use, too-many-locals
+        work_folder = tempfile.mkdtemp()
+
+        path = options['input']
+
+        if path is None:
+            path = os.path.join(work_folder, 'dump.jsonl')
+
+            with io.open(path, 'w', encoding='utf8') as dump_file:
+                for app in getattr(settings, 'SIMPLE_BACKUP_DUMPDATA_APPS', ('auth',)):
+                    native_dump(app, dump_file)
+
+        size = os.path.getsize(path)
+
+        six.print_('Input: %s (%.1f MB)' % (path, float(size) / MEGABYTE))
+
+        cases = []
+
+        for name in sorted(CODEC_CLASSES.keys()):
+            if CODEC_CLASSES[name]().available() is False:
+                six.print_('%-14s not available' % name)
+
+                continue
+
+            if name in ('bz2', 'zstd'):
+                cases.append(('%s (1 thread)' % name, codec_named(name, threads=0)))
+                cases.append(('%s (threads)' % name, codec_named(name, threads=-1)))
+            else:
+                cases.append((name, codec_named(name)))
+
+        compressed_path = os.path.join(work_folder, 'compressed')
+
+        try:
+            for label, codec in cases:
+                start = time.time()
+
+                with io.open(path, 'rb') as source, io.open(compressed_path, 'wb') as compressed_file:
+                    writer = CompressedFixtureWriter(compressed_file, codec=codec)
+
+                    while True:
+                        chunk = source.read(MEGABYTE)
+
+                        if not chunk:
+                            break
+
+                        writer.write(chunk)
+
+                    writer.close()
+
+                compress_seconds = max(time.time() - start, 0.000001)
+
+                start = time.time()
+
+                with io.open(compressed_path, 'rb') as compressed_file:
+                    with codec.open_reader(compressed_file) as reader:
+                        while reader.read(MEGABYTE):
+                            pass
+
+                decompress_seconds = max(time.time() - start, 0.000001)
+
+                compressed_size = os.path.getsize(compressed_path)
+
+                six.print_('%-16s ratio: %6.2f  compress: %8.1f MB/s  decompress: %8.1f MB/s' % (
+                    label,
+                    float(size) / max(compressed_size, 1),
+                    float(size) / MEGABYTE / compress_seconds,
+                    float(size) / MEGABYTE / decompress_seconds,
+                ))
+
+                os.remove(compressed_path)
+        finally:
+            if options['input'] is None:
+                os.remove(path)
+
+            os.rmdir(work_folder)
+
+    def benchmark_dump(self, options): # pylint: disable=no-self-use
+        # The synthetic users only exist inside this transaction, which is
+        # rolled back at the end. The native engine runs first because peak
+        # RSS never goes down within a process.
+
+        work_folder = tempfile.mkdtemp()
+
+        with transaction.atomic():
+            created = 0
+
+            while created < options['rows']:
+                batch = [User(username='simple-backup-benchmark-%d' % index, email='benchmark-%d@example.com' % index, password='!') for index in range(created, min(created + FIXTURE_BATCH_SIZE, options['rows']))]
+
+                User.objects.bulk_create(batch)
+
+                created += len(batch)
+
+            rows = sum(model._default_manager.count() for model in app_models('auth')) # pylint: disable=protected-access
+
+            six.print_('Fixture: %d row(s) in auth' % rows)
+
+            try:
+                for engine in ('native', 'dumpdata'):
+                    path = os.path.join(work_folder, engine)
+
+                    baseline = peak_rss()
+
+                    start = time.time()
+
+                    with io.open(path, 'wb') as fixture_file:
+                        writer = CompressedFixtureWriter(fixture_file)
+
+                        if engine == 'native':
+                            native_dump('auth', writer)
+                        else:
+                            management.call_command('dumpdata', 'auth', stdout=writer)
+
+                        writer.close()
+
+                    seconds = max(time.time() - start, 0.000001)
+
+                    six.print_('%-8s %10.0f rows/s  %8.1f seconds  %8.1f MB written  peak RSS: %8.1f MB (+%.1f MB)' % (
+                        engine,
+                        rows / seconds,
+                        seconds,
+                        float(os.path.getsize(path)) / MEGABYTE,
+                        float(peak_rss()) / MEGABYTE,
+                        float(peak_rss() - baseline) / MEGABYTE,
+                    ))
+
+                    os.remove(path)
+            finally:
+                os.rmdir(work_folder)
+
+                transaction.set_rollback(True)
+
+    def benchmark_encryption(self, options): # pylint: disable=no-self-use
+        key = base64.b64decode(settings.SIMPLE_BACKUP_KEY)
+
+        work_folder = tempfile.mkdtemp()
+
+        path = os.path.join(work_folder, 'payload')
+
+        with io.open(path, 'wb') as payload:
+            for _ in range(options['size']):
+                payload.write(os.urandom(MEGABYTE))
+
+        size = os.path.getsize(path)
+
+        six.print_('Payload: %.1f MB' % (float(size) / MEGABYTE))
+
+        try:
+            for case in ('legacy', 'chunked'):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_encryption_case, case, key, path, os.path.join(work_folder, case)).result()
+
+                six.print_('%-8s encrypt: %8.1f MB/s  decrypt: %8.1f MB/s  peak RSS: %8.1f MB (+%.1f MB over baseline)' % (
+                    case,
+                    float(size) / MEGABYTE / max(result['encrypt_seconds'], 0.000001),
+                    float(size) / MEGABYTE / max(result['decrypt_seconds'], 0.000001),
+                    float(result['peak_rss']) / MEGABYTE,
+                    float(result['peak_rss'] - result['baseline_rss']) / MEGABYTE,
+                ))
+        finally:
+            os.remove(path)
+            os.rmdir(work_folder)
@@ -0,0 +1,79 @@
+# pylint: disable=no-member,line-too-long
+
+import base64
+import datetime
+import shutil
+import tempfile
+
+import six
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...archives import parse_date
+from ...decorators import handle_lock
+from ...destinations import destination_for_url, destination_label
+from ...retention import compact_windows, compactable_windows, compaction_plan, delete_superseded
+
+class Command(BaseCommand):
+    help = 'Merges aged daily backup windows into weekly and monthly archives (see SIMPLE_BACKUP_RETENTION).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destination',
+                            type=str,
+                            dest='destinations',
+                            action='append',
+                            default=None,
+                            help='Destination to compact, in SIMPLE_BACKUP_DESTINATIONS URL format (default: every configured destination; may be repeated)')
+
+        parser.add_argument('--today',
+                            type=str,
+                            dest='today',
+                            default=None,
+                            help='Date retention horizons are counted back from (default: today)')
+
+        parser.add_argument('--dry-run',
+                            dest='dry_run',
+                            action='store_true',
+                            help='Only report the windows that would be merged')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        key = base64.b64decode(settings.SIMPLE_BACKUP_KEY)
+
+        today = parse_date(options['today']) if options['today'] is not None else datetime.date.today()
+
+        destinations = options['destinations'] or getattr(settings, 'SIMPLE_BACKUP_DESTINATIONS', [])
+
+        for destination_url in destinations:
+            destination = destination_for_url(destination_url)
+
+            if destination is None:
+                raise CommandError('Unknown destination: %s' % destination_label(destination_url))
+
+            label = destination_label(destination_url)
+
+            plan = compaction_plan(compactable_windows(label), today)
+
+            if not plan:
+                six.print_('%s: nothing to compact.' % label)
+
+                continue
+
+            staging = tempfile.mkdtemp(prefix='simple_backup_compact_', dir=getattr(settings, 'SIMPLE_BACKUP_STAGING_DESTINATION', tempfile.gettempdir()))
+
+            try:
+                superseded = []
+
+                for period, windows in plan:
+                    six.print_('%s: merging %d window(s) into a %sly archive: %s' % (label, len(windows), period[0], ', '.join('%s__%s' % window for window in windows)))
+
+                    if options['dry_run'] is False:
+                        superseded.extend(compact_windows(key, destination, label, windows, staging))
+
+                if options['dry_run'] is False:
+                    deleted = delete_superseded(key, destination, label, superseded, staging)
+
+                    six.print_('%s: merged %d period(s), deleted %d superseded object(s).' % (label, len(plan), deleted))
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
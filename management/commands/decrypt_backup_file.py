@@ -1,14 +1,123 @@
 # pylint: disable=no-member,line-too-long
 
 import base64
+import glob
+import io
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
 
 import six
 
-from nacl.secret import SecretBox
+from nacl.exceptions import CryptoError
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+
+from ...compression import codec_for_header, decompress_file
+from ...deduplication import MANIFEST_SUFFIX, chunk_folder, find_chunk_root, read_manifest, reassemble_file
+from ...encryption import decrypt_file, open_decrypted
+
+READ_SIZE = 1024 * 1024
+
+def decrypted_path(encrypted_path):
+    if encrypted_path.endswith('.encrypted'):
+        return encrypted_path[:-len('.encrypted')]
+
+    return encrypted_path + '.decrypted'
+
+def decrypt_and_decompress(key, encrypted_path, output_path):
+    '''
+    Decrypts encrypted_path and, when the plaintext is compressed with a
+    known codec, decompresses it in the same pass. Returns the path written.
+    '''
+
+    with io.open(encrypted_path, 'rb') as encrypted_file:
+        reader = open_decrypted(key, encrypted_file)
+
+        codec = codec_for_header(reader.peek(8)[:8])
+
+        if codec is not None and codec.available():
+            if output_path.endswith(codec.extension):
+                output_path = output_path[:-len(codec.extension)]
+            else:
+                output_path = output_path + '.decompressed'
+
+            reader = codec.open_reader(reader)
+
+        try:
+            with io.open(output_path, 'wb') as output_file:
+                while True:
+                    chunk = reader.read(READ_SIZE)
+
+                    if not chunk:
+                        break
+
+                    output_file.write(chunk)
+        except Exception:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+            raise
+
+    return output_path
+
+def decrypt_backup(key, encrypted_path, output_path, chunk_root, decompress): # pylint: disable=too-many-branches
+    '''
+    Decrypts (and optionally reassembles and decompresses) one backup file.
+    Runs in worker processes, so any failure is returned rather than raised:
+    returns (encrypted path, output path, bytes read, bytes written, error).
+    Decrypted manifests are removed once their file is reassembled.
+    '''
+
+    try:
+        output_folder = os.path.dirname(output_path)
+
+        if output_folder and os.path.isdir(output_folder) is False:
+            try:
+                os.makedirs(output_folder)
+            except OSError:
+                if os.path.isdir(output_folder) is False:
+                    raise
+
+        if decompress and output_path.endswith(MANIFEST_SUFFIX) is False:
+            output_path = decrypt_and_decompress(key, encrypted_path, output_path)
+        else:
+            decrypt_file(key, encrypted_path, output_path)
+
+            # Deduplicated backups decrypt to a manifest - rebuild the original file from its chunks.
+
+            if output_path.endswith(MANIFEST_SUFFIX):
+                manifest_path = output_path
+
+                try:
+                    if chunk_root is None:
+                        chunk_root = find_chunk_root(encrypted_path, read_manifest(manifest_path)['chunk_folder'])
+
+                    output_path = reassemble_file(key, manifest_path, chunk_root)
+                finally:
+                    # The manifest is only a step towards the file it lists.
+
+                    os.remove(manifest_path)
+
+                if decompress:
+                    decompressed_path = decompress_file(output_path)
+
+                    if decompressed_path is not None:
+                        os.remove(output_path)
 
+                        output_path = decompressed_path
+
+        return encrypted_path, output_path, os.path.getsize(encrypted_path), os.path.getsize(output_path), None
+    except CryptoError as exception:
+        return encrypted_path, None, 0, 0, 'authentication failed (%s)' % exception
+    except (IOError, OSError, ValueError) as exception:
+        return encrypted_path, None, 0, 0, str(exception)
+    except Exception as exception: # pylint: disable=broad-except
+        # Codecs raise their own errors (EOFError, zstandard.ZstdError...) - one bad file must not stop the others.
+
+        return encrypted_path, None, 0, 0, '%s: %s' % (exception.__class__.__name__, exception)
 
 class Command(BaseCommand):
     help = 'Loads content from incremental backups of data content.'
@@ -17,20 +126,106 @@ class Command(BaseCommand):
         parser.add_argument('file',
                             nargs='+',
                             type=str,
-                            help='Backup file to decrypt')
+                            help='Backup file, folder or glob pattern to decrypt')
+
+        parser.add_argument('--chunk-root',
+                            type=str,
+                            dest='chunk_root',
+                            default=None,
+                            help='Folder holding the chunk store for deduplicated backups (default: nearest parent folder containing it)')
+
+        parser.add_argument('--decompress',
+                            dest='decompress',
+                            action='store_true',
+                            help='Also decompress decrypted files, detecting the codec from their content')
+
+        parser.add_argument('--output-dir',
+                            type=str,
+                            dest='output_dir',
+                            default=None,
+                            help='Write decrypted files to this folder instead of next to the encrypted files')
+
+        parser.add_argument('--jobs',
+                            type=int,
+                            dest='jobs',
+                            default=1,
+                            help='Number of files decrypted in parallel worker processes')
+
+    def backup_files(self, inputs, output_dir): # pylint: disable=no-self-use, too-many-branches
+        '''
+        Expands files, folders (searched recursively, skipping the chunk store)
+        and glob patterns into (encrypted path, output path) pairs.
+        '''
+
+        files = []
+
+        for name in inputs:
+            if os.path.isdir(name):
+                for folder, folder_names, file_names in os.walk(name):
+                    if chunk_folder() in folder_names:
+                        folder_names.remove(chunk_folder())
+
+                    for file_name in sorted(file_names):
+                        if file_name.endswith('.encrypted'):
+                            path = os.path.join(folder, file_name)
+
+                            files.append((path, os.path.relpath(path, name)))
+            elif os.path.exists(name):
+                files.append((name, os.path.basename(name)))
+            else:
+                matches = sorted(glob.glob(name))
 
-    def handle(self, *args, **options):
+                if not matches:
+                    raise CommandError('No backup files match %s.' % name)
+
+                for path in matches:
+                    if os.path.isfile(path):
+                        files.append((path, os.path.basename(path)))
+
+        pairs = []
+
+        for path, relative_path in files:
+            if output_dir is not None:
+                pairs.append((path, decrypted_path(os.path.join(output_dir, relative_path))))
+            else:
+                pairs.append((path, decrypted_path(path)))
+
+        return pairs
+
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
         key = base64.b64decode(settings.SIMPLE_BACKUP_KEY) # getpass.getpass('Enter secret backup key: ')
 
-        for encrypted_file in  options['file']:
-            box = SecretBox(key)
+        pairs = self.backup_files(options['file'], options['output_dir'])
+
+        start_time = time.time()
+
+        if options['jobs'] > 1:
+            with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+                futures = [executor.submit(decrypt_backup, key, encrypted_path, output_path, options['chunk_root'], options['decompress']) for encrypted_path, output_path in pairs]
+
+                results = [future.result() for future in futures]
+        else:
+            results = [decrypt_backup(key, encrypted_path, output_path, options['chunk_root'], options['decompress']) for encrypted_path, output_path in pairs]
+
+        seconds = max(time.time() - start_time, 0.000001)
+
+        read_bytes = 0
+        written_bytes = 0
+
+        failures = []
+
+        for encrypted_path, output_path, file_read, file_written, error in results:
+            if error is not None:
+                failures.append(encrypted_path)
 
-            with open(encrypted_file, 'rb') as backup_file:
-                encrypted_content = backup_file.read()
+                six.print_('FAILED %s: %s' % (encrypted_path, error))
+            else:
+                six.print_('Decrypted %s to %s' % (encrypted_path, output_path))
 
-                content = box.decrypt(encrypted_content)
+                read_bytes += file_read
+                written_bytes += file_written
 
-                with open(encrypted_file.replace('.encrypted', ''), 'wb') as output:
-                    output.write(content)
+        six.print_('Decrypted %d of %d file(s) in %.2f seconds: %.2f MB read (%.2f MB/s), %.2f MB written (%.2f MB/s).' % (len(results) - len(failures), len(results), seconds, read_bytes / 1000000.0, read_bytes / 1000000.0 / seconds, written_bytes / 1000000.0, written_bytes / 1000000.0 / seconds))
 
-                    six.print_('Decrypted %s' % encrypted_file.replace('.encrypted', ''))
+        if failures:
+            raise CommandError('%d file(s) could not be decrypted: %s' % (len(failures), ', '.join(failures)))
@@ -0,0 +1,59 @@
+# pylint: disable=no-member,line-too-long
+
+import datetime
+
+import six
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...catalog import artifacts_containing
+
+class Command(BaseCommand):
+    help = 'Looks up the backup artifacts holding a model\'s rows (or one row) as of a date in the backup catalog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model',
+                            type=str,
+                            help='Model to look up, as app_label.Model')
+
+        parser.add_argument('--pk',
+                            type=int,
+                            dest='primary_key',
+                            default=None,
+                            help='Only artifacts whose primary key range covers this (integer) key')
+
+        parser.add_argument('--as-of',
+                            type=str,
+                            dest='as_of',
+                            default=None,
+                            help='Only artifacts from windows ending on or before this date')
+
+        parser.add_argument('--destination',
+                            type=str,
+                            dest='destination',
+                            default=None,
+                            help='Only artifacts at this destination (as recorded in the catalog)')
+
+        parser.add_argument('--all',
+                            dest='all',
+                            action='store_true',
+                            help='List every matching artifact instead of the newest window only')
+
+    def handle(self, *args, **options):
+        as_of = None
+
+        if options['as_of'] is not None:
+            as_of = datetime.date(*[int(component) for component in options['as_of'].split('-')])
+
+        artifacts = list(artifacts_containing(options['model'], primary_key=options['primary_key'], as_of=as_of, destination=options['destination']))
+
+        if not artifacts:
+            raise CommandError('No catalogued backups hold %s%s.' % (options['model'], (' #%s' % options['primary_key']) if options['primary_key'] is not None else ''))
+
+        if options['all'] is False:
+            newest = (artifacts[0].start_date, artifacts[0].end_date)
+
+            artifacts = [artifact for artifact in artifacts if (artifact.start_date, artifact.end_date) == newest]
+
+        for artifact in artifacts:
+            six.print_('%s__%s\t%s\t%s\t%s bytes\t%s row(s)\t%s' % (artifact.start_date, artifact.end_date, artifact.destination, artifact.path, artifact.size, artifact.row_count, artifact.codec))
@@ -4,27 +4,85 @@ import base64
 import datetime
 import importlib
 import os
+import shutil
 import sys
+import tempfile
+import time
 
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-import boto3
-import dropbox
 import pytz
 import six
 
-from botocore.config import Config
-from nacl.secret import SecretBox
+import django
 
+from django import db
+from django.apps import apps
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
 
+from ...catalog import file_checksum, read_catalog_stats
+from ...compression import codec_for_extension
+from ...deduplication import chunk_folder, deduplicate_file, deduplication_enabled
 from ...decorators import handle_lock
+from ...destinations import destination_for_url, destination_label
+from ...encryption import encrypt_file
+from ...models import BackupArtifact, BackupArtifactRange
 
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse import urlparse
+DEFAULT_TRANSMIT_WORKERS = 4
+DEFAULT_TRANSMIT_RETRIES = 3
+LEDGER_QUERY_BATCH_SIZE = 500
+
+WORKER_PID = None
+
+INHERITED_CONNECTIONS = []
+
+def prepare_worker():
+    '''
+    Readies a pool worker on its first task. Done here rather than with a pool
+    initializer, which ProcessPoolExecutor only accepts from Python 3.7.
+    '''
+
+    global WORKER_PID # pylint: disable=global-statement
+
+    if WORKER_PID == os.getpid():
+        return
+
+    WORKER_PID = os.getpid()
+
+    # Needed when workers are spawned rather than forked.
+
+    if apps.ready is False:
+        django.setup()
+
+    # A forked worker must open its own database connections. Inherited ones
+    # are set aside rather than closed, as closing one would end the parent's
+    # session on the shared socket.
+
+    for connection in db.connections.all():
+        if connection.connection is not None:
+            INHERITED_CONNECTIONS.append(connection.connection)
+
+            connection.connection = None
+
+def stage_app_backup(app, parameters):
+    try:
+        backup_api = importlib.import_module(app + '.backup_api')
+
+        return app, backup_api.incremental_backup(parameters)
+    except ImportError:
+        pass
+    except AttributeError:
+        pass
+
+    return app, None
+
+def pooled_stage_app_backup(app, parameters):
+    prepare_worker()
+
+    return stage_app_backup(app, parameters)
 
 class Command(BaseCommand):
     help = 'Generates incremental backups of data content and transmits to storage.'
@@ -47,6 +105,23 @@ class Command(BaseCommand):
                             action='store_true',
                             help='Filter sensitive data from the backup data points written')
 
+        parser.add_argument('--transmit-workers',
+                            type=int,
+                            dest='transmit_workers',
+                            default=None,
+                            help='Number of destinations to transmit to concurrently (default: SIMPLE_BACKUP_TRANSMIT_WORKERS or %d)' % DEFAULT_TRANSMIT_WORKERS)
+
+        parser.add_argument('--workers',
+                            type=int,
+                            dest='workers',
+                            default=1,
+                            help='Number of worker processes dumping apps in parallel')
+
+        parser.add_argument('--resume',
+                            dest='resume',
+                            action='store_true',
+                            help='Skip apps and destinations already recorded as transmitted for this window')
+
     def folder_for_options(self, options): # pylint: disable=no-self-use
         folder_path_format = '%(start_date)s__%(end_date)s'
 
@@ -75,8 +150,23 @@ class Command(BaseCommand):
         return folder_path_format % folder_args
 
 
+    def lock_suffix(self, options): # pylint: disable=no-self-use
+        # Explicit date windows lock independently so batches can run them in parallel.
+
+        if options.get('start_date', None) is not None and options.get('end_date', None) is not None:
+            return '%s__%s' % (options['start_date'], options['end_date'])
+
+        return None
+
     @handle_lock
     def handle(self, *args, **options): # pylint: disable=too-many-locals, too-many-statements, too-many-branches
+        self.backup_report = { # pylint: disable=attribute-defined-outside-init
+            'success': False,
+            'files': 0,
+            'bytes': 0,
+            'destinations': [],
+        }
+
         here_tz = pytz.timezone(settings.TIME_ZONE)
 
         parameters = {}
@@ -125,104 +215,341 @@ class Command(BaseCommand):
 
             sys.exit(1)
 
+        transmit_workers = options['transmit_workers']
+
+        if transmit_workers is None:
+            transmit_workers = getattr(settings, 'SIMPLE_BACKUP_TRANSMIT_WORKERS', DEFAULT_TRANSMIT_WORKERS)
+
+        transmit_report = self.backup_report['destinations']
+
+        final_folder = self.folder_for_options(options)
+
+        window = tuple(datetime.date(*[int(component) for component in options[date_key].split('-')]) for date_key in ('start_date', 'end_date'))
+
+        app_destinations = {}
+
         for app in settings.INSTALLED_APPS:
-            try:
-                backup_api = importlib.import_module(app + '.backup_api')
+            app_destinations[app] = list(destinations)
+
+            if options['resume']:
+                transmitted = set(BackupArtifact.objects.filter(start_date=window[0], end_date=window[1], app=app).values_list('destination', flat=True))
+
+                app_destinations[app] = [destination for destination in destinations if destination_label(destination) not in transmitted]
+
+                if not app_destinations[app]:
+                    six.print_('Skipping %s: already transmitted to all destinations for %s.' % (app, final_folder))
+
+                    del app_destinations[app]
+
+        checksums = {}
+
+        # Catalog details (codec and per-model row statistics) by encrypted path.
+
+        catalog = {}
+
+        # Apps queued in this run that list each encrypted file. A chunk
+        # shared by several apps' files is encrypted once and removed after
+        # the last of them is collected.
+
+        references = {}
+
+        # Chunks on their way to each destination in this run, by remote path:
+        # (encrypted path, future of the transmission carrying them).
+
+        queued_chunks = {}
+
+        # Each run stages into its own folder so concurrent windows never collide.
+
+        backup_staging = getattr(settings, 'SIMPLE_BACKUP_STAGING_DESTINATION', tempfile.gettempdir())
+
+        parameters['staging_destination'] = tempfile.mkdtemp(prefix='simple_backup_', dir=backup_staging)
+
+        # Staged files are encrypted and handed to the transmit pool as soon as
+        # each app finishes dumping, so uploads overlap with later dumps.
+
+        pending = []
+
+        # With SIMPLE_BACKUP_DEDUPLICATE, staged files become manifests plus
+        # content-addressed chunks shared by every run at a destination.
+
+        chunk_staging = os.path.join(parameters['staging_destination'], 'chunks')
+
+        deduplicate = deduplication_enabled()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, transmit_workers)) as executor:
+                for app, to_transmit in self.staged_backups(parameters, options['workers'], list(app_destinations.keys())):
+                    artifacts = []
+
+                    app_paths = set()
+
+                    for path in to_transmit:
+                        codec = codec_for_extension(path)
+
+                        stats = read_catalog_stats(path)
+
+                        staged_files = [(path, final_folder + '/' + os.path.basename(path))]
+
+                        if deduplicate:
+                            if os.path.isdir(chunk_staging) is False:
+                                os.makedirs(chunk_staging)
+
+                            manifest_path, chunk_files = deduplicate_file(key, path, chunk_staging)
 
-                to_transmit = backup_api.incremental_backup(parameters)
+                            # Chunks go first, so a manifest never lands before the chunks it lists.
 
-                for destination in destinations:
-                    destination_url = urlparse(destination)
+                            staged_files = chunk_files + [(manifest_path, final_folder + '/' + os.path.basename(manifest_path))]
 
-                    if destination_url.scheme == 'file':
-                        dest_path = destination_url.path
+                        for staged_path, remote_path in staged_files:
+                            encrypted_path = staged_path + '.encrypted'
 
-                        final_folder = self.folder_for_options(options)
+                            if encrypted_path in app_paths:
+                                # A chunk another file of this app already lists.
 
-                        if final_folder is not None:
-                            dest_path = os.path.join(dest_path, final_folder)
+                                os.remove(staged_path)
 
-                        if os.path.exists(dest_path) is False:
-                            six.print_('Creating folder for archive storage: ' + dest_path)
-                            sys.stdout.flush()
-                            os.makedirs(dest_path)
+                                continue
 
-                        for path in to_transmit:
-                            box = SecretBox(key)
+                            if encrypted_path in references:
+                                # A chunk shared with another app's file, encrypted already.
 
-                            with open(path, 'rb') as backup_file:
-                                encrypted_str = box.encrypt(backup_file.read())
+                                os.remove(staged_path)
+                            else:
+                                encrypt_file(key, staged_path, encrypted_path)
 
-                                filename = os.path.basename(path) + '.encrypted'
+                                os.remove(staged_path)
 
-                                encrypted_path = os.path.join(dest_path, filename)
+                                checksums[encrypted_path] = file_checksum(encrypted_path)
 
-                                six.print_('Writing to filesystem: ' + encrypted_path)
-                                sys.stdout.flush()
+                                if staged_path.startswith(chunk_staging + os.sep):
+                                    chunk_codec = codec_for_extension(staged_path)
 
-                                with open(encrypted_path, 'wb') as encrypted_file:
-                                    encrypted_file.write(encrypted_str)
-                    elif destination_url.scheme == 'dropbox':
-                        access_token = destination_url.netloc
+                                    catalog[encrypted_path] = (chunk_codec.name if chunk_codec is not None else None, None)
+                                else:
+                                    catalog[encrypted_path] = (codec.name if codec is not None else None, stats)
 
-                        client = dropbox.Dropbox(access_token)
+                                references[encrypted_path] = 0
 
-                        for path in to_transmit:
-                            box = SecretBox(key)
+                                self.backup_report['files'] += 1
+                                self.backup_report['bytes'] += os.path.getsize(encrypted_path)
 
-                            with open(path, 'rb') as backup_file:
-                                backup_io = BytesIO()
-                                backup_io.write(backup_file.read())
-                                backup_io.seek(0)
+                            references[encrypted_path] += 1
 
-                                filename = os.path.basename(path) + '.encrypted'
+                            app_paths.add(encrypted_path)
 
-                                final_folder = self.folder_for_options(options)
+                            artifacts.append((encrypted_path, remote_path + '.encrypted'))
 
-                                dropbox_path = os.path.join(destination_url.path, final_folder + '/' + filename)
+                    futures = []
 
-                                six.print_('Uploading to Dropbox: ' + dropbox_path)
-                                sys.stdout.flush()
+                    for destination in app_destinations[app]:
+                        destination_chunks = queued_chunks.setdefault(destination, {})
+
+                        to_send, queued = self.planned_artifacts(destination, artifacts, destination_chunks)
+
+                        future = executor.submit(self.transmit_artifacts, destination, to_send, queued)
+
+                        for encrypted_path, remote_path in to_send:
+                            if remote_path.startswith(chunk_folder() + '/'):
+                                destination_chunks[remote_path] = (encrypted_path, future)
+
+                        futures.append(future)
+
+                    pending.append((app, artifacts, futures))
+
+                    pending = self.collect_transmitted(pending, window, checksums, catalog, references, wait=False)
+
+                self.collect_transmitted(pending, window, checksums, catalog, references, wait=True)
+        finally:
+            shutil.rmtree(parameters['staging_destination'], ignore_errors=True)
+
+        failed = 0
+
+        for status in transmit_report:
+            if status['success']:
+                six.print_('[OK] %s: %d file(s), %d bytes in %.2f seconds' % (status['destination'], status['files'], status['bytes'], status['seconds']))
+            else:
+                six.print_('[FAILED] %s: %s' % (status['destination'], status['error']))
+
+                failed += 1
+
+        self.backup_report['success'] = failed == 0
+
+        if failed > 0:
+            raise CommandError('Unable to transmit backups to %d destination(s).' % failed)
+
+    def staged_backups(self, parameters, workers, app_names): # pylint: disable=no-self-use
+        if workers <= 1:
+            for app in app_names:
+                app, to_transmit = stage_app_backup(app, parameters)
+
+                if to_transmit is not None:
+                    yield app, to_transmit
+
+            return
+
+        # Forked workers must not share the parent's database connections -
+        # close them here, and prepare_worker sets aside any opened since.
+
+        db.connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(pooled_stage_app_backup, app, parameters) for app in app_names]
+
+            for future in as_completed(futures):
+                app, to_transmit = future.result()
+
+                if to_transmit is not None:
+                    yield app, to_transmit
+
+    def collect_transmitted(self, pending, window, checksums, catalog, references, wait): # pylint: disable=too-many-arguments, too-many-positional-arguments, bad-option-value
+        remaining = []
+
+        for app, artifacts, futures in pending:
+            if wait is False and all(future.done() for future in futures) is False:
+                remaining.append((app, artifacts, futures))
+
+                continue
+
+            for future in futures:
+                status = future.result()
+
+                self.backup_report['destinations'].append(status)
+
+                if status['success']:
+                    self.record_transmitted(app, window, status, checksums, catalog)
+
+            for encrypted_path, remote_path in artifacts: # pylint: disable=unused-variable
+                references[encrypted_path] -= 1
+
+                if references[encrypted_path] == 0:
+                    os.remove(encrypted_path)
+
+                    del checksums[encrypted_path]
+                    del catalog[encrypted_path]
+                    del references[encrypted_path]
+
+        return remaining
+
+    def record_transmitted(self, app, window, status, checksums, catalog): # pylint: disable=no-self-use, too-many-arguments, too-many-locals, too-many-positional-arguments, bad-option-value
+        now = timezone.now()
+
+        with transaction.atomic():
+            ranges = []
+
+            for encrypted_path, remote_path in status['transmitted']:
+                codec, stats = catalog[encrypted_path]
+
+                row_count = sum(entry['rows'] for entry in stats.values()) if stats is not None else None
+
+                artifact = BackupArtifact.objects.create(app=app, destination=status['destination'], start_date=window[0], end_date=window[1], path=remote_path, size=os.path.getsize(encrypted_path), checksum=checksums[encrypted_path], codec=codec, row_count=row_count, transmitted=now)
+
+                for model, entry in (stats or {}).items():
+                    ranges.append(BackupArtifactRange(artifact=artifact, model=model, row_count=entry['rows'], min_pk=entry['min_pk'], max_pk=entry['max_pk']))
+
+            BackupArtifactRange.objects.bulk_create(ranges)
+
+    def planned_artifacts(self, destination, artifacts, destination_chunks): # pylint: disable=no-self-use
+        '''
+        Splits an app's artifacts for a destination into those to upload and
+        the chunks an earlier transmission in this run is already uploading
+        there (with its future). Chunks already recorded for the destination
+        are never uploaded again.
+        '''
+
+        chunk_paths = [remote_path for encrypted_path, remote_path in artifacts if remote_path.startswith(chunk_folder() + '/')]
+
+        stored = set()
+
+        for start in range(0, len(chunk_paths), LEDGER_QUERY_BATCH_SIZE):
+            stored.update(BackupArtifact.objects.filter(destination=destination_label(destination), path__in=chunk_paths[start:start + LEDGER_QUERY_BATCH_SIZE]).values_list('path', flat=True))
+
+        to_send = []
+        queued = []
+
+        for encrypted_path, remote_path in artifacts:
+            if remote_path in stored:
+                continue
+
+            if remote_path in destination_chunks:
+                queued.append((encrypted_path, remote_path, destination_chunks[remote_path][1]))
+            else:
+                to_send.append((encrypted_path, remote_path))
+
+        return to_send, queued
+
+    def transmit_artifact(self, backup_destination, status, encrypted_path, remote_path): # pylint: disable=no-self-use
+        retries = getattr(settings, 'SIMPLE_BACKUP_TRANSMIT_RETRIES', DEFAULT_TRANSMIT_RETRIES)
+
+        attempt = 0
+
+        while True:
+            try:
+                backup_destination.transmit(encrypted_path, remote_path)
+
+                break
+            except Exception as exception: # pylint: disable=broad-except
+                attempt += 1
+
+                if attempt > retries:
+                    raise
+
+                six.print_('Retrying %s on %s (attempt %d of %d): %s' % (remote_path, status['destination'], attempt, retries, exception))
+                sys.stdout.flush()
+
+                time.sleep(2 ** attempt)
+
+        status['files'] += 1
+        status['bytes'] += os.path.getsize(encrypted_path)
+        status['transmitted'].append((encrypted_path, remote_path))
+
+    def transmit_artifacts(self, destination, artifacts, queued=()):
+        status = {
+            'destination': destination,
+            'success': False,
+            'files': 0,
+            'bytes': 0,
+            'seconds': 0,
+            'error': None,
+            'transmitted': [],
+        }
+
+        start_time = time.time()
+
+        try:
+            backup_destination = destination_for_url(destination)
 
-                                client.files_upload(box.encrypt(backup_io.read()), dropbox_path)
-                    elif destination_url.scheme == 's3':
-                        aws_config = Config(
-                            region_name=settings.SIMPLE_BACKUP_AWS_REGION,
-                            retries={'max_attempts': 10, 'mode': 'standard'}
-                        )
+            if backup_destination is None:
+                raise ValueError('Unknown destination: ' + destination)
 
-                        os.environ['AWS_ACCESS_KEY_ID'] = settings.SIMPLE_BACKUP_AWS_ACCESS_KEY_ID
-                        os.environ['AWS_SECRET_ACCESS_KEY'] = settings.SIMPLE_BACKUP_AWS_SECRET_ACCESS_KEY
+            status['destination'] = destination_label(destination)
 
-                        client = boto3.client('s3', config=aws_config)
+            chunk_prefix = chunk_folder() + '/'
 
-                        s3_bucket = destination_url.netloc
+            for encrypted_path, remote_path in artifacts:
+                if remote_path.startswith(chunk_prefix):
+                    self.transmit_artifact(backup_destination, status, encrypted_path, remote_path)
 
-                        for path in to_transmit:
-                            box = SecretBox(key)
+            # Chunks an earlier transmission carries count once it succeeds -
+            # those it failed to deliver are uploaded here instead.
 
-                            with open(path, 'rb') as backup_file:
-                                backup_io = BytesIO()
-                                backup_io.write(backup_file.read())
-                                backup_io.seek(0)
+            for encrypted_path, remote_path, future in queued:
+                if future.result()['success'] is False:
+                    self.transmit_artifact(backup_destination, status, encrypted_path, remote_path)
 
-                                filename = os.path.basename(path) + '.encrypted'
+            # Every chunk has landed before any manifest listing it.
 
-                                final_folder = self.folder_for_options(options)
+            backup_destination.commit()
 
-                                final_filename = final_folder + '/' + filename
+            for encrypted_path, remote_path in artifacts:
+                if remote_path.startswith(chunk_prefix) is False:
+                    self.transmit_artifact(backup_destination, status, encrypted_path, remote_path)
 
-                                six.print_('Uploading to S3: ' + final_filename)
-                                sys.stdout.flush()
+            backup_destination.commit()
 
-                                client.put_object(Body=box.encrypt(backup_io.read()), Bucket=s3_bucket, Key=final_filename)
-                    else:
-                        six.print_('Unknown destination: ' + destination)
+            status['success'] = True
+        except Exception as exception: # pylint: disable=broad-except
+            status['error'] = '%s: %s' % (type(exception).__name__, exception)
 
-                for path in to_transmit:
-                    os.remove(path)
+        status['seconds'] = time.time() - start_time
 
-            except ImportError:
-                pass
-            except AttributeError:
-                pass
+        return status
@@ -1,15 +1,60 @@
 # pylint: disable=no-member,line-too-long,superfluous-parens
 
 import datetime
+import time
+
+from concurrent.futures import ProcessPoolExecutor
 
 import pytz
+import six
 
+from django import db
 from django.conf import settings
 from django.core import management
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from ...decorators import handle_lock
 
+from . import incremental_backup
+
+def backup_window(arguments):
+    command = incremental_backup.Command()
+
+    start_time = time.time()
+
+    error = None
+
+    try:
+        management.call_command(command, *arguments)
+    except Exception as exception: # pylint: disable=broad-except
+        error = '%s: %s' % (type(exception).__name__, exception)
+
+    summary = {
+        'start_date': arguments[1],
+        'end_date': arguments[3],
+        'seconds': time.time() - start_time,
+        'files': 0,
+        'bytes': 0,
+        'status': 'skipped (window locked by another process)',
+    }
+
+    report = getattr(command, 'backup_report', None)
+
+    if report is not None:
+        summary['files'] = report['files']
+        summary['bytes'] = report['bytes']
+        summary['status'] = 'ok' if report['success'] else 'failed'
+
+    if error is not None:
+        summary['status'] = 'failed (%s)' % error
+
+    return summary
+
+def pooled_backup_window(arguments):
+    incremental_backup.prepare_worker()
+
+    return backup_window(arguments)
+
 class Command(BaseCommand):
     help = 'Executes sequential incremental backups.'
 
@@ -37,9 +82,28 @@ class Command(BaseCommand):
                             action='store_true',
                             help='Filter sensitive data from the backup data points written')
 
+        parser.add_argument('--parallel',
+                            dest='parallel',
+                            default=1,
+                            type=int,
+                            help='Number of backup windows to run at once in separate processes')
+
+        parser.add_argument('--resume',
+                            dest='resume',
+                            action='store_true',
+                            help='Skip apps and destinations already recorded as transmitted for each window')
+
 
     @handle_lock
-    def handle(self, *args, **options):
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
+        if options['parallel'] > 1:
+            # Without a creation date, a high-water mark range depends on the windows before it.
+
+            unbounded = [declaration['model'] for declaration in getattr(settings, 'SIMPLE_BACKUP_INCREMENTAL_MODELS', ()) if 'high_water_mark' in declaration and 'created_field' not in declaration]
+
+            if unbounded:
+                raise CommandError('--parallel needs a "created_field" in the SIMPLE_BACKUP_INCREMENTAL_MODELS declarations of high-water mark models: %s.' % ', '.join(unbounded))
+
         here_tz = pytz.timezone(settings.TIME_ZONE)
 
         components = options['start_date'].split('-')
@@ -50,6 +114,8 @@ class Command(BaseCommand):
 
         end_date = datetime.datetime(int(components[0]), int(components[1]), int(components[2]), 0, 0, 0, 0, here_tz).date()
 
+        windows = []
+
         while start_date <= end_date:
             local_end_date = start_date + datetime.timedelta(days=(options['window_days'] - 1))
 
@@ -65,6 +131,40 @@ class Command(BaseCommand):
             if options['filter_sensitive'] is not None and options['filter_sensitive'] is not False:
                 arguments.append('--filter-sensitive-data')
 
-            management.call_command('incremental_backup', *arguments)
+            if options['resume']:
+                arguments.append('--resume')
+
+            windows.append(arguments)
 
             start_date = local_end_date + datetime.timedelta(days=1)
+
+        summaries = []
+
+        if options['parallel'] <= 1:
+            for arguments in windows:
+                summaries.append(backup_window(arguments))
+        else:
+            # Forked workers must not share the parent's database connections.
+
+            db.connections.close_all()
+
+            with ProcessPoolExecutor(max_workers=options['parallel']) as executor:
+                summaries = list(executor.map(pooled_backup_window, windows))
+
+        total_seconds = 0
+        total_bytes = 0
+
+        six.print_('')
+
+        for summary in summaries:
+            six.print_('%s__%s: %s - %d file(s), %d bytes in %.2f seconds' % (summary['start_date'], summary['end_date'], summary['status'], summary['files'], summary['bytes'], summary['seconds']))
+
+            total_seconds += summary['seconds']
+            total_bytes += summary['bytes']
+
+        six.print_('%d window(s), %d bytes, %.2f seconds of backup time.' % (len(summaries), total_bytes, total_seconds))
+
+        failed = [summary for summary in summaries if summary['status'].startswith('failed')]
+
+        if failed:
+            raise CommandError('%d of %d backup window(s) failed.' % (len(failed), len(summaries)))
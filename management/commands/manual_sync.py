@@ -1,23 +1,187 @@
 # pylint: disable=no-member,line-too-long,invalid-name
 
 import importlib
+import io
 import os
 import sys
+import threading
+import time
 import traceback
 import urllib
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from django.core.management.base import BaseCommand
 
+try:
+    from ...destinations import DESTINATION_CLASSES, destination_for_url
+except (ImportError, ValueError): # Run as a standalone script, outside the app.
+    DESTINATION_CLASSES = {}
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_CHUNK_SIZE = 8
+
+class CountingReader(object): # pylint: disable=useless-object-inheritance, too-few-public-methods
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+
+        self.bytes_read += len(data)
+
+        return data
+
+class RateLimiter(object): # pylint: disable=useless-object-inheritance, too-few-public-methods
+    '''
+    Spaces out request starts across all workers so that no more than
+    rate requests per second are issued to the providers.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+
+            delay = self.next_start - now
+
+            self.next_start = max(now, self.next_start) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+class DestinationStorage(object): # pylint: disable=useless-object-inheritance
+    '''
+    Presents a SIMPLE_BACKUP_DESTINATIONS backend (destinations.py) with the
+    interface of the storage modules, so every scheme the backups write to
+    can be synced from or to, sharing its pooled client across workers.
+    '''
+
+    def __init__(self, url):
+        self.destination = destination_for_url(url)
+
+    def list_files(self, source): # pylint: disable=unused-argument
+        return list(self.destination.list_files())
+
+    def open_read(self, source, path): # pylint: disable=unused-argument
+        return self.destination.open_read(path), 'application/octet-stream'
+
+    def fetch_content(self, source, path):
+        stream, file_type = self.open_read(source, path)
+
+        try:
+            return stream.read(), file_type
+        finally:
+            stream.close()
+
+    def create_sync_request(self, file_list, destination): # pylint: disable=unused-argument
+        # One listing of the destination instead of a request per file.
+
+        stored = dict((item['name'], item) for item in self.destination.list_files())
+
+        return [file_item['name'] for file_item in file_list if self.destination.needs_update(stored.get(file_item['name'], None), file_item.get('size', None), file_item.get('updated', None), file_item.get('fingerprint', None))]
+
+    def upload_stream(self, destination, file_path, stream, file_type, chunk_size=None, fingerprint=None): # pylint: disable=unused-argument, too-many-arguments, too-many-positional-arguments, bad-option-value
+        self.destination.write_stream(stream, file_path, fingerprint=fingerprint)
+
+        return file_path
+
+    def upload_content(self, destination, file_path, file_content, file_type, fingerprint=None): # pylint: disable=too-many-arguments, too-many-positional-arguments, bad-option-value
+        return self.upload_stream(destination, file_path, io.BytesIO(file_content), file_type, fingerprint=fingerprint)
+
+def storage_for_url(url, *functions):
+    '''
+    Returns the storage module for a URL's scheme if it provides any of
+    functions, falling back to the destination backend registered for the
+    scheme.
+    '''
+
+    module_name = url.scheme.replace('-', '_')
+
+    storage_module = None
+
+    try:
+        storage_module = importlib.import_module('storage.%s' % module_name)
+    except ImportError:
+        try:
+            if __package__:
+                storage_module = importlib.import_module('...storage.%s' % module_name, __package__)
+        except ImportError:
+            pass
+
+    if storage_module is not None and any(hasattr(storage_module, function) for function in functions):
+        return storage_module
+
+    if url.scheme in DESTINATION_CLASSES:
+        return DestinationStorage(url.geturl())
+
+    if storage_module is None:
+        raise ImportError('No storage backend for %s:// URLs.' % url.scheme)
+
+    return storage_module
+
+def parse_arguments(args):
+    positional = []
+    options = {
+        'concurrency': DEFAULT_CONCURRENCY,
+        'retries': DEFAULT_RETRIES,
+        'rate_limit': DEFAULT_RATE_LIMIT,
+        'chunk_size': DEFAULT_CHUNK_SIZE,
+    }
+
+    value_options = {
+        '--concurrency': ('concurrency', int),
+        '--retries': ('retries', int),
+        '--rate-limit': ('rate_limit', float),
+        '--chunk-size': ('chunk_size', int),
+    }
+
+    index = 0
+
+    while index < len(args):
+        arg = args[index]
+
+        name, _, value = arg.partition('=')
+
+        if name in value_options:
+            if value == '':
+                index += 1
+                value = args[index] if index < len(args) else ''
+
+            option_name, option_type = value_options[name]
+
+            options[option_name] = option_type(value)
+        else:
+            positional.append(arg)
+
+        index += 1
+
+    return positional, options
+
 class Command(BaseCommand):
     help = 'Executes sequential incremental backups.'
 
-    def handle(self, *args, **options): # pylint: disable=too-many-locals
+    def handle(self, *args, **options): # pylint: disable=too-many-locals, too-many-statements, too-many-branches
+        args, sync_options = parse_arguments(args)
+
         if '--help' in args or len(args) < 3:
-            print('Usage: manual_sync.py <source> <destination>')
+            print('Usage: manual_sync.py [options] <source> <destination>')
             print('')
             print('         <source>: Source of files in URL format: e.g. s3://my-s3-bucket/')
             print('    <destination>: Files\' destination  in URL format: e.g. google-drive://GOOGLE-FOLDER-ID/')
             print('')
+            print('  --concurrency N: Number of files transferred at once (default: %d)' % DEFAULT_CONCURRENCY)
+            print('      --retries N: Attempts per file after the first failure (default: %d)' % DEFAULT_RETRIES)
+            print('   --rate-limit N: Maximum transfers started per second (default: %s)' % DEFAULT_RATE_LIMIT)
+            print('   --chunk-size N: Megabytes held in memory per streamed transfer (default: %d)' % DEFAULT_CHUNK_SIZE)
+            print('')
 
             sys.exit(0)
 
@@ -37,44 +201,134 @@ class Command(BaseCommand):
         source_url = urllib.parse.urlparse(source)
         destination_url = urllib.parse.urlparse(destination)
 
-        source_module = importlib.import_module('storage.%s' % source_url.scheme.replace('-', '_'))
-        destination_module = importlib.import_module('storage.%s' % destination_url.scheme.replace('-', '_'))
+        source_module = storage_for_url(source_url, 'iterate_files', 'list_files')
+        destination_module = storage_for_url(destination_url, 'create_sync_request')
+
+        # Sources that can list incrementally hand over a generator (newest
+        # folders first) instead of one sorted list of every file.
 
         try:
-            source_list = source_module.list_files(source)
+            if hasattr(source_module, 'iterate_files'):
+                source_list = source_module.iterate_files(source)
+            else:
+                source_list = source_module.list_files(source)
+
+                source_list.sort(key=lambda item: item.get('updated', None), reverse=True)
         except: # pylint: disable=bare-except
             print('Error fetching files from %s.' % source)
             traceback.print_exc()
 
             sys.exit(1)
 
-        source_list.sort(key=lambda item: item.get('updated', None), reverse=True)
+        # Content fingerprints reported by the source are stored with each
+        # upload so later syncs can recognize identical files.
+
+        fingerprints = {}
+
+        def remember_fingerprints(file_list):
+            for file_item in file_list:
+                if file_item.get('fingerprint', None) is not None:
+                    fingerprints[file_item['name']] = file_item['fingerprint']
+
+                yield file_item
 
         try:
-            request_list = destination_module.create_sync_request(source_list, destination)
+            request_list = destination_module.create_sync_request(remember_fingerprints(source_list), destination)
         except: # pylint: disable=bare-except
             print('Error building sync request files from %s.' % destination)
             traceback.print_exc()
 
             sys.exit(1)
 
-        request_index = 1
+        rate_limiter = RateLimiter(sync_options['rate_limit'])
+
+        # Pipe content through in chunks when both ends support streaming.
+
+        streaming = hasattr(source_module, 'open_read') and hasattr(destination_module, 'upload_stream')
+
+        chunk_size = sync_options['chunk_size'] * 1024 * 1024
+
+        def transfer_item(request_item):
+            upload_options = {}
+
+            if request_item in fingerprints:
+                upload_options['fingerprint'] = fingerprints[request_item]
+
+            if streaming:
+                stream, file_type = source_module.open_read(source, request_item)
+
+                reader = CountingReader(stream)
+
+                try:
+                    identifier = destination_module.upload_stream(destination, request_item, reader, file_type, chunk_size=chunk_size, **upload_options)
+                finally:
+                    stream.close()
+
+                return identifier, reader.bytes_read
 
-        for request_item in request_list:
             file_content, file_type = source_module.fetch_content(source, request_item)
 
-            try:
-                if destination_module.upload_content(destination, request_item, file_content, file_type) is not None:
-                    print('Synced %s... (%s of %s)' % (request_item, request_index, len(request_list)))
-                else:
-                    print('Error syncing %s... (%s of %s)' % (request_item, request_index, len(request_list)))
-            except: # pylint: disable=bare-except
-                print('Error syncing %s from %s to %s.' % (request_item, source_url.scheme, destination_url.scheme))
-                traceback.print_exc()
+            return destination_module.upload_content(destination, request_item, file_content, file_type, **upload_options), len(file_content)
+
+        def sync_item(request_item):
+            attempt = 0
+
+            while True:
+                rate_limiter.wait()
+
+                try:
+                    identifier, transferred = transfer_item(request_item)
+
+                    if identifier is None:
+                        raise ValueError('No identifier returned for uploaded file.')
+
+                    return transferred
+                except: # pylint: disable=bare-except
+                    attempt += 1
+
+                    if attempt > sync_options['retries']:
+                        raise
+
+                    time.sleep(2 ** attempt)
+
+        start_time = time.time()
+
+        synced_count = 0
+        synced_bytes = 0
+        failed = []
 
-                sys.exit(1)
+        with ThreadPoolExecutor(max_workers=max(1, sync_options['concurrency'])) as executor:
+            futures = {}
 
-            request_index += 1
+            for request_item in request_list:
+                futures[executor.submit(sync_item, request_item)] = request_item
+
+            for future in as_completed(futures):
+                request_item = futures[future]
+
+                try:
+                    synced_bytes += future.result()
+                    synced_count += 1
+
+                    print('Synced %s... (%s of %s)' % (request_item, synced_count + len(failed), len(request_list)))
+                except: # pylint: disable=bare-except
+                    failed.append(request_item)
+
+                    print('Error syncing %s from %s to %s. (%s of %s)' % (request_item, source_url.scheme, destination_url.scheme, synced_count + len(failed), len(request_list)))
+                    traceback.print_exc()
+
+        elapsed = max(time.time() - start_time, 0.000001)
+
+        print('')
+        print('Synced %d file(s), %.1f MB in %.1f seconds (%.2f files/s, %.2f MB/s).' % (synced_count, synced_bytes / (1024.0 * 1024.0), elapsed, synced_count / elapsed, synced_bytes / (1024.0 * 1024.0) / elapsed))
+
+        if failed:
+            print('Failed to sync %d file(s):' % len(failed))
+
+            for request_item in failed:
+                print('  %s' % request_item)
+
+            sys.exit(1)
 
 if __name__ == '__main__':
     from dotenv import load_dotenv
@@ -0,0 +1,77 @@
+# pylint: disable=no-member,line-too-long
+
+import base64
+import datetime
+import shutil
+import tempfile
+
+import six
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...archives import parse_date
+from ...decorators import handle_lock
+from ...destinations import destination_for_url, destination_label
+from ...retention import catalogued_windows, delete_superseded, prune_cutoff, prune_windows
+
+class Command(BaseCommand):
+    help = 'Deletes backup windows past the monthly retention horizon (see SIMPLE_BACKUP_RETENTION).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destination',
+                            type=str,
+                            dest='destinations',
+                            action='append',
+                            default=None,
+                            help='Destination to prune, in SIMPLE_BACKUP_DESTINATIONS URL format (default: every configured destination; may be repeated)')
+
+        parser.add_argument('--today',
+                            type=str,
+                            dest='today',
+                            default=None,
+                            help='Date retention horizons are counted back from (default: today)')
+
+        parser.add_argument('--dry-run',
+                            dest='dry_run',
+                            action='store_true',
+                            help='Only report the windows that would be deleted')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        key = base64.b64decode(settings.SIMPLE_BACKUP_KEY)
+
+        today = parse_date(options['today']) if options['today'] is not None else datetime.date.today()
+
+        cutoff = prune_cutoff(today)
+
+        destinations = options['destinations'] or getattr(settings, 'SIMPLE_BACKUP_DESTINATIONS', [])
+
+        for destination_url in destinations:
+            destination = destination_for_url(destination_url)
+
+            if destination is None:
+                raise CommandError('Unknown destination: %s' % destination_label(destination_url))
+
+            label = destination_label(destination_url)
+
+            expired = [window for window in catalogued_windows(label) if window[1] < cutoff]
+
+            if not expired:
+                six.print_('%s: nothing ends before %s.' % (label, cutoff))
+
+                continue
+
+            six.print_('%s: deleting %d window(s) ending before %s: %s' % (label, len(expired), cutoff, ', '.join('%s__%s' % window for window in expired)))
+
+            if options['dry_run']:
+                continue
+
+            staging = tempfile.mkdtemp(prefix='simple_backup_prune_', dir=getattr(settings, 'SIMPLE_BACKUP_STAGING_DESTINATION', tempfile.gettempdir()))
+
+            try:
+                deleted = delete_superseded(key, destination, label, prune_windows(label, cutoff), staging)
+
+                six.print_('%s: deleted %d object(s).' % (label, deleted))
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,328 @@
+# pylint: disable=no-member,line-too-long
+
+import base64
+import datetime
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import six
+
+import django
+
+from django.apps import apps
+from django.conf import settings
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from ...archives import artifact_window, fetch_artifact, iter_records, parse_date
+from ...backup_api import dependency_order
+from ...catalog import restore_plan
+from ...deduplication import chunk_folder
+from ...decorators import handle_lock
+from ...destinations import destination_for_url, destination_label
+
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_BATCH_SIZE = 1000
+
+def bulk_options(model, connection):
+    # Upserts (Django 4.1+, where the database supports them) let later windows overwrite rows in bulk.
+
+    features = connection.features
+
+    if django.VERSION >= (4, 1) and getattr(features, 'supports_update_conflicts', False):
+        update_fields = [field.name for field in model._meta.concrete_fields if not field.primary_key] # pylint: disable=protected-access
+
+        if update_fields:
+            options = {
+                'update_conflicts': True,
+                'update_fields': update_fields,
+            }
+
+            if getattr(features, 'supports_update_conflicts_with_target', False):
+                options['unique_fields'] = [model._meta.pk.name] # pylint: disable=protected-access
+
+            return options
+
+    return None
+
+def stamps_saves(model):
+    # auto_now and auto_now_add fields are set to the current time on every (bulk) insert that is not raw.
+
+    return any(getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False) for field in model._meta.concrete_fields) # pylint: disable=protected-access
+
+def insert_batch(model, batch):
+    '''
+    Inserts a batch of deserialized objects of one model, and their
+    many-to-many rows. Runs within the restore's transaction.
+    '''
+
+    connection = connections[DEFAULT_DB_ALIAS]
+
+    if model._meta.parents or stamps_saves(model): # pylint: disable=protected-access
+        # bulk_create does not support multi-table inheritance, and would
+        # replace backed-up auto_now(_add) values with the restore time. Raw
+        # saves keep every field as it was dumped, as loaddata does.
+
+        for deserialized in batch:
+            deserialized.save()
+
+        return
+
+    options = bulk_options(model, connection)
+
+    objects = [deserialized.object for deserialized in batch]
+
+    if options is None:
+        # Without upserts, rows already present are updated one at a time
+        # so later windows still overwrite earlier ones, and only new
+        # rows are inserted in bulk.
+
+        existing = set(model._base_manager.filter(pk__in=[obj.pk for obj in objects if obj.pk is not None]).values_list('pk', flat=True)) # pylint: disable=protected-access
+
+        for obj in objects:
+            if obj.pk in existing:
+                obj.save_base(raw=True)
+
+        objects = [obj for obj in objects if obj.pk not in existing]
+
+        options = {}
+
+    model._base_manager.bulk_create(objects, **options) # pylint: disable=protected-access
+
+    for field in model._meta.many_to_many: # pylint: disable=protected-access
+        through = field.remote_field.through
+
+        if not through._meta.auto_created: # pylint: disable=protected-access
+            continue # Explicit through models are dumped as models of their own.
+
+        source_field = field.m2m_field_name() + '_id'
+        target_field = field.m2m_reverse_field_name() + '_id'
+
+        owners = [deserialized.object.pk for deserialized in batch if field.name in deserialized.m2m_data]
+
+        if not owners:
+            continue
+
+        through._base_manager.filter(**{source_field + '__in': owners}).delete() # pylint: disable=protected-access
+
+        through_rows = []
+
+        for deserialized in batch:
+            for value in deserialized.m2m_data.get(field.name, []):
+                through_rows.append(through(**{source_field: deserialized.object.pk, target_field: value}))
+
+        through._base_manager.bulk_create(through_rows) # pylint: disable=protected-access
+
+class Command(BaseCommand):
+    help = 'Restores backed-up data from a destination into the database, in a single transaction. Rows from later windows overwrite rows already present: in bulk upserts on Django 4.1 and later (where the database supports them), otherwise by updating each existing row individually, which is slower when restoring over existing data. Models with auto_now or auto_now_add fields are always saved row by row, so those fields keep their backed-up values.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('destination',
+                            type=str,
+                            help='Destination holding the backups, in SIMPLE_BACKUP_DESTINATIONS URL format')
+
+        parser.add_argument('--start-date',
+                            type=str,
+                            dest='start_date',
+                            default=None,
+                            help='Restore backup windows ending on or after this date')
+
+        parser.add_argument('--end-date',
+                            type=str,
+                            dest='end_date',
+                            default=None,
+                            help='Restore backup windows starting on or before this date')
+
+        parser.add_argument('--workers',
+                            type=int,
+                            dest='workers',
+                            default=DEFAULT_FETCH_WORKERS,
+                            help='Number of artifacts fetched and decrypted concurrently')
+
+        parser.add_argument('--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=DEFAULT_BATCH_SIZE,
+                            help='Number of rows inserted per bulk insert')
+
+        parser.add_argument('--list',
+                            dest='list',
+                            action='store_true',
+                            help='Find backups by listing the destination instead of using the backup catalog')
+
+        parser.add_argument('--app',
+                            type=str,
+                            dest='apps',
+                            action='append',
+                            default=None,
+                            help='Only restore models of this app (may be repeated)')
+
+    @handle_lock
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
+        key = base64.b64decode(settings.SIMPLE_BACKUP_KEY)
+
+        destination = destination_for_url(options['destination'])
+
+        if destination is None:
+            raise CommandError('Unknown destination: %s' % destination_label(options['destination']))
+
+        start_date = parse_date(options['start_date']) if options['start_date'] is not None else datetime.date.min
+        end_date = parse_date(options['end_date']) if options['end_date'] is not None else datetime.date.max
+
+        # The backup catalog answers from the database; destinations without
+        # catalog entries (or with --list) are listed instead.
+
+        artifacts = []
+
+        if options['list'] is False:
+            for artifact in restore_plan(destination_label(options['destination']), start_date, end_date):
+                artifacts.append(((artifact.start_date, artifact.end_date), artifact.path))
+
+        if not artifacts:
+            artifacts = self.listed_artifacts(destination, start_date, end_date)
+
+        if not artifacts:
+            raise CommandError('No backups found at %s between %s and %s.' % (destination.label(), start_date, end_date))
+
+        six.print_('Restoring %d artifact(s) from %s...' % (len(artifacts), destination.label()))
+
+        staging = tempfile.mkdtemp(prefix='simple_backup_restore_', dir=getattr(settings, 'SIMPLE_BACKUP_STAGING_DESTINATION', tempfile.gettempdir()))
+
+        start_time = time.time()
+
+        try:
+            fetched = []
+
+            with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+                futures = dict((executor.submit(self.fetch_artifact, key, options['destination'], remote_path, staging), (window, remote_path)) for window, remote_path in artifacts)
+
+                for future in as_completed(futures):
+                    window, remote_path = futures[future]
+
+                    path, encrypted = future.result()
+
+                    fetched.append((window, remote_path, path, encrypted))
+
+            fetch_seconds = time.time() - start_time
+
+            six.print_('Fetched %d artifact(s) in %.2f seconds.' % (len(fetched), fetch_seconds))
+
+            # Older windows first, and within a window the files whose first
+            # model has the fewest dependencies first.
+
+            model_rank = dict((model, index) for index, model in enumerate(dependency_order(apps.get_models())))
+
+            plan = sorted(fetched, key=lambda item: (item[0], self.file_rank(key, item[2], item[3], model_rank), item[1]))
+
+            row_count = 0
+
+            connection = connections[DEFAULT_DB_ALIAS]
+
+            loaded_models = set()
+
+            # One transaction for the whole load, as loaddata uses: rows may
+            # reference rows of later batches, and databases that cannot turn
+            # constraint checks off (PostgreSQL) only check deferred foreign
+            # keys on commit.
+
+            with transaction.atomic():
+                with connection.constraint_checks_disabled():
+                    for window, remote_path, path, encrypted in plan: # pylint: disable=unused-variable
+                        rows = self.load_artifact(key, path, encrypted, options, loaded_models)
+
+                        six.print_('Loaded %d row(s) from %s' % (rows, remote_path))
+
+                        row_count += rows
+
+                connection.check_constraints(table_names=[model._meta.db_table for model in loaded_models]) # pylint: disable=protected-access
+
+                # Rows keep their original primary keys - move sequences past them.
+
+                sequence_sql = connection.ops.sequence_reset_sql(no_style(), list(loaded_models))
+
+                if sequence_sql:
+                    with connection.cursor() as cursor:
+                        for line in sequence_sql:
+                            cursor.execute(line)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        seconds = max(time.time() - start_time, 0.000001)
+
+        six.print_('Restored %d row(s) in %.2f seconds (%.0f rows/s).' % (row_count, seconds, row_count / seconds))
+
+    def listed_artifacts(self, destination, start_date, end_date): # pylint: disable=no-self-use
+        chunk_prefix = chunk_folder() + '/'
+
+        artifacts = []
+
+        for remote_path in destination.list_paths():
+            window = artifact_window(remote_path)
+
+            if window is None or remote_path.startswith(chunk_prefix) or remote_path.endswith('.encrypted') is False:
+                continue
+
+            if window[1] >= start_date and window[0] <= end_date:
+                artifacts.append((window, remote_path))
+
+        return artifacts
+
+    def fetch_artifact(self, key, destination_url, remote_path, staging): # pylint: disable=no-self-use
+        # Each worker uses its own destination client.
+
+        return fetch_artifact(key, destination_for_url(destination_url), remote_path, staging)
+
+    def file_rank(self, key, path, encrypted, model_rank): # pylint: disable=no-self-use
+        # Only the first record is read - the file is parsed in full when loaded.
+
+        records = iter_records(key, path, encrypted)
+
+        try:
+            record = next(records, None)
+        finally:
+            records.close()
+
+        if record is not None:
+            try:
+                return model_rank.get(apps.get_model(record['model']), len(model_rank))
+            except LookupError:
+                pass
+
+        return len(model_rank)
+
+    def load_artifact(self, key, path, encrypted, options, loaded_models): # pylint: disable=no-self-use, too-many-arguments, too-many-positional-arguments, bad-option-value
+        records = iter_records(key, path, encrypted)
+
+        if options['apps']:
+            records = (record for record in records if record['model'].split('.')[0] in options['apps'])
+
+        batch = []
+        batch_model = None
+
+        rows = 0
+
+        for deserialized in serializers.deserialize('python', records, ignorenonexistent=True):
+            model = type(deserialized.object)
+
+            if batch and (model != batch_model or len(batch) >= options['batch_size']):
+                insert_batch(batch_model, batch)
+
+                batch = []
+
+            batch_model = model
+
+            batch.append(deserialized)
+
+            loaded_models.add(model)
+
+            rows += 1
+
+        if batch:
+            insert_batch(batch_model, batch)
+
+        return rows
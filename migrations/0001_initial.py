@@ -0,0 +1,32 @@
+# pylint: skip-file
+# Generated by Django 5.2.18 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('app', models.CharField(max_length=1024)),
+                ('destination', models.CharField(max_length=1024)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('path', models.CharField(max_length=4096)),
+                ('size', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=128)),
+                ('transmitted', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start_date', 'end_date', 'app'], name='simple_back_start_d_183c9b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# pylint: skip-file
+# Generated by Django 5.2.18 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_backup', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DumpWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=1024)),
+                ('field', models.CharField(max_length=1024)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('start_value', models.BigIntegerField(blank=True, null=True)),
+                ('end_value', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('model', 'field', 'start_date', 'end_date')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# pylint: skip-file
+# Generated by Django 5.2.18 on 2026-10-18 13:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_backup', '0002_dump_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupArtifactRange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=1024)),
+                ('row_count', models.BigIntegerField()),
+                ('min_pk', models.BigIntegerField(blank=True, null=True)),
+                ('max_pk', models.BigIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='backupartifact',
+            name='codec',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='backupartifact',
+            name='row_count',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='backupartifact',
+            index=models.Index(fields=['destination', 'end_date'], name='simple_back_destina_367159_idx'),
+        ),
+        migrations.AddField(
+            model_name='backupartifactrange',
+            name='artifact',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranges', to='simple_backup.backupartifact'),
+        ),
+        migrations.AddIndex(
+            model_name='backupartifactrange',
+            index=models.Index(fields=['model', 'min_pk', 'max_pk'], name='simple_back_model_6f0b7b_idx'),
+        ),
+    ]
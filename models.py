@@ -1,15 +1,21 @@
 # pylint: disable=line-too-long
 
+import django
+
 from django.conf import settings
 from django.core.checks import Warning, register # pylint: disable=redefined-builtin
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
 
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
 
+from .compression import configured_codec
+
 @register()
-def check_backup_parameters(app_configs, **kwargs): # pylint: disable=unused-argument
+def check_backup_parameters(app_configs, **kwargs): # pylint: disable=unused-argument, too-many-branches
     errors = []
 
     if hasattr(settings, 'SIMPLE_BACKUP_DESTINATIONS') is False:
@@ -36,8 +42,99 @@ def check_backup_parameters(app_configs, **kwargs): # pylint: disable=unused-arg
                     warning = Warning('SIMPLE_BACKUP_AWS_REGION parameter not defined', hint='Update configuration to include SIMPLE_BACKUP_AWS_REGION.', obj=None, id='simple_backup.W012')
                     errors.append(warning)
 
+    try:
+        configured_codec()
+    except ImproperlyConfigured as error:
+        warning = Warning('SIMPLE_BACKUP_COMPRESSION is not usable: %s' % error, hint='Update SIMPLE_BACKUP_COMPRESSION or install the package for the selected codec.', obj=None, id='simple_backup.W003')
+        errors.append(warning)
+
+    dump_engine = getattr(settings, 'SIMPLE_BACKUP_DUMP_ENGINE', 'dumpdata')
+
+    if dump_engine not in ('dumpdata', 'native'):
+        warning = Warning('SIMPLE_BACKUP_DUMP_ENGINE "%s" is not a known engine.' % dump_engine, hint='Set SIMPLE_BACKUP_DUMP_ENGINE to "dumpdata" or "native".', obj=None, id='simple_backup.W004')
+        errors.append(warning)
+    elif dump_engine == 'native' and django.VERSION < (3, 2):
+        warning = Warning('SIMPLE_BACKUP_DUMP_ENGINE "native" writes JSON lines fixtures, which loaddata only reads from Django 3.2.', hint='Remove SIMPLE_BACKUP_DUMP_ENGINE or set it to "dumpdata".', obj=None, id='simple_backup.W004')
+        errors.append(warning)
+
     if hasattr(settings, 'SIMPLE_BACKUP_KEY') is False:
         warning = Warning('SIMPLE_BACKUP_KEY parameter not defined', hint='Update configuration to include SIMPLE_BACKUP_KEY.', obj=None, id='simple_backup.W002')
         errors.append(warning)
 
     return errors
+
+class BackupArtifact(models.Model):
+    '''
+    Ledger entry for an encrypted artifact transmitted to a destination.
+    Entries for an (app, destination) pair within a window are written
+    together once every artifact for that pair has been transmitted.
+    '''
+
+    class Meta: # pylint: disable=old-style-class, no-init, too-few-public-methods
+        indexes = [
+            models.Index(fields=['start_date', 'end_date', 'app']),
+            models.Index(fields=['destination', 'end_date']),
+        ]
+
+    app = models.CharField(max_length=1024)
+    destination = models.CharField(max_length=1024)
+
+    start_date = models.DateField()
+    end_date = models.DateField()
+
+    path = models.CharField(max_length=4096)
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=128)
+
+    codec = models.CharField(max_length=32, null=True, blank=True)
+    row_count = models.BigIntegerField(null=True, blank=True)
+
+    transmitted = models.DateTimeField()
+
+    def __str__(self):
+        return '%s (%s)' % (self.path, self.destination)
+
+class BackupArtifactRange(models.Model):
+    '''
+    Catalog entry for the rows of one model held by an artifact. Primary
+    key bounds are only recorded for integer keys.
+    '''
+
+    class Meta: # pylint: disable=old-style-class, no-init, too-few-public-methods
+        indexes = [
+            models.Index(fields=['model', 'min_pk', 'max_pk']),
+        ]
+
+    artifact = models.ForeignKey(BackupArtifact, related_name='ranges', on_delete=models.CASCADE)
+
+    model = models.CharField(max_length=1024)
+
+    row_count = models.BigIntegerField()
+
+    min_pk = models.BigIntegerField(null=True, blank=True)
+    max_pk = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return '%s: %s - %s' % (self.model, self.min_pk, self.max_pk)
+
+class DumpWatermark(models.Model):
+    '''
+    Range of a high-water mark field covered by an incremental dump of a
+    model for one window. Later windows continue from the highest end value
+    recorded before them.
+    '''
+
+    class Meta: # pylint: disable=old-style-class, no-init, too-few-public-methods
+        unique_together = (('model', 'field', 'start_date', 'end_date'),)
+
+    model = models.CharField(max_length=1024)
+    field = models.CharField(max_length=1024)
+
+    start_date = models.DateField()
+    end_date = models.DateField()
+
+    start_value = models.BigIntegerField(null=True, blank=True)
+    end_value = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return '%s.%s: %s - %s' % (self.model, self.field, self.start_value, self.end_value)
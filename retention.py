@@ -0,0 +1,348 @@
+# pylint: disable=no-member,line-too-long
+
+'''
+Grandfather-father-son retention for catalogued backup windows.
+
+SIMPLE_BACKUP_RETENTION sets how many days of daily windows, weeks of
+weekly archives and months of monthly archives are kept:
+
+    SIMPLE_BACKUP_RETENTION = {'daily': 14, 'weekly': 8, 'monthly': 12}
+
+Compaction merges windows that ended before the daily horizon into one
+archive per ISO week, and windows that ended before the weekly horizon
+into one archive per month (both keyed on the window end date). Within a
+merged period the newest full dump of each SIMPLE_BACKUP_DUMPDATA_APPS app
+supersedes the others and is copied on the storage side, so it is never
+downloaded. Incremental dumps (.json-incremental) only hold changes, so
+those are fetched and merged, keeping the last version of each row; merged
+files are uploaded whole, not deduplicated. Files written by other apps'
+backup_api modules may only hold their window's data, so compaction leaves
+them where they are. Pruning deletes windows that ended before the monthly
+horizon.
+
+Both work from the backup catalog (the BackupArtifact ledger). Superseded
+artifacts leave the catalog before they are deleted from storage, so a
+failed deletion leaves unreferenced objects rather than catalog entries
+pointing at nothing. Chunks of deduplicated backups that no remaining
+manifest lists are collected afterwards - run this when no backup is in
+progress, as a running backup may be about to reference them.
+'''
+
+import collections
+import datetime
+import io
+import json
+import os
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .archives import fetch_artifact, iter_records, window_folder
+from .backup_api import CompressedFixtureWriter, full_dump_stems
+from .catalog import CatalogStats, data_artifacts, file_checksum
+from .compression import codec_for_extension, configured_codec
+from .deduplication import MANIFEST_SUFFIX, chunk_folder, manifest_chunk_paths, read_manifest
+from .encryption import decrypt_file, encrypt_file
+from .models import BackupArtifact, BackupArtifactRange
+
+DEFAULT_RETENTION = {
+    'daily': 14,
+    'weekly': 8,
+    'monthly': 12,
+}
+
+INCREMENTAL_MARKER = '.json-incremental'
+
+DELETE_QUERY_BATCH_SIZE = 500
+
+def retention_policy():
+    policy = dict(DEFAULT_RETENTION)
+
+    policy.update(getattr(settings, 'SIMPLE_BACKUP_RETENTION', {}))
+
+    return policy
+
+def months_before(date, months):
+    # First day of the month the given number of months before date's month.
+
+    month_index = date.year * 12 + (date.month - 1) - months
+
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+def compaction_period(window, today, policy):
+    '''
+    Returns the period (('week', monday) or ('month', first day)) a window
+    belongs to once it has aged out of the daily tier, or None while it is
+    still kept as it is.
+    '''
+
+    end_date = window[1]
+
+    if end_date > today - datetime.timedelta(days=policy['daily']):
+        return None
+
+    if end_date > today - datetime.timedelta(weeks=policy['weekly']):
+        return ('week', end_date - datetime.timedelta(days=end_date.weekday()))
+
+    return ('month', end_date.replace(day=1))
+
+def compaction_plan(windows, today, policy=None):
+    '''
+    Groups windows into the periods they should be merged into. Returns
+    (period, windows) pairs, oldest first, for periods holding more than
+    one window.
+    '''
+
+    if policy is None:
+        policy = retention_policy()
+
+    periods = collections.OrderedDict()
+
+    for window in sorted(set(windows)):
+        period = compaction_period(window, today, policy)
+
+        if period is not None:
+            periods.setdefault(period, []).append(window)
+
+    return [(period, period_windows) for period, period_windows in periods.items() if len(period_windows) > 1]
+
+def prune_cutoff(today, policy=None):
+    # Windows ending before this date are past the monthly horizon.
+
+    if policy is None:
+        policy = retention_policy()
+
+    return months_before(today, policy['monthly'])
+
+def catalogued_windows(destination_label):
+    return sorted(set(data_artifacts().filter(destination=destination_label).values_list('start_date', 'end_date')))
+
+def compactable_windows(destination_label):
+    full_stems = full_dump_stems()
+
+    return sorted(set((start_date, end_date) for start_date, end_date, path in data_artifacts().filter(destination=destination_label).values_list('start_date', 'end_date', 'path') if is_compactable(path, full_stems)))
+
+def artifact_stem(remote_path):
+    # The file name without window folder, encryption, manifest or codec suffixes.
+
+    name = remote_path.split('/')[-1]
+
+    for suffix in ('.encrypted', MANIFEST_SUFFIX):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    codec = codec_for_extension(name)
+
+    if codec is not None:
+        name = name[:-len(codec.extension)]
+
+    return name
+
+def is_compactable(remote_path, full_stems):
+    # Only full dumps of whole apps and incremental change sets can be merged.
+
+    stem = artifact_stem(remote_path)
+
+    return stem in full_stems or INCREMENTAL_MARKER in stem
+
+def merge_incremental(key, destination, artifacts, stem, staging): # pylint: disable=too-many-locals
+    '''
+    Merges the records of incremental dumps, oldest first, keeping the last
+    version of each row. Returns the encrypted merged file, its codec and
+    its catalog statistics.
+    '''
+
+    records = collections.OrderedDict()
+
+    for artifact in artifacts:
+        local_path, encrypted = fetch_artifact(key, destination, artifact.path, os.path.join(staging, 'fetched'))
+
+        for record in iter_records(key, local_path, encrypted):
+            records[(record['model'].lower(), record.get('pk', None))] = record
+
+        os.remove(local_path)
+
+    codec = configured_codec()
+
+    merged_path = os.path.join(staging, stem + codec.extension)
+
+    stats = CatalogStats()
+
+    with io.open(merged_path, 'wb') as fixture_file:
+        writer = CompressedFixtureWriter(fixture_file, codec=codec)
+
+        writer.write('[')
+
+        for index, record in enumerate(records.values()):
+            if index > 0:
+                writer.write(',\n')
+
+            writer.write(json.dumps(record, ensure_ascii=False))
+
+            try:
+                label = apps.get_model(record['model'])._meta.label # pylint: disable=protected-access
+            except LookupError:
+                label = record['model']
+
+            stats.add(label, record.get('pk', None))
+
+        writer.write(']\n')
+
+        writer.close()
+
+    encrypt_file(key, merged_path, merged_path + '.encrypted')
+
+    os.remove(merged_path)
+
+    return merged_path + '.encrypted', codec, stats
+
+def compact_windows(key, destination, destination_label, windows, staging): # pylint: disable=too-many-locals
+    '''
+    Merges the catalogued artifacts of windows at a destination into one
+    archive spanning them. Returns the superseded remote paths, which are
+    already removed from the catalog and still need deleting from storage.
+    Artifacts other than full and incremental dumps are left untouched.
+    '''
+
+    # Oldest data first, so the last artifact of each file is the newest: a
+    # window ending later is newer whatever it starts on, and of windows
+    # ending together the narrower (a daily window next to an archive) is.
+
+    artifacts = list(data_artifacts().filter(destination=destination_label, start_date__in=[window[0] for window in windows]).order_by('end_date', 'start_date', 'transmitted', 'path'))
+
+    full_stems = full_dump_stems()
+
+    artifacts = [artifact for artifact in artifacts if (artifact.start_date, artifact.end_date) in windows and is_compactable(artifact.path, full_stems)]
+
+    start_date = min(window[0] for window in windows)
+    end_date = max(window[1] for window in windows)
+
+    folder = window_folder(start_date, end_date)
+
+    by_stem = collections.OrderedDict()
+
+    for artifact in artifacts:
+        by_stem.setdefault(artifact_stem(artifact.path), []).append(artifact)
+
+    created = []
+
+    for stem, stem_artifacts in by_stem.items():
+        newest = stem_artifacts[-1]
+
+        if INCREMENTAL_MARKER in stem and len(stem_artifacts) > 1:
+            encrypted_path, codec, stats = merge_incremental(key, destination, stem_artifacts, stem, staging)
+
+            remote_path = folder + '/' + os.path.basename(encrypted_path)
+
+            destination.transmit(encrypted_path, remote_path)
+
+            ranges = [BackupArtifactRange(model=model, row_count=entry['rows'], min_pk=entry['min_pk'], max_pk=entry['max_pk']) for model, entry in stats.models.items()]
+
+            created.append((BackupArtifact(app=newest.app, destination=destination_label, start_date=start_date, end_date=end_date, path=remote_path, size=os.path.getsize(encrypted_path), checksum=file_checksum(encrypted_path), codec=codec.name, row_count=stats.row_count()), ranges))
+
+            os.remove(encrypted_path)
+        else:
+            # A full dump holds everything the earlier ones in the period did
+            # (and a lone incremental dump is simply moved).
+
+            remote_path = folder + '/' + newest.path.split('/')[-1]
+
+            # The newest window may already span the whole period.
+
+            if remote_path != newest.path:
+                destination.copy(newest.path, remote_path)
+
+            ranges = [BackupArtifactRange(model=artifact_range.model, row_count=artifact_range.row_count, min_pk=artifact_range.min_pk, max_pk=artifact_range.max_pk) for artifact_range in newest.ranges.all()]
+
+            created.append((BackupArtifact(app=newest.app, destination=destination_label, start_date=start_date, end_date=end_date, path=remote_path, size=newest.size, checksum=newest.checksum, codec=newest.codec, row_count=newest.row_count), ranges))
+
+    destination.commit()
+
+    now = timezone.now()
+
+    new_paths = set(artifact.path for artifact, ranges in created)
+
+    with transaction.atomic():
+        for artifact, ranges in created:
+            artifact.transmitted = now
+            artifact.save()
+
+            for artifact_range in ranges:
+                artifact_range.artifact = artifact
+
+            BackupArtifactRange.objects.bulk_create(ranges)
+
+        forget_artifacts([artifact.pk for artifact in artifacts])
+
+    return [artifact.path for artifact in artifacts if artifact.path not in new_paths]
+
+def forget_artifacts(artifact_ids):
+    for start in range(0, len(artifact_ids), DELETE_QUERY_BATCH_SIZE):
+        BackupArtifact.objects.filter(pk__in=artifact_ids[start:start + DELETE_QUERY_BATCH_SIZE]).delete()
+
+def prune_windows(destination_label, cutoff):
+    '''
+    Removes the catalogued artifacts of windows that ended before cutoff
+    and returns their remote paths for deletion from storage.
+    '''
+
+    artifacts = list(data_artifacts().filter(destination=destination_label, end_date__lt=cutoff).values_list('pk', 'path'))
+
+    with transaction.atomic():
+        forget_artifacts([artifact_id for artifact_id, path in artifacts])
+
+    return [path for artifact_id, path in artifacts]
+
+def orphaned_chunks(key, destination, destination_label, staging):
+    '''
+    Removes catalogued chunks that no remaining manifest at the destination
+    lists and returns their remote paths for deletion from storage.
+    '''
+
+    chunks = list(BackupArtifact.objects.filter(destination=destination_label, path__startswith=chunk_folder() + '/').values_list('pk', 'path'))
+
+    if not chunks:
+        return []
+
+    referenced = set()
+
+    manifest_staging = os.path.join(staging, 'manifests')
+
+    for index, remote_path in enumerate(data_artifacts().filter(destination=destination_label, path__endswith=MANIFEST_SUFFIX + '.encrypted').values_list('path', flat=True)):
+        encrypted_path = os.path.join(manifest_staging, '%d.encrypted' % index)
+
+        if os.path.isdir(manifest_staging) is False:
+            os.makedirs(manifest_staging)
+
+        destination.fetch(remote_path, encrypted_path)
+
+        decrypt_file(key, encrypted_path, encrypted_path[:-len('.encrypted')])
+
+        referenced.update(manifest_chunk_paths(read_manifest(encrypted_path[:-len('.encrypted')])))
+
+        os.remove(encrypted_path)
+        os.remove(encrypted_path[:-len('.encrypted')])
+
+    orphans = [(artifact_id, path) for artifact_id, path in chunks if path not in referenced]
+
+    with transaction.atomic():
+        forget_artifacts([artifact_id for artifact_id, path in orphans])
+
+    return [path for artifact_id, path in orphans]
+
+def delete_superseded(key, destination, destination_label, remote_paths, staging):
+    '''
+    Deletes superseded artifacts from storage in bulk, followed by any
+    chunks that only deleted manifests referenced. Returns the number of
+    objects deleted.
+    '''
+
+    if any(remote_path.endswith(MANIFEST_SUFFIX + '.encrypted') for remote_path in remote_paths):
+        remote_paths = list(remote_paths) + orphaned_chunks(key, destination, destination_label, staging)
+
+    if remote_paths:
+        destination.delete(remote_paths)
+
+    return len(remote_paths)
@@ -1,8 +1,12 @@
 # pylint: disable=no-member, line-too-long
 
 import io
+import json
 import os
 import logging
+import tempfile
+import threading
+import time
 
 try:
     from urlparse import urlparse
@@ -15,51 +19,246 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaUpload
 
 logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
-CACHED_FOLDER_IDS = {}
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
 
-def find_folder(service, parent_id, path, child_components):
-    if path in CACHED_FOLDER_IDS:
-        return CACHED_FOLDER_IDS[path]
+DEFAULT_FOLDER_CACHE_TTL = 7 * 24 * 60 * 60
 
-    if len(child_components) == 0: # pylint: disable=len-as-condition
-        CACHED_FOLDER_IDS[path] = parent_id
+# Python 2 only has os.rename, which also replaces files atomically on POSIX.
 
-        return parent_id
+replace_file = getattr(os, 'replace', os.rename) # pylint: disable=invalid-name
 
-    child_component = child_components[0]
+# Guards credential loading and refreshes (token.json) across threads.
 
-    results = (service.files().list(q='"%s" in parents and name = "%s" and mimeType = "application/vnd.google-apps.folder"' % (parent_id, child_component), \
-                                    pageSize=100, fields='nextPageToken, files(id, name, size, parents, modifiedTime, mimeType)').execute())
+SERVICE_LOCK = threading.Lock()
+
+# Serializes folder resolution so concurrent uploads never create duplicate folders.
+
+FOLDER_LOCK = threading.Lock()
+
+CACHED_CREDENTIALS = {}
+
+# httplib2 connections are not thread-safe, so each thread keeps its own service object.
+
+THREAD_SERVICES = threading.local()
+
+class FolderCache(object): # pylint: disable=useless-object-inheritance
+    '''
+    Folder IDs keyed by root folder ID and every path prefix beneath it,
+    persisted as JSON (GOOGLE_DRIVE_FOLDER_CACHE, default
+    .google_drive_folders.json) so later runs skip the lookups entirely.
+    Entries expire after GOOGLE_DRIVE_FOLDER_CACHE_TTL seconds.
+    '''
+
+    def __init__(self):
+        self.path = os.environ.get('GOOGLE_DRIVE_FOLDER_CACHE', '.google_drive_folders.json')
+        self.ttl = float(os.environ.get('GOOGLE_DRIVE_FOLDER_CACHE_TTL', DEFAULT_FOLDER_CACHE_TTL))
+        self.lock = threading.RLock()
+        self.entries = None
+        self.dirty = False
+
+    def load(self):
+        if self.entries is None:
+            self.entries = {}
+
+            if os.path.exists(self.path):
+                try:
+                    with io.open(self.path, 'r', encoding='utf8') as cache_file:
+                        self.entries = json.load(cache_file)
+                except ValueError:
+                    logger.warning('Ignoring unreadable folder cache at %s.', self.path)
+
+        return self.entries
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+                self.dirty = False
+
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+
+        handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.google_drive_folders_')
+
+        with os.fdopen(handle, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+
+        replace_file(temp_path, self.path)
+
+    def get(self, root_id, path):
+        with self.lock:
+            entry = self.load().get(root_id, {}).get(path, None)
+
+            if entry is None or (time.time() - entry[1]) > self.ttl:
+                return None
+
+            return entry[0]
+
+    def set(self, root_id, path, folder_id):
+        with self.lock:
+            self.load().setdefault(root_id, {})[path] = [folder_id, time.time()]
+
+            self.dirty = True
+
+    def invalidate(self, root_id, path):
+        # Drops the path and everything beneath it - children of a vanished folder are gone too.
+
+        with self.lock:
+            folders = self.load().get(root_id, {})
+
+            for cached_path in list(folders.keys()):
+                if path == '' or cached_path == path or cached_path.startswith(path + '/'):
+                    del folders[cached_path]
+
+            self.dirty = True
+
+            self.flush()
+
+FOLDER_CACHE = FolderCache()
+
+# Resumable upload chunks must be multiples of 256 KB.
+
+CHUNK_GRANULARITY = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+INDEX_PAGE_SIZE = 1000
+
+# The Drive API accepts up to 100 calls per batch request.
+
+BATCH_SIZE = 100
+
+class MediaStreamUpload(MediaUpload):
+    '''
+    Resumable upload body read from a forward-only stream (e.g. an S3
+    StreamingBody) of unknown length. Only the chunk currently in flight is
+    retained, so that the client can resend it after a partial failure.
+    '''
+
+    def __init__(self, stream, mimetype, chunksize=DEFAULT_CHUNK_SIZE): # pylint: disable=super-init-not-called
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = max(CHUNK_GRANULARITY, -(-chunksize // CHUNK_GRANULARITY) * CHUNK_GRANULARITY)
+
+        self._offset = 0
+        self._buffer = b''
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def stream(self):
+        return self._stream
+
+    def getbytes(self, begin, length): # pylint: disable=arguments-renamed, bad-option-value
+        if begin < self._offset:
+            raise ValueError('Cannot rewind stream upload to offset %d (retained data starts at %d).' % (begin, self._offset))
+
+        self._buffer = self._buffer[begin - self._offset:]
+        self._offset = begin
+
+        pieces = [self._buffer]
+        buffered = len(self._buffer)
+
+        while buffered < length:
+            data = self._stream.read(length - buffered)
+
+            if not data:
+                break
+
+            pieces.append(data)
+            buffered += len(data)
+
+        self._buffer = b''.join(pieces)
+
+        return self._buffer[:length]
+
+def find_child_folder(service, parent_id, name):
+    results = (service.files().list(q='"%s" in parents and name = "%s" and mimeType = "%s" and trashed = false' % (parent_id, name, FOLDER_MIME_TYPE), \
+                                    pageSize=100, fields='nextPageToken, files(id, name)').execute())
 
     items = results.get('files', [])
 
-    if len(items) == 0: # pylint: disable=len-as-condition
-        folder_metadata = {
-            'parents': [parent_id],
-            'name': child_component,
-            'mimeType': 'application/vnd.google-apps.folder',
-        }
+    if items:
+        return items[0]['id']
+
+    folder_metadata = {
+        'parents': [parent_id],
+        'name': name,
+        'mimeType': FOLDER_MIME_TYPE,
+    }
 
-        new_file = service.files().create(body=folder_metadata, fields="id").execute()
+    new_file = service.files().create(body=folder_metadata, fields="id").execute()
 
-        identifier = new_file.get('id')
+    return new_file.get('id')
 
-        CACHED_FOLDER_IDS[path] = identifier
+def find_folder(service, root_id, child_components):
+    '''
+    Resolves (creating as needed) the folder at child_components beneath
+    root_id, consulting and filling the cache for every intermediate prefix.
+    If a cached folder turns out to be gone, its cache entries are dropped and
+    the path is resolved again from the root.
+    '''
 
-        return identifier
+    with FOLDER_LOCK:
+        try:
+            return resolve_folder(service, root_id, child_components)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
 
-    match = items[0]
+            FOLDER_CACHE.invalidate(root_id, '')
 
-    return find_folder(service, match['id'], path, child_components[1:])
+            return resolve_folder(service, root_id, child_components)
+        finally:
+            FOLDER_CACHE.flush()
 
-def fetch_service(scopes):
-    credentials = None
+def resolve_folder(service, root_id, child_components):
+    folder_id = root_id
+
+    # Start from the deepest cached prefix.
+
+    depth = len(child_components)
+
+    while depth > 0:
+        cached_id = FOLDER_CACHE.get(root_id, '/'.join(child_components[:depth]))
+
+        if cached_id is not None:
+            folder_id = cached_id
+
+            break
+
+        depth -= 1
+
+    while depth < len(child_components):
+        folder_id = find_child_folder(service, folder_id, child_components[depth])
+
+        depth += 1
+
+        FOLDER_CACHE.set(root_id, '/'.join(child_components[:depth]), folder_id)
 
-    if os.path.exists('token.json'):
+    return folder_id
+
+def fetch_credentials(scopes):
+    credentials = CACHED_CREDENTIALS.get(tuple(scopes), None)
+
+    if credentials is None and os.path.exists('token.json'):
         credentials = Credentials.from_authorized_user_file('token.json', scopes)
 
     # If there are no (valid) credentials available, let the user log in.
@@ -75,11 +274,43 @@ def fetch_service(scopes):
         with open('token.json', 'w', encoding='utf8') as token:
             token.write(credentials.to_json())
 
-    service = build('drive', 'v3', credentials=credentials)
+    CACHED_CREDENTIALS[tuple(scopes)] = credentials
+
+    return credentials
+
+def fetch_service(scopes):
+    # Credentials and the per-thread service object are reused for the life of the process.
+
+    with SERVICE_LOCK:
+        credentials = fetch_credentials(scopes)
+
+    services = getattr(THREAD_SERVICES, 'services', None)
+
+    if services is None:
+        services = {}
+
+        THREAD_SERVICES.services = services
+
+    service = services.get(tuple(scopes), None)
+
+    if service is None:
+        service = build('drive', 'v3', credentials=credentials)
+
+        services[tuple(scopes)] = service
 
     return service
 
-def upload_content(destination, file_path, file_content, file_type):
+def upload_content(destination, file_path, file_content, file_type, fingerprint=None):
+    media = MediaIoBaseUpload(io.BytesIO(file_content), mimetype=file_type, resumable=True)
+
+    return upload_media(destination, file_path, media, file_type, fingerprint)
+
+def upload_stream(destination, file_path, stream, file_type, chunk_size=DEFAULT_CHUNK_SIZE, fingerprint=None): # pylint: disable=too-many-arguments, too-many-positional-arguments, bad-option-value
+    media = MediaStreamUpload(stream, file_type, chunksize=chunk_size)
+
+    return upload_media(destination, file_path, media, file_type, fingerprint)
+
+def upload_media(destination, file_path, media, file_type, fingerprint=None): # pylint: disable=too-many-arguments, too-many-positional-arguments, bad-option-value
     url = urlparse(destination)
 
     scopes = [
@@ -88,11 +319,11 @@ def upload_content(destination, file_path, file_content, file_type):
 
     root_id = url.netloc
 
-    service = fetch_service(scopes)
-
     path_components = file_path.split('/')
 
-    folder_id = find_folder(service, root_id, '/'.join(path_components[:-1]), path_components[:-1])
+    service = fetch_service(scopes)
+
+    folder_id = find_folder(service, root_id, path_components[:-1])
 
     file_metadata = {
         'parents': [folder_id],
@@ -100,39 +331,258 @@ def upload_content(destination, file_path, file_content, file_type):
         'mimeType': file_type,
     }
 
-    media = MediaIoBaseUpload(io.BytesIO(file_content), mimetype=file_type, resumable=True)
+    # Keep the source's fingerprint with the file so later syncs can match it
+    # even when Drive's own md5Checksum is not comparable (S3 multipart ETags).
+
+    if fingerprint is not None:
+        file_metadata['appProperties'] = {
+            'fingerprint': fingerprint,
+        }
+
+    try:
+        new_file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    except HttpError as error:
+        if error.resp.status != 404:
+            raise
+
+        # The cached destination folder no longer exists - forget it and retry once.
+
+        FOLDER_CACHE.invalidate(root_id, '/'.join(path_components[:-1]))
 
-    new_file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        file_metadata['parents'] = [find_folder(service, root_id, path_components[:-1])]
+
+        new_file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
 
     identifier = new_file.get('id')
 
     return identifier
 
-def needs_update(service, root_id, name, size, updated):
-    path_components = name.split('/')
+def folder_listing_request(service, folder_id, page_token=None):
+    return service.files().list(q='"%s" in parents and trashed = false' % folder_id, pageSize=INDEX_PAGE_SIZE, pageToken=page_token, \
+                                fields='nextPageToken, files(name, size, modifiedTime, md5Checksum, appProperties)')
 
-    folder_id = find_folder(service, root_id, '/'.join(path_components[:-1]), path_components[:-1])
+def index_entry(item):
+    size = item.get('size', None)
 
-    results = (service.files().list(q='"%s" in parents and name = "%s"' % (folder_id, path_components[-1]), \
-                                    pageSize=20, fields='nextPageToken, files(id, name, size, parents, modifiedTime, mimeType)').execute())
+    return (int(size) if size is not None else None, item.get('modifiedTime', None), item.get('md5Checksum', None), item.get('appProperties', {}).get('fingerprint', None))
 
-    items = results.get('files', [])
+def add_listing_page(index, results):
+    for item in results.get('files', []):
+        if item['name'] not in index: # Keep the first match, as the per-file query did.
+            index[item['name']] = index_entry(item)
 
-    if len(items) == 0: # pylint: disable=len-as-condition
+    return results.get('nextPageToken', None)
+
+def folder_index(service, folder_id):
+    '''
+    Lists a folder's contents once (paging through nextPageToken) and returns
+    a map of name -> (size, modifiedTime, md5Checksum, fingerprint) for local
+    diffing.
+    '''
+
+    index = {}
+
+    page_token = None
+
+    while True:
+        page_token = add_listing_page(index, folder_listing_request(service, folder_id, page_token).execute())
+
+        if page_token is None:
+            return index
+
+def execute_batch(service, requests):
+    '''
+    Executes (key, request) pairs BATCH_SIZE at a time and returns a map of
+    key -> (response, exception), so that one failing call does not sink
+    the others.
+    '''
+
+    results = {}
+
+    for start in range(0, len(requests), BATCH_SIZE):
+        chunk = requests[start:start + BATCH_SIZE]
+
+        def callback(request_id, response, exception, chunk=chunk):
+            results[chunk[int(request_id)][0]] = (response, exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+
+        for index, (key, request) in enumerate(chunk): # pylint: disable=unused-variable
+            batch.add(request, request_id=str(index))
+
+        batch.execute()
+
+    return results
+
+def resolve_folders(service, root_id, folder_paths): # pylint: disable=too-many-locals, too-many-branches
+    '''
+    Resolves (creating as needed) many folder paths at once, one depth level
+    at a time: all lookups for a level share batch requests, then all missing
+    folders for that level are created in batch requests. Returns a map of
+    path -> folder ID. Paths whose batch calls failed are retried one by one
+    through find_folder (which recovers from stale cache entries).
+    '''
+
+    resolved = {(): root_id}
+
+    failed = set()
+
+    components_list = [tuple(path.split('/')) if path else () for path in set(folder_paths)]
+
+    max_depth = max([len(components) for components in components_list] + [0])
+
+    with FOLDER_LOCK:
+        for depth in range(1, max_depth + 1):
+            prefixes = set(components[:depth] for components in components_list if len(components) >= depth)
+
+            lookups = []
+
+            for prefix in sorted(prefixes):
+                if prefix[:-1] not in resolved:
+                    continue
+
+                cached_id = FOLDER_CACHE.get(root_id, '/'.join(prefix))
+
+                if cached_id is not None:
+                    resolved[prefix] = cached_id
+                else:
+                    lookups.append((prefix, service.files().list(q='"%s" in parents and name = "%s" and mimeType = "%s" and trashed = false' % (resolved[prefix[:-1]], prefix[-1], FOLDER_MIME_TYPE), \
+                                                                 pageSize=100, fields='nextPageToken, files(id, name)')))
+
+            creations = []
+
+            for prefix, (response, exception) in execute_batch(service, lookups).items():
+                if exception is not None:
+                    logger.warning('Unable to look up folder %s: %s', '/'.join(prefix), exception)
+
+                    failed.add(prefix)
+                elif response.get('files', []):
+                    resolved[prefix] = response['files'][0]['id']
+
+                    FOLDER_CACHE.set(root_id, '/'.join(prefix), resolved[prefix])
+                else:
+                    folder_metadata = {
+                        'parents': [resolved[prefix[:-1]]],
+                        'name': prefix[-1],
+                        'mimeType': FOLDER_MIME_TYPE,
+                    }
+
+                    creations.append((prefix, service.files().create(body=folder_metadata, fields='id')))
+
+            for prefix, (response, exception) in execute_batch(service, creations).items():
+                if exception is not None:
+                    logger.warning('Unable to create folder %s: %s', '/'.join(prefix), exception)
+
+                    failed.add(prefix)
+                else:
+                    resolved[prefix] = response.get('id')
+
+                    FOLDER_CACHE.set(root_id, '/'.join(prefix), resolved[prefix])
+
+        FOLDER_CACHE.flush()
+
+    folder_ids = {}
+
+    for components in components_list:
+        if components in resolved:
+            folder_ids['/'.join(components)] = resolved[components]
+        else:
+            folder_ids['/'.join(components)] = find_folder(service, root_id, list(components))
+
+    return folder_ids
+
+def folder_indices(service, folder_ids):
+    '''
+    Batched variant of folder_index: lists many folders together, following
+    nextPageToken for the folders that need more pages. Folders whose listing
+    fails are omitted, so their files are treated as missing.
+    '''
+
+    indices = dict((folder_id, {}) for folder_id in folder_ids)
+
+    pending = [(folder_id, None) for folder_id in indices]
+
+    while pending:
+        requests = [(folder_id, folder_listing_request(service, folder_id, page_token)) for folder_id, page_token in pending]
+
+        pending = []
+
+        for folder_id, (response, exception) in execute_batch(service, requests).items():
+            if exception is not None:
+                logger.warning('Unable to list folder %s: %s', folder_id, exception)
+
+                del indices[folder_id]
+
+                continue
+
+            page_token = add_listing_page(indices[folder_id], response)
+
+            if page_token is not None:
+                pending.append((folder_id, page_token))
+
+    return indices
+
+def entry_fingerprints(entry):
+    md5_checksum, fingerprint = entry[2:]
+
+    fingerprints = set()
+
+    if md5_checksum is not None:
+        fingerprints.add('md5:' + md5_checksum)
+
+    if fingerprint is not None:
+        fingerprints.add(fingerprint)
+
+    return fingerprints
+
+def entry_needs_update(entry, size, updated, fingerprint=None):
+    '''
+    Content fingerprints ("md5:<hex>", or "s3-etag:<etag>" for multipart
+    uploads) decide when both sides have one of the same kind. Otherwise
+    falls back to comparing size and modification time.
+    '''
+
+    if entry is None:
         return True
 
-    match = items[0]
+    entry_size, modified_time = entry[:2]
 
-    if int(match['size']) != size:
+    if entry_size != size:
         return True
 
-    last_updated = arrow.get(match['modifiedTime']).datetime
+    if fingerprint is not None:
+        fingerprints = entry_fingerprints(entry)
+
+        if fingerprint in fingerprints:
+            return False
+
+        # A fingerprint of the same kind that differs means the content changed.
+
+        if fingerprint.split(':', 1)[0] in set(item.split(':', 1)[0] for item in fingerprints):
+            return True
+
+    last_updated = arrow.get(modified_time).datetime
 
     if last_updated < updated:
         return True
 
     return False
 
+def needs_update(service, root_id, name, size, updated, fingerprint=None): # pylint: disable=too-many-arguments, too-many-positional-arguments, bad-option-value
+    path_components = name.split('/')
+
+    folder_id = find_folder(service, root_id, path_components[:-1])
+
+    results = (service.files().list(q='"%s" in parents and name = "%s" and trashed = false' % (folder_id, path_components[-1]), \
+                                    pageSize=20, fields='nextPageToken, files(name, size, modifiedTime, md5Checksum, appProperties)').execute())
+
+    items = results.get('files', [])
+
+    if len(items) == 0: # pylint: disable=len-as-condition
+        return True
+
+    return entry_needs_update(index_entry(items[0]), size, updated, fingerprint)
+
 def create_sync_request(file_list, destination):
     url = urlparse(destination)
 
@@ -142,10 +592,26 @@ def create_sync_request(file_list, destination):
 
     service = fetch_service(scopes)
 
+    file_list = list(file_list)
+
+    # Resolve and list every destination folder in batches, then diff locally.
+
+    folder_paths = set('/'.join(file_item['name'].split('/')[:-1]) for file_item in file_list)
+
+    folder_ids = resolve_folders(service, url.netloc, folder_paths)
+
+    indices = folder_indices(service, set(folder_ids.values()))
+
     requested_files = []
 
     for file_item in file_list:
-        if needs_update(service, url.netloc, file_item['name'], file_item['size'], file_item['updated']):
+        path_components = file_item['name'].split('/')
+
+        index = indices.get(folder_ids['/'.join(path_components[:-1])], {})
+
+        entry = index.get(path_components[-1], None)
+
+        if entry_needs_update(entry, file_item['size'], file_item['updated'], file_item.get('fingerprint', None)):
             requested_files.append(file_item['name'])
         else:
             logger.info('Skipping %s...', file_item['name'])
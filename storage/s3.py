@@ -1,10 +1,54 @@
+# pylint: disable=line-too-long
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
 
+import arrow
 import boto3
 
+from botocore.config import Config
+
+DEFAULT_LISTING_WORKERS = 8
+DEFAULT_LISTING_CACHE_TTL = 24 * 60 * 60
+DEFAULT_MAX_CONNECTIONS = 16
+LISTING_CACHE_VERSION = 3
+
+# Python 2 only has os.rename, which also replaces files atomically on POSIX.
+
+replace_file = getattr(os, 'replace', os.rename) # pylint: disable=invalid-name
+
+SHARED_CLIENT = {}
+SHARED_CLIENT_LOCK = threading.Lock()
+
+def shared_client():
+    '''
+    Returns the client (and connection pool, sized by S3_MAX_CONNECTIONS)
+    shared by every call and thread for the rest of the run. boto3 clients,
+    unlike sessions, may be shared between threads.
+    '''
+
+    with SHARED_CLIENT_LOCK:
+        if 's3' not in SHARED_CLIENT:
+            config = Config(max_pool_connections=max(1, int(os.environ.get('S3_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS))))
+
+            # A private session: building clients from the default session is not thread-safe.
+
+            SHARED_CLIENT['s3'] = boto3.session.Session().client('s3', config=config)
+
+        return SHARED_CLIENT['s3']
+
 def s3_objects(paginator, bucket_name, prefix='/', delimiter='/', start_after=''):
     # Credit: https://stackoverflow.com/a/54014862/193812
 
@@ -16,32 +60,286 @@ def s3_objects(paginator, bucket_name, prefix='/', delimiter='/', start_after=''
         for content in page.get('Contents', ()): # pylint: disable=use-yield-from
             yield content
 
-def list_files(source):
+def listing_shards(paginator, bucket_name, prefix):
+    '''
+    Splits a listing into one shard per top-level folder below prefix (the
+    date folders written by SIMPLE_BACKUP_FOLDER_FORMAT). Returns the shard
+    prefixes and any objects stored directly under prefix.
+    '''
+
+    shards = []
+    loose_objects = []
+
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', ()):
+            shards.append(common_prefix['Prefix'])
+
+        loose_objects.extend(page.get('Contents', ()))
+
+    return shards, loose_objects
+
+def file_item(s3_object):
+    return {
+        'name': s3_object['Key'],
+        'size': s3_object['Size'],
+        'updated': s3_object['LastModified'],
+    }
+
+def object_fingerprint(client, bucket_name, s3_object):
+    '''
+    Returns "md5:<hex>" when the object's MD5 is known - single-part ETags are
+    the MD5 of the content, and multipart uploads made by Simple Backup store
+    it as "md5" metadata - or "s3-etag:<etag>" otherwise.
+    '''
+
+    etag = s3_object.get('ETag', '').strip('"')
+
+    if etag == '':
+        return None
+
+    if '-' not in etag:
+        return 'md5:' + etag
+
+    metadata = client.head_object(Bucket=bucket_name, Key=s3_object['Key']).get('Metadata', {})
+
+    if 'md5' in metadata:
+        return 'md5:' + metadata['md5']
+
+    return 's3-etag:' + etag
+
+def object_row(client, bucket_name, s3_object, known=None):
+    '''
+    Returns the cached form of an object: [key, size, updated, fingerprint,
+    ETag]. The fingerprint of a known row (by key) is reused while its ETag
+    and size are unchanged, saving a HEAD request per multipart object.
+    '''
+
+    etag = s3_object.get('ETag', '')
+
+    previous = known.get(s3_object['Key'], None) if known else None
+
+    if previous is not None and previous[4] == etag and previous[1] == s3_object['Size']:
+        fingerprint = previous[3]
+    else:
+        fingerprint = object_fingerprint(client, bucket_name, s3_object)
+
+    return [s3_object['Key'], s3_object['Size'], arrow.get(s3_object['LastModified']).isoformat(), fingerprint, etag]
+
+def cached_files(objects):
+    for row in objects:
+        item = file_item({'Key': row[0], 'Size': row[1], 'LastModified': arrow.get(row[2]).datetime})
+
+        item['fingerprint'] = row[3]
+
+        yield item
+
+class ListingCache(object): # pylint: disable=useless-object-inheritance
+    '''
+    Remembers each shard's objects on disk. Within S3_LISTING_CACHE_TTL
+    seconds (default: a day) of a shard's last full listing, later runs only
+    ask S3 for keys that sort after its last cached key (via StartAfter).
+    Past that the shard is listed in full again, dropping deleted keys and
+    refreshing overwritten ones. Shards themselves are rediscovered on every
+    run, so folders written out of order are found straight away and
+    removed folders are forgotten.
+    '''
+
+    def __init__(self, bucket_name, prefix):
+        self.path = os.environ.get('S3_LISTING_CACHE', '.s3_listing_cache')
+
+        if self.path:
+            self.path = os.path.join(self.path, hashlib.sha256(('%s/%s' % (bucket_name, prefix)).encode('utf-8')).hexdigest())
+
+        self.ttl = float(os.environ.get('S3_LISTING_CACHE_TTL', DEFAULT_LISTING_CACHE_TTL))
+
+    def shard_path(self, shard):
+        return os.path.join(self.path, hashlib.sha256(shard.encode('utf-8')).hexdigest() + '.json')
+
+    def shards(self):
+        shards = []
+
+        if self.path and os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                entry = self.read(os.path.join(self.path, name))
+
+                if entry is not None and entry.get('loose', False) is False:
+                    shards.append(entry['shard'])
+
+        return shards
+
+    def read(self, path): # pylint: disable=no-self-use
+        try:
+            with io.open(path, 'r', encoding='utf8') as cache_file:
+                entry = json.load(cache_file)
+
+            if entry.get('version', None) == LISTING_CACHE_VERSION:
+                return entry
+        except (IOError, OSError, ValueError):
+            pass
+
+        return None
+
+    def get(self, shard):
+        if not self.path:
+            return None
+
+        return self.read(self.shard_path(shard))
+
+    def is_fresh(self, entry):
+        return time.time() - entry['listed'] < self.ttl
+
+    def remove(self, shard):
+        if not self.path:
+            return
+
+        try:
+            os.remove(self.shard_path(shard))
+        except OSError:
+            pass
+
+    def set(self, shard, objects, listed, loose=False):
+        if not self.path:
+            return
+
+        if not objects:
+            self.remove(shard)
+
+            return
+
+        if os.path.isdir(self.path) is False:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if os.path.isdir(self.path) is False:
+                    raise
+
+        entry = {
+            'version': LISTING_CACHE_VERSION,
+            'shard': shard,
+            'listed': listed,
+            'objects': objects,
+            'loose': loose,
+        }
+
+        # Write to a temporary file first so an interrupted run never leaves a partial cache.
+
+        handle, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        with os.fdopen(handle, 'w') as cache_file:
+            json.dump(entry, cache_file)
+
+        replace_file(temp_path, self.shard_path(shard))
+
+def list_shard(client, bucket_name, shard, cache):
+    cached = cache.get(shard)
+
+    objects = []
+    known = {}
+    start_after = shard
+    listed = time.time()
+
+    if cached is not None and cached['objects'] and cache.is_fresh(cached):
+        objects = cached['objects']
+        start_after = objects[-1][0]
+        listed = cached['listed']
+    elif cached is not None:
+        known = dict((row[0], row) for row in cached['objects'])
+
+    new_count = 0
+
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=shard, StartAfter=start_after):
+        for s3_object in page.get('Contents', ()):
+            objects.append(object_row(client, bucket_name, s3_object, known))
+
+            new_count += 1
+
+    if cached is None or new_count > 0 or listed != cached['listed']:
+        cache.set(shard, objects, listed)
+
+    return objects
+
+def iterate_files(source): # pylint: disable=too-many-locals
+    '''
+    Lists source one date folder at a time on a pool of threads
+    (S3_LISTING_WORKERS, default 8) and yields files newest folder first,
+    holding at most a few shards in memory at once.
+    '''
+
     url = urlparse(source)
 
     bucket_name = url.netloc
 
-    client = boto3.client('s3')
-    paginator = client.get_paginator('list_objects_v2')
+    prefix = url.path.lstrip('/')
+
+    client = shared_client()
+
+    cache = ListingCache(bucket_name, prefix)
 
-    file_list = []
+    # The delimited listing only returns folder names (and loose objects), so
+    # every run rediscovers all of them - backfilled and compacted windows
+    # sort before later folders.
 
-    for s3_object in s3_objects(paginator, bucket_name, url.path):
-        file_list.append({
-            'name': s3_object['Key'],
-            'size': s3_object['Size'],
-            'updated': s3_object['LastModified'],
-        })
+    shards, loose_objects = listing_shards(client.get_paginator('list_objects_v2'), bucket_name, prefix)
 
-    return file_list
+    # Folders removed since (pruned or compacted windows) leave the cache.
+
+    for shard in set(cache.shards()) - set(shards):
+        cache.remove(shard)
+
+    shards = sorted(shards, reverse=True)
+
+    # Objects stored directly under prefix are cached alongside the shards.
+
+    loose = cache.get(prefix)
+
+    known = dict((row[0], row) for row in (loose['objects'] if loose is not None else []))
+
+    loose = [object_row(client, bucket_name, s3_object, known) for s3_object in loose_objects if s3_object['Key'] != prefix]
+
+    cache.set(prefix, loose, time.time(), loose=True)
+
+    for item in cached_files(loose): # pylint: disable=use-yield-from
+        yield item
+
+    workers = max(1, int(os.environ.get('S3_LISTING_WORKERS', DEFAULT_LISTING_WORKERS)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+
+        for shard in shards:
+            pending.append(executor.submit(list_shard, client, bucket_name, shard, cache))
+
+            # Keep a bounded window of shards in flight so memory stays flat.
+
+            if len(pending) >= workers * 2:
+                for item in cached_files(pending.pop(0).result()): # pylint: disable=use-yield-from
+                    yield item
+
+        for future in pending:
+            for item in cached_files(future.result()): # pylint: disable=use-yield-from
+                yield item
+
+def list_files(source):
+    return list(iterate_files(source))
 
 def fetch_content(source, path):
     url = urlparse(source)
 
     bucket_name = url.netloc
 
-    client = boto3.client('s3')
+    client = shared_client()
 
     s3_response_object = client.get_object(Bucket=bucket_name, Key=path)
 
     return s3_response_object['Body'].read(), s3_response_object['ContentType']
+
+def open_read(source, path):
+    url = urlparse(source)
+
+    bucket_name = url.netloc
+
+    client = shared_client()
+
+    s3_response_object = client.get_object(Bucket=bucket_name, Key=path)
+
+    return s3_response_object['Body'], s3_response_object['ContentType']
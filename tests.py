@@ -1,3 +1,829 @@
-# from django.test import TestCase
+# pylint: disable=no-member,line-too-long
 
-# Create your tests here.
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytz
+import six
+
+from nacl.exceptions import CryptoError
+from nacl.secret import SecretBox
+
+from django.contrib.auth.models import Group, Permission, User
+from django.core import serializers
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+from . import archives, compression, destinations
+from .archives import fetch_artifact, iter_records, window_folder
+from .backup_api import CompressedFixtureWriter, incremental_backup, new_rows
+from .catalog import file_checksum, read_catalog_stats
+from .compression import CODEC_CLASSES, codec_named, configured_codec, decompress_file
+from .deduplication import MANIFEST_SUFFIX, deduplicate_file, iter_chunks
+from .destinations import S3_DEFAULT_PART_SIZE, S3_MIN_PART_SIZE, destination_for_url, file_md5
+from .encryption import FLAG_FINAL, HEADER_STRUCT, RECORD_STRUCT, decrypt_stream, encrypt_file, encrypt_stream
+from .management.commands.decrypt_backup_file import decrypt_backup, decrypted_path
+from .management.commands.manual_sync import DestinationStorage
+from .management.commands import restore_backup
+from .management.commands.restore_backup import insert_batch
+from .models import BackupArtifact, DumpWatermark
+from .retention import compact_windows, compactable_windows
+from .storage import s3 as s3_storage
+from .storage.s3 import object_fingerprint
+
+TEST_BUCKET = 'simple-backup-test'
+
+@override_settings(SIMPLE_BACKUP_AWS_REGION='us-east-1', SIMPLE_BACKUP_AWS_ACCESS_KEY_ID='testing', SIMPLE_BACKUP_AWS_SECRET_ACCESS_KEY='testing')
+class S3DestinationTestCase(TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+
+        # Shared clients created outside this mock would talk to the real S3.
+
+        destinations.SHARED_CLIENTS.clear()
+
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=TEST_BUCKET)
+
+        self.destination = destination_for_url('s3://%s/' % TEST_BUCKET)
+
+        self.staging = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+        destinations.SHARED_CLIENTS.clear()
+
+        self.mock.stop()
+
+    def staged_file(self, size):
+        path = os.path.join(self.staging, 'artifact-%d.encrypted' % size)
+
+        with open(path, 'wb') as staged_file:
+            remaining = size
+
+            while remaining > 0:
+                block = os.urandom(min(remaining, 1024 * 1024))
+
+                staged_file.write(block)
+
+                remaining -= len(block)
+
+        return path
+
+    def stored_content(self, remote_path):
+        return self.s3_client.get_object(Bucket=TEST_BUCKET, Key=remote_path)['Body'].read()
+
+    def test_small_file_uses_put_object(self):
+        path = self.staged_file(1024 * 1024)
+
+        with mock.patch.object(self.destination.client, 'create_multipart_upload', wraps=self.destination.client.create_multipart_upload) as create_multipart_upload:
+            self.destination.transmit(path, 'window/small.encrypted')
+
+        self.assertEqual(create_multipart_upload.call_count, 0)
+
+        with open(path, 'rb') as staged_file:
+            self.assertEqual(self.stored_content('window/small.encrypted'), staged_file.read())
+
+        self.assertEqual(self.s3_client.head_object(Bucket=TEST_BUCKET, Key='window/small.encrypted')['Metadata']['md5'], file_md5(path))
+
+    def test_large_file_uses_16mb_parts(self):
+        path = self.staged_file(70 * 1024 * 1024)
+
+        with mock.patch.object(self.destination.client, 'upload_part', wraps=self.destination.client.upload_part) as upload_part:
+            self.destination.transmit(path, 'window/large.encrypted')
+
+        part_sizes = sorted((call[1]['PartNumber'], len(call[1]['Body'])) for call in upload_part.call_args_list)
+
+        self.assertEqual(part_sizes, [(1, S3_DEFAULT_PART_SIZE), (2, S3_DEFAULT_PART_SIZE), (3, S3_DEFAULT_PART_SIZE), (4, S3_DEFAULT_PART_SIZE), (5, 70 * 1024 * 1024 - 4 * S3_DEFAULT_PART_SIZE)])
+
+        with open(path, 'rb') as staged_file:
+            self.assertEqual(self.stored_content('window/large.encrypted'), staged_file.read())
+
+        # Multipart ETags are not an MD5, so fingerprints come from the metadata.
+
+        s3_object = self.s3_client.list_objects_v2(Bucket=TEST_BUCKET)['Contents'][0]
+
+        self.assertTrue('-' in s3_object['ETag'])
+        self.assertEqual(object_fingerprint(self.s3_client, TEST_BUCKET, s3_object), 'md5:' + file_md5(path))
+
+    @override_settings(SIMPLE_BACKUP_S3_MULTIPART_THRESHOLD=6 * 1024 * 1024, SIMPLE_BACKUP_S3_PART_SIZE=5 * 1024 * 1024, SIMPLE_BACKUP_S3_PART_RETRIES=2)
+    def test_failed_part_is_retried(self):
+        path = self.staged_file(12 * 1024 * 1024)
+
+        upload_part = self.destination.client.upload_part
+
+        attempts = []
+
+        def flaky_upload_part(**kwargs):
+            attempts.append(kwargs['PartNumber'])
+
+            if kwargs['PartNumber'] == 2 and attempts.count(2) == 1:
+                raise IOError('Connection reset')
+
+            return upload_part(**kwargs)
+
+        with mock.patch.object(self.destination.client, 'upload_part', side_effect=flaky_upload_part), mock.patch.object(destinations.time, 'sleep'):
+            self.destination.transmit(path, 'window/retried.encrypted')
+
+        self.assertEqual(attempts.count(2), 2)
+
+        with open(path, 'rb') as staged_file:
+            self.assertEqual(self.stored_content('window/retried.encrypted'), staged_file.read())
+
+    @override_settings(SIMPLE_BACKUP_S3_MULTIPART_THRESHOLD=6 * 1024 * 1024, SIMPLE_BACKUP_S3_PART_SIZE=5 * 1024 * 1024, SIMPLE_BACKUP_S3_PART_RETRIES=1)
+    def test_failed_upload_is_aborted(self):
+        path = self.staged_file(12 * 1024 * 1024)
+
+        upload_part = self.destination.client.upload_part
+
+        def failing_upload_part(**kwargs):
+            if kwargs['PartNumber'] == 2:
+                raise IOError('Connection reset')
+
+            return upload_part(**kwargs)
+
+        with mock.patch.object(self.destination.client, 'upload_part', side_effect=failing_upload_part), mock.patch.object(destinations.time, 'sleep'):
+            with self.assertRaises(IOError):
+                self.destination.transmit(path, 'window/aborted.encrypted')
+
+        self.assertEqual(self.s3_client.list_multipart_uploads(Bucket=TEST_BUCKET).get('Uploads', []), [])
+        self.assertEqual(self.s3_client.list_objects_v2(Bucket=TEST_BUCKET).get('KeyCount', 0), 0)
+
+    @override_settings(SIMPLE_BACKUP_S3_MULTIPART_THRESHOLD=S3_MIN_PART_SIZE, SIMPLE_BACKUP_S3_PART_SIZE=S3_MIN_PART_SIZE)
+    def test_sync_fingerprint_stored(self):
+        storage = DestinationStorage('s3://%s/' % TEST_BUCKET)
+
+        content = os.urandom(S3_MIN_PART_SIZE + 1024)
+
+        storage.upload_stream(None, 'window/large.encrypted', io.BytesIO(content), 'application/octet-stream', fingerprint='s3-etag:source-2')
+
+        self.assertTrue('-' in self.s3_client.head_object(Bucket=TEST_BUCKET, Key='window/large.encrypted')['ETag'])
+
+        def requested(fingerprint):
+            return storage.create_sync_request([{'name': 'window/large.encrypted', 'size': len(content), 'updated': timezone.now() - datetime.timedelta(days=1), 'fingerprint': fingerprint}], None)
+
+        self.assertEqual(requested('s3-etag:source-2'), [])
+        self.assertEqual(requested('s3-etag:rewritten-2'), ['window/large.encrypted'])
+
+class S3ListingCacheTestCase(TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+
+        s3_storage.SHARED_CLIENT.clear()
+
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=TEST_BUCKET)
+
+        self.cache_folder = tempfile.mkdtemp()
+
+        self.environ = mock.patch.dict(os.environ, {'S3_LISTING_CACHE': self.cache_folder, 'S3_LISTING_CACHE_TTL': str(24 * 60 * 60)})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+
+        shutil.rmtree(self.cache_folder, ignore_errors=True)
+
+        s3_storage.SHARED_CLIENT.clear()
+
+        self.mock.stop()
+
+    def put(self, key, content):
+        self.s3_client.put_object(Bucket=TEST_BUCKET, Key=key, Body=content)
+
+    def listed(self):
+        return dict((item['name'], item) for item in s3_storage.iterate_files('s3://%s/' % TEST_BUCKET))
+
+    def test_backfilled_folders_found(self):
+        self.put('2026-08-08__2026-08-08/backup.encrypted', b'later')
+
+        self.assertEqual(sorted(self.listed()), ['2026-08-08__2026-08-08/backup.encrypted'])
+
+        # Backfilled and compacted windows sort before the cached folder.
+
+        self.put('2026-08-01__2026-08-07/backup.encrypted', b'compacted')
+        self.put('2026-07-01__2026-07-01/backup.encrypted', b'backfilled')
+
+        self.assertEqual(sorted(self.listed()), ['2026-07-01__2026-07-01/backup.encrypted', '2026-08-01__2026-08-07/backup.encrypted', '2026-08-08__2026-08-08/backup.encrypted'])
+
+    def test_removed_folders_forgotten(self):
+        self.put('2026-08-01__2026-08-01/backup.encrypted', b'pruned')
+        self.put('2026-08-02__2026-08-02/backup.encrypted', b'kept')
+
+        self.assertEqual(len(self.listed()), 2)
+
+        self.s3_client.delete_object(Bucket=TEST_BUCKET, Key='2026-08-01__2026-08-01/backup.encrypted')
+
+        self.assertEqual(sorted(self.listed()), ['2026-08-02__2026-08-02/backup.encrypted'])
+
+        self.assertEqual(s3_storage.ListingCache(TEST_BUCKET, '').shards(), ['2026-08-02__2026-08-02/'])
+
+    def test_expired_shards_relisted(self):
+        self.put('2026-08-01__2026-08-01/a.encrypted', b'original')
+        self.put('2026-08-01__2026-08-01/b.encrypted', b'deleted')
+
+        self.assertEqual(self.listed()['2026-08-01__2026-08-01/a.encrypted']['size'], len(b'original'))
+
+        self.put('2026-08-01__2026-08-01/a.encrypted', b'overwritten content')
+        self.s3_client.delete_object(Bucket=TEST_BUCKET, Key='2026-08-01__2026-08-01/b.encrypted')
+
+        with mock.patch.dict(os.environ, {'S3_LISTING_CACHE_TTL': '0'}):
+            listed = self.listed()
+
+        self.assertEqual(sorted(listed), ['2026-08-01__2026-08-01/a.encrypted'])
+        self.assertEqual(listed['2026-08-01__2026-08-01/a.encrypted']['size'], len(b'overwritten content'))
+        self.assertEqual(listed['2026-08-01__2026-08-01/a.encrypted']['fingerprint'], 'md5:' + hashlib.md5(b'overwritten content').hexdigest()) # nosec
+
+class SyncRequestTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        self.storage = DestinationStorage('file://' + self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_size_rewrites_synced(self):
+        for name, content in (('same.bin', b'same'), ('rewritten.bin', b'old!'), ('unknown.bin', b'data')):
+            self.storage.upload_content(None, 'window/' + name, content, 'application/octet-stream')
+
+        earlier = timezone.now() - datetime.timedelta(days=1)
+        later = timezone.now() + datetime.timedelta(days=1)
+
+        source_list = [
+            {'name': 'window/same.bin', 'size': 4, 'updated': later, 'fingerprint': 'md5:' + hashlib.md5(b'same').hexdigest()}, # nosec
+            {'name': 'window/rewritten.bin', 'size': 4, 'updated': earlier, 'fingerprint': 'md5:' + hashlib.md5(b'new!').hexdigest()}, # nosec
+            {'name': 'window/unknown.bin', 'size': 4, 'updated': earlier, 'fingerprint': 's3-etag:source-2'},
+            {'name': 'window/new.bin', 'size': 4, 'updated': earlier},
+        ]
+
+        # Without a comparable fingerprint, only files changed since the stored copy was written are synced.
+
+        self.assertEqual(self.storage.create_sync_request(source_list, None), ['window/rewritten.bin', 'window/new.bin'])
+
+        source_list[2]['updated'] = later
+
+        self.assertEqual(self.storage.create_sync_request(source_list, None), ['window/rewritten.bin', 'window/unknown.bin', 'window/new.bin'])
+
+@override_settings(ALLOWED_HOSTS=['test'], SIMPLE_BACKUP_DUMPDATA_APPS=('auth',))
+class CompactionTestCase(TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+        self.folder = tempfile.mkdtemp()
+        self.staging = tempfile.mkdtemp()
+
+        self.url = 'file://' + self.folder
+
+        self.destination = destination_for_url(self.url)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def store(self, start_date, end_date, name, records, app='simple_backup'):
+        codec = configured_codec()
+
+        path = os.path.join(self.staging, name + codec.extension)
+
+        with io.open(path, 'wb') as fixture_file:
+            writer = CompressedFixtureWriter(fixture_file, codec=codec)
+
+            writer.write(json.dumps(records))
+
+            writer.close()
+
+        encrypt_file(self.key, path, path + '.encrypted')
+
+        remote_path = window_folder(start_date, end_date) + '/' + os.path.basename(path) + '.encrypted'
+
+        self.destination.transmit(path + '.encrypted', remote_path)
+
+        BackupArtifact.objects.create(app=app, destination=self.url, start_date=start_date, end_date=end_date, path=remote_path, size=os.path.getsize(path + '.encrypted'), checksum=file_checksum(path + '.encrypted'), codec=codec.name, transmitted=timezone.now())
+
+        os.remove(path)
+        os.remove(path + '.encrypted')
+
+    def stored_names(self, remote_path):
+        local_path, encrypted = fetch_artifact(self.key, self.destination, remote_path, os.path.join(self.staging, 'fetched'))
+
+        return [record['fields']['name'] for record in iter_records(self.key, local_path, encrypted)]
+
+    def test_later_window_supersedes(self):
+        compacted = (datetime.date(2026, 8, 3), datetime.date(2026, 8, 9))
+        later = (datetime.date(2026, 8, 1), datetime.date(2026, 8, 10))
+
+        # The earlier, already compacted window starts after the later one.
+
+        self.store(compacted[0], compacted[1], 'simple_backup_test_auth.json-dumpdata', [{'model': 'auth.group', 'pk': 1, 'fields': {'name': 'old'}}])
+        self.store(compacted[0], compacted[1], 'simple_backup_test_authgroup.json-incremental', [{'model': 'auth.group', 'pk': 1, 'fields': {'name': 'old'}}, {'model': 'auth.group', 'pk': 2, 'fields': {'name': 'kept'}}])
+
+        self.store(later[0], later[1], 'simple_backup_test_auth.json-dumpdata', [{'model': 'auth.group', 'pk': 1, 'fields': {'name': 'new'}}])
+        self.store(later[0], later[1], 'simple_backup_test_authgroup.json-incremental', [{'model': 'auth.group', 'pk': 1, 'fields': {'name': 'new'}}])
+
+        superseded = compact_windows(self.key, self.destination, self.url, [later, compacted], self.staging)
+
+        self.assertEqual(len(superseded), 2)
+
+        merged = dict(('incremental' if '.json-incremental' in artifact.path else 'full', artifact.path) for artifact in BackupArtifact.objects.all())
+
+        self.assertEqual(sorted(merged), ['full', 'incremental'])
+
+        for remote_path in merged.values():
+            self.assertTrue(remote_path.startswith(window_folder(later[0], later[1]) + '/'))
+
+        self.assertEqual(self.stored_names(merged['full']), ['new'])
+        self.assertEqual(sorted(self.stored_names(merged['incremental'])), ['kept', 'new'])
+
+    def test_other_app_files_kept(self):
+        first = (datetime.date(2026, 8, 1), datetime.date(2026, 8, 1))
+        second = (datetime.date(2026, 8, 2), datetime.date(2026, 8, 2))
+
+        for window, name in ((first, 'first'), (second, 'second')):
+            self.store(window[0], window[1], 'simple_backup_test_auth.json-dumpdata', [{'model': 'auth.group', 'pk': 1, 'fields': {'name': name}}])
+
+            # Other apps' backup_api modules may only write the window's own data.
+
+            self.store(window[0], window[1], 'otherapp_events.json', [{'model': 'auth.group', 'pk': 2, 'fields': {'name': name}}], app='otherapp')
+
+        superseded = compact_windows(self.key, self.destination, self.url, [first, second], self.staging)
+
+        self.assertEqual(superseded, [window_folder(window[0], window[1]) + '/simple_backup_test_auth.json-dumpdata.bz2.encrypted' for window in (first, second)])
+
+        others = BackupArtifact.objects.filter(app='otherapp').order_by('start_date')
+
+        self.assertEqual([(artifact.start_date, artifact.end_date) for artifact in others], [first, second])
+        self.assertEqual([self.stored_names(artifact.path) for artifact in others], [['first'], ['second']])
+
+        # The merged windows keep only the other apps' files, so they are not planned again.
+
+        self.assertEqual(compactable_windows(self.url), [(first[0], second[1])])
+
+@override_settings(SIMPLE_BACKUP_DEDUPLICATE_CHUNK_SIZE=16 * 1024)
+class DeduplicationTestCase(TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+        self.folder = tempfile.mkdtemp()
+        self.staging = tempfile.mkdtemp()
+
+        self.destination = destination_for_url('file://' + self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def store(self, remote_path, content):
+        # Stores content as a deduplicated artifact and returns its manifest's remote path.
+
+        path = os.path.join(self.staging, os.path.basename(remote_path))
+
+        with io.open(path, 'wb') as staged_file:
+            staged_file.write(content)
+
+        chunk_staging = os.path.join(self.staging, 'chunks')
+
+        if os.path.isdir(chunk_staging) is False:
+            os.makedirs(chunk_staging)
+
+        manifest_path, chunk_files = deduplicate_file(self.key, path, chunk_staging)
+
+        for local_path, chunk_remote in chunk_files:
+            encrypt_file(self.key, local_path, local_path + '.encrypted')
+
+            self.destination.transmit(local_path + '.encrypted', chunk_remote + '.encrypted')
+
+        encrypt_file(self.key, manifest_path, manifest_path + '.encrypted')
+
+        manifest_remote = remote_path + MANIFEST_SUFFIX + '.encrypted'
+
+        self.destination.transmit(manifest_path + '.encrypted', manifest_remote)
+
+        return manifest_remote
+
+    def test_chunks_survive_insertion(self):
+        content = b''.join(hashlib.sha256(six.text_type(index).encode('utf-8')).hexdigest().encode('utf-8') + b'\n' for index in range(20000))
+
+        chunks = list(iter_chunks(io.BytesIO(content), 4096))
+
+        self.assertEqual(b''.join(chunks), content)
+
+        for chunk in chunks[:-1]:
+            self.assertTrue(1024 < len(chunk) <= 4 * 4096)
+
+        # Content-defined boundaries: only the chunks around an insertion change.
+
+        edited = content[:len(content) // 2] + b'inserted' + content[len(content) // 2:]
+
+        edited_chunks = list(iter_chunks(io.BytesIO(edited), 4096))
+
+        self.assertEqual(b''.join(edited_chunks), edited)
+        self.assertTrue(len(set(chunks) - set(edited_chunks)) <= 2)
+
+    def test_shared_chunks_fetched_once(self):
+        content = os.urandom(256 * 1024)
+
+        manifests = [self.store('2026-08-%02d__2026-08-%02d/data.bin' % (day, day), content) for day in range(1, 9)]
+
+        fetched = []
+
+        def slow_fetch(remote_path, local_path):
+            # Writes the file gradually, as downloads do.
+
+            fetched.append(remote_path)
+
+            with io.open(os.path.join(self.folder, remote_path), 'rb') as stored_file:
+                stored = stored_file.read()
+
+            with io.open(local_path, 'wb') as local_file:
+                local_file.write(stored[:len(stored) // 2])
+                local_file.flush()
+
+                time.sleep(0.01)
+
+                local_file.write(stored[len(stored) // 2:])
+
+        staging = os.path.join(self.staging, 'restore')
+
+        with mock.patch.object(self.destination, 'fetch', side_effect=slow_fetch), ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda remote_path: fetch_artifact(self.key, self.destination, remote_path, staging), manifests))
+
+        for path, encrypted in results:
+            self.assertFalse(encrypted)
+
+            with io.open(path, 'rb') as reassembled_file:
+                self.assertEqual(reassembled_file.read(), content)
+
+        chunks = [remote_path for remote_path in fetched if remote_path not in manifests]
+
+        self.assertEqual(len(chunks), len(set(chunks)))
+
+    def test_compressed_file_rebuilt(self):
+        content = b''.join(hashlib.sha256(six.text_type(index).encode('utf-8')).hexdigest().encode('utf-8') + b'\n' for index in range(5000))
+
+        codec = codec_named('bz2', threads=2, block_size=100 * 1000)
+
+        # Chunks hold decompressed content, each compressed on its own, so the rebuilt file differs but decompresses the same.
+
+        manifest = self.store('2026-08-01__2026-08-02/data.json.bz2', codec.compress(content))
+
+        path, encrypted = fetch_artifact(self.key, self.destination, manifest, os.path.join(self.staging, 'restore'))
+
+        self.assertFalse(encrypted)
+        self.assertEqual(os.path.basename(path), 'data.json.bz2')
+
+        with io.open(path, 'rb') as reassembled_file:
+            self.assertEqual(codec.decompress(reassembled_file.read()), content)
+
+    def test_swapped_chunk_rejected(self):
+        manifest = self.store('2026-08-01__2026-08-02/data.bin', os.urandom(128 * 1024))
+
+        chunks = sorted(os.path.join(folder, name) for folder, folder_names, names in os.walk(os.path.join(self.folder, 'chunks')) for name in names)
+
+        # Each chunk authenticates on its own, so only its name shows it is not the one listed.
+
+        shutil.copyfile(chunks[0], chunks[1])
+
+        with self.assertRaises(ValueError):
+            fetch_artifact(self.key, self.destination, manifest, os.path.join(self.staging, 'restore'))
+
+    def test_decrypted_manifest_removed(self):
+        content = os.urandom(64 * 1024)
+
+        encrypted_path = os.path.join(self.folder, self.store('2026-08-01__2026-08-02/data.bin', content))
+
+        result = decrypt_backup(self.key, encrypted_path, decrypted_path(encrypted_path), None, False)
+
+        self.assertEqual(result[1:], (os.path.join(os.path.dirname(encrypted_path), 'data.bin'), os.path.getsize(encrypted_path), len(content), None))
+
+        with io.open(result[1], 'rb') as reassembled_file:
+            self.assertEqual(reassembled_file.read(), content)
+
+        self.assertEqual(sorted(os.listdir(os.path.dirname(encrypted_path))), ['data.bin', 'data.bin' + MANIFEST_SUFFIX + '.encrypted'])
+
+class DecryptBackupTestCase(TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_codec_errors_reported(self):
+        path = os.path.join(self.folder, 'data.json.bz2')
+
+        with io.open(path, 'wb') as compressed_file:
+            compressed_file.write(codec_named('bz2').compress(b'[]' * 1000)[:-10])
+
+        encrypt_file(self.key, path, path + '.encrypted')
+
+        os.remove(path)
+
+        # A truncated stream fails with EOFError, which is the file's result rather than the batch's.
+
+        encrypted_path, output_path, read_bytes, written_bytes, error = decrypt_backup(self.key, path + '.encrypted', path, None, True)
+
+        self.assertEqual((encrypted_path, output_path, read_bytes, written_bytes), (path + '.encrypted', None, 0, 0))
+        self.assertTrue(error.startswith('EOFError: '))
+        self.assertEqual(os.listdir(self.folder), ['data.json.bz2.encrypted'])
+
+class EncryptionTestCase(TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+        self.content = os.urandom(100)
+
+    def encrypted(self, content):
+        encrypted = io.BytesIO()
+
+        encrypt_stream(self.key, io.BytesIO(content), encrypted, chunk_size=16)
+
+        return bytearray(encrypted.getvalue())
+
+    def decrypted(self, encrypted):
+        decrypted = io.BytesIO()
+
+        decrypt_stream(self.key, io.BytesIO(bytes(encrypted)), decrypted)
+
+        return decrypted.getvalue()
+
+    def record_offset(self, index):
+        return HEADER_STRUCT.size + index * (RECORD_STRUCT.size + SecretBox.MACBYTES + 16)
+
+    def test_round_trip_at_chunk_sizes(self):
+        for size in (0, 1, 15, 16, 32, 33, 100):
+            encrypted = self.encrypted(self.content[:size])
+
+            self.assertEqual(self.decrypted(encrypted), self.content[:size])
+
+            # Exact multiples of the chunk size end on a full final record, not an empty one.
+
+            records = max(1, (size + 15) // 16)
+
+            self.assertEqual(len(encrypted), HEADER_STRUCT.size + records * (RECORD_STRUCT.size + SecretBox.MACBYTES) + size)
+
+    def test_tampered_record_rejected(self):
+        encrypted = self.encrypted(self.content)
+
+        encrypted[self.record_offset(2) + RECORD_STRUCT.size + 3] ^= 0x01
+
+        with self.assertRaises(CryptoError):
+            self.decrypted(encrypted)
+
+    def test_final_flag_flip_rejected(self):
+        # Marking an earlier record final would truncate the content, and unmarking the last one extend it.
+
+        encrypted = self.encrypted(self.content)
+
+        encrypted[self.record_offset(2)] |= FLAG_FINAL
+
+        with self.assertRaises(CryptoError):
+            self.decrypted(encrypted[:self.record_offset(3)])
+
+        encrypted = self.encrypted(self.content)
+
+        encrypted[self.record_offset(6)] &= ~FLAG_FINAL
+
+        with self.assertRaises(CryptoError):
+            self.decrypted(encrypted)
+
+    def test_truncated_file_rejected(self):
+        encrypted = self.encrypted(self.content)
+
+        for size in (HEADER_STRUCT.size - 1, self.record_offset(6), self.record_offset(6) + RECORD_STRUCT.size + 2, len(encrypted) - 1):
+            with self.assertRaises(CryptoError):
+                self.decrypted(encrypted[:size])
+
+        with self.assertRaises(CryptoError):
+            self.decrypted(encrypted + b'\0')
+
+    def test_legacy_box_decrypted(self):
+        # Files written before the chunked container are a single SecretBox message.
+
+        self.assertEqual(self.decrypted(SecretBox(self.key).encrypt(self.content)), self.content)
+
+        with self.assertRaises(CryptoError):
+            self.decrypted(SecretBox(os.urandom(32)).encrypt(self.content))
+
+class RestoreTestCase(TestCase):
+    def test_auto_now_values_kept(self):
+        joined = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=pytz.utc)
+
+        User.objects.create(pk=1, username='restored', date_joined=joined)
+
+        records = serializers.serialize('python', User.objects.all())
+
+        User.objects.all().delete()
+
+        # Stamped fields get the current time on any insert that is not raw.
+
+        with mock.patch.object(User._meta.get_field('date_joined'), 'auto_now_add', True): # pylint: disable=protected-access
+            insert_batch(User, list(serializers.deserialize('python', records)))
+
+        self.assertEqual(User.objects.get(pk=1).date_joined, joined)
+
+    def restore_groups(self):
+        permissions = list(Permission.objects.order_by('pk').values_list('pk', flat=True)[:3])
+
+        group = Group.objects.create(pk=1, name='old')
+        group.permissions.set(permissions[:2])
+
+        records = [
+            {'model': 'auth.group', 'pk': 1, 'fields': {'name': 'new', 'permissions': permissions[1:]}},
+            {'model': 'auth.group', 'pk': 2, 'fields': {'name': 'added', 'permissions': []}},
+        ]
+
+        insert_batch(Group, list(serializers.deserialize('python', records)))
+
+        # Later windows replace whole rows, many-to-many rows included.
+
+        self.assertEqual(list(Group.objects.order_by('pk').values_list('pk', 'name')), [(1, 'new'), (2, 'added')])
+        self.assertEqual(sorted(Group.objects.get(pk=1).permissions.values_list('pk', flat=True)), permissions[1:])
+        self.assertEqual(list(Group.objects.get(pk=2).permissions.all()), [])
+
+    def test_later_rows_overwrite(self):
+        self.restore_groups()
+
+    def test_overwrite_without_upserts(self):
+        # Older Django versions and databases update existing rows one by one.
+
+        with mock.patch.object(restore_backup, 'bulk_options', return_value=None):
+            self.restore_groups()
+
+class WatermarkTestCase(TestCase):
+    def window(self, day):
+        start = datetime.datetime(2026, 8, day, tzinfo=pytz.utc)
+
+        return {'start_date': start, 'end_date': start + datetime.timedelta(days=1)}
+
+    def dumped(self, model, day, created_field=None):
+        return list(new_rows(model, 'id', self.window(day), created_field=created_field).values_list('pk', flat=True))
+
+    def test_ranges_follow_window_order(self):
+        for index in range(1, 4):
+            Group.objects.create(pk=index, name='group-%d' % index)
+
+        self.assertEqual(self.dumped(Group, 2), [1, 2, 3])
+
+        for index in range(4, 6):
+            Group.objects.create(pk=index, name='group-%d' % index)
+
+        self.assertEqual(self.dumped(Group, 3), [4, 5])
+
+        # Re-running a window dumps its recorded range, not what is new since.
+
+        Group.objects.create(pk=6, name='group-6')
+
+        self.assertEqual(self.dumped(Group, 2), [1, 2, 3])
+        self.assertEqual(list(DumpWatermark.objects.order_by('start_date').values_list('start_value', 'end_value')), [(None, 3), (3, 5)])
+
+        with self.assertRaises(ValueError):
+            self.dumped(Group, 1)
+
+    def test_created_field_bounds_range(self):
+        for index, day in enumerate((1, 1, 2, 3, 3, 3)):
+            User.objects.create(pk=index + 1, username='user-%d' % index, date_joined=datetime.datetime(2026, 8, day, 12, tzinfo=pytz.utc))
+
+        # Windows may run in any order.
+
+        self.assertEqual(self.dumped(User, 3, 'date_joined'), [4, 5, 6])
+        self.assertEqual(self.dumped(User, 1, 'date_joined'), [1, 2])
+        self.assertEqual(self.dumped(User, 2, 'date_joined'), [3])
+        self.assertEqual(self.dumped(User, 4, 'date_joined'), [])
+
+        User.objects.create(pk=7, username='late', date_joined=datetime.datetime(2026, 8, 2, 18, tzinfo=pytz.utc))
+
+        self.assertEqual(self.dumped(User, 2, 'date_joined'), [3])
+
+class RecordParsingTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        self.records = [{'model': 'auth.group', 'pk': index, 'fields': {'name': 'gr%sppe %d' % (six.unichr(0xfc), index)}} for index in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def parsed(self, content):
+        path = os.path.join(self.folder, 'records.json')
+
+        with io.open(path, 'wb') as records_file:
+            records_file.write(content.encode('utf-8'))
+
+        # Tiny reads split records, and multi-byte characters, between reads.
+
+        with mock.patch.object(archives, 'READ_SIZE', 7):
+            return list(iter_records(None, path, encrypted=False))
+
+    def test_array_parsed_in_pieces(self):
+        self.assertEqual(self.parsed(json.dumps(self.records, ensure_ascii=False)), self.records)
+        self.assertEqual(self.parsed('[]'), [])
+
+    def test_json_lines_parsed(self):
+        self.assertEqual(self.parsed('\n'.join(json.dumps(record, ensure_ascii=False) for record in self.records) + '\n'), self.records)
+
+    def test_truncated_array_rejected(self):
+        with self.assertRaises(ValueError):
+            self.parsed(json.dumps(self.records)[:-10])
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        self.content = b''.join(hashlib.sha256(str(index).encode('ascii')).hexdigest().encode('ascii') * (index % 5) for index in range(500))
+
+        # Threaded bz2 writes a separate stream per block.
+
+        self.codecs = [codec_class() for name, codec_class in sorted(CODEC_CLASSES.items()) if codec_class().available()] + [codec_named('bz2', threads=2, block_size=1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def decompressed(self, codec, compressed):
+        path = os.path.join(self.folder, 'content' + codec.extension)
+
+        with io.open(path, 'wb') as compressed_file:
+            compressed_file.write(compressed)
+
+        # Tiny reads end streams exactly where a read does.
+
+        with mock.patch.object(compression, 'READ_SIZE', 7):
+            with io.open(decompress_file(path, chunk_size=100), 'rb') as output_file:
+                return output_file.read()
+
+    def test_codecs_round_trip(self):
+        for codec in self.codecs:
+            self.assertEqual(self.decompressed(codec, codec.compress(self.content)), self.content)
+            self.assertEqual(self.decompressed(codec, codec.compress(b'')), b'')
+            self.assertEqual(codec.decompress(codec.compress(self.content)), self.content)
+
+    def test_concatenated_streams_read(self):
+        for codec in self.codecs:
+            compressed = codec.compress(self.content[:1000]) + codec.compress(b'') + codec.compress(self.content[1000:])
+
+            self.assertEqual(self.decompressed(codec, compressed), self.content)
+
+    def test_truncated_stream_rejected(self):
+        codec = codec_named('bz2')
+
+        with self.assertRaises(EOFError):
+            self.decompressed(codec, codec.compress(self.content)[:-10])
+
+@override_settings(ALLOWED_HOSTS=['test'], SIMPLE_BACKUP_DUMPDATA_APPS=('auth',), SIMPLE_BACKUP_DUMP_ENGINE='dumpdata', SIMPLE_BACKUP_INCREMENTAL_MODELS=())
+class CatalogTestCase(TestCase):
+    def setUp(self):
+        self.staging = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def test_dumpdata_rows_counted(self):
+        for index in range(3):
+            User.objects.create(pk=10 + index, username='user-%d' % index)
+
+        Group.objects.create(pk=7, name='group')
+
+        parameters = {
+            'staging_destination': self.staging,
+            'start_date': timezone.now() - datetime.timedelta(days=1),
+            'end_date': timezone.now(),
+        }
+
+        paths = incremental_backup(parameters)
+
+        self.assertEqual([os.path.basename(path) for path in paths], ['simple_backup_test_auth.json-dumpdata' + configured_codec().extension])
+
+        stats = read_catalog_stats(paths[0])
+
+        self.assertEqual(stats['auth.User'], {'rows': 3, 'min_pk': 10, 'max_pk': 12})
+        self.assertEqual(stats['auth.Group'], {'rows': 1, 'min_pk': 7, 'max_pk': 7})
+
+        # The counted format writes the same records dumpdata's "json" does.
+
+        records = list(iter_records(None, paths[0], encrypted=False))
+
+        self.assertEqual(len(records), sum(entry['rows'] for entry in stats.values()))
+        self.assertEqual(records, json.loads(serializers.serialize('json', [obj for model in (Permission, Group, User) for obj in model.objects.order_by('pk')])))